@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Retrieve the light curves of any source without know their tile.
+
+The tile of every source is inferred from the prefix of their id (see
+`carpyncho.models.Tile`) and only the rows of the requested sources are
+readed with the CSR index of the observations. The indexes and the
+readed light curves are keeped in a LRU cache limited by memory
+(``LC_CACHE_BYTES`` setting).
+
+Only the compacted observations are readed: the sources of a tile with
+segments not compacted yet (see `carpyncho.models.LightCurves.compact`)
+can be incomplete and a warning is emitted.
+
+Example
+-------
+
+>>> from corral import db
+>>> from carpyncho import api
+>>> with db.session_scope() as session:
+...     reader = api.LightCurvesReader(session)
+...     lcs = reader.light_curves([30010000000130, 40010000000130])
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import warnings
+from collections import OrderedDict
+
+from corral import db
+from corral.conf import settings
+
+from .models import Tile, LightCurves
+from .lib import lcindex
+from .lib.lru import LRUCache
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+DEFAULT_CACHE_BYTES = 512 * 1024 ** 2
+
+ZONES_NAMES = dict((v, k) for k, v in Tile.ZONES.items())
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def tile_name_of(src_id):
+    """Name of the tile of the source (``40010000000130`` -> ``"d001"``)"""
+    src_id = str(src_id)
+    if len(src_id) != 14 or src_id[0] not in ZONES_NAMES:
+        raise ValueError("Invalid source id '{}'".format(src_id))
+    return ZONES_NAMES[src_id[0]] + src_id[1:4]
+
+
+def get_light_curves(src_ids, columns=None, max_bytes=None):
+    """Retrieve the light curves of the given sources in a new session
+    (see `LightCurvesReader.light_curves`)
+
+    """
+    with db.session_scope() as session:
+        reader = LightCurvesReader(session, max_bytes=max_bytes)
+        return reader.light_curves(src_ids, columns=columns)
+
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+class LightCurvesReader(object):
+    """Read the light curves of sources of any tile.
+
+    Parameters
+    ----------
+
+    session : sqlalchemy.orm.Session
+        Session used to retrieve the light curves of the tiles.
+    max_bytes : int or None
+        Memory limit of the cache. None means the ``LC_CACHE_BYTES``
+        setting.
+
+    """
+
+    def __init__(self, session, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = settings.get("LC_CACHE_BYTES", DEFAULT_CACHE_BYTES)
+        self.session = session
+        self.cache = LRUCache(max_bytes)
+
+    def get_lcurves(self, tile_name):
+        query = self.session.query(LightCurves).join(Tile).filter(
+            Tile.name == tile_name)
+        return query.first()
+
+    def get_index(self, tile_name, lc):
+        key = ("index", tile_name)
+        index = self.cache.get(key)
+        if index is None and lc is not None:
+            index = lc.observations_index
+            if index is not None:
+                self.cache.set(key, index)
+        return index
+
+    def light_curves(self, src_ids, columns=None):
+        """Retrieve the observations (sorted by time) of every source.
+
+        Returns
+        -------
+
+        OrderedDict
+            The observations of every source in the same order of
+            ``src_ids``. The sources of tiles without light curves has
+            None and the sources without observations an empty array.
+
+        """
+        src_ids = [int(src_id) for src_id in src_ids]
+
+        result, by_tile = {}, {}
+        for src_id in src_ids:
+            obs = self.cache.get(("obs", src_id))
+            if obs is None:
+                by_tile.setdefault(tile_name_of(src_id), set()).add(src_id)
+            else:
+                result[src_id] = obs
+
+        for tile_name, tile_src_ids in sorted(by_tile.items()):
+            lc = self.get_lcurves(tile_name)
+            index = self.get_index(tile_name, lc)
+            if lc is not None and lc.segments:
+                warnings.warn((
+                    "The tile {} has {} segments not compacted, their "
+                    "observations are not retrieved").format(
+                        tile_name, lc.segments))
+
+            # the sources are readed in the order of the file
+            for src_id in sorted(tile_src_ids):
+                if index is None:
+                    result[src_id] = None
+                    continue
+                src_slice = lcindex.source_slice(index, src_id)
+                obs = lc.read_observations(src_slice)
+                result[src_id] = self.cache.set(("obs", src_id), obs)
+
+        return OrderedDict(
+            (src_id, (
+                result[src_id] if columns is None or result[src_id] is None
+                else result[src_id][columns]))
+            for src_id in src_ids)
+
+    def light_curve(self, src_id, columns=None):
+        """Retrieve the observations of only one source"""
+        return self.light_curves([src_id], columns=columns)[int(src_id)]
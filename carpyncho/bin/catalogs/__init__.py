@@ -3,6 +3,8 @@
 
 import os
 
+import numpy as np
+
 import pandas as pd
 
 from astropy.coordinates import SkyCoord
@@ -11,6 +13,7 @@ from astropy.io.votable import parse
 from sh import bzip2
 
 from ...lib.context_managers import cd
+from ...lib import zones
 
 
 # =============================================================================
@@ -21,6 +24,17 @@ PATH = os.path.abspath(os.path.dirname(__file__))
 
 CATALOG_PATH = os.path.join(PATH, "carpyncho_catalog.pkl")
 
+NPY_CATALOG_PATH = os.path.join(PATH, "carpyncho_catalog.npy")
+
+ZONES_PATH = os.path.join(PATH, "carpyncho_catalog_zones.npy")
+
+CATALOG_DTYPE = [
+    ("ID", "|S25"),
+    ("ra", float),
+    ("dec", float),
+    ("cls", "|S13"),
+    ("catalog", "|S13")]
+
 
 # =============================================================================
 # BUILD
@@ -118,6 +132,28 @@ def build():
     print("Saving catalog")
     # ~ catalog.to_pickle(CATALOG_PATH)
 
+    print("Indexing catalog")
+    build_index(load())
+
+
+def build_index(df):
+    """Store the catalog as a binary array sorted by declination zones
+    plus the offsets of every zone.
+
+    """
+    order, offsets = zones.build(df.ra.values, df.dec.values)
+    df = df.iloc[order]
+
+    arr = np.empty(len(df), dtype=CATALOG_DTYPE)
+    arr["ID"] = df.ID.astype(str).values
+    arr["ra"] = df.ra.values
+    arr["dec"] = df.dec.values
+    arr["cls"] = df.cls.astype(str).values
+    arr["catalog"] = df.catalog.astype(str).values
+
+    np.save(NPY_CATALOG_PATH, arr)
+    np.save(ZONES_PATH, offsets)
+
 
 # =============================================================================
 # LOAD
@@ -125,3 +161,35 @@ def build():
 
 def load():
     return pd.read_pickle(CATALOG_PATH)
+
+
+def index_is_stale():
+    """True if the zone index is missing or older than the pickled
+    catalog.
+
+    """
+    paths = NPY_CATALOG_PATH, ZONES_PATH
+    if not all(os.path.exists(path) for path in paths):
+        return True
+    if not os.path.exists(CATALOG_PATH):
+        return False
+    catalog_mtime = os.path.getmtime(CATALOG_PATH)
+    return any(os.path.getmtime(path) < catalog_mtime for path in paths)
+
+
+def load_footprint(ra, dec, pad=0.):
+    """Retrieve only the sources of the catalog inside the box that
+    contains the given coordinates plus pad degrees. Only the declination
+    zones of the box are readed from disk.
+
+    The zone index is rebuilt if the pickled catalog is newer.
+
+    """
+    if index_is_stale():
+        build_index(load())
+    catalog = np.load(NPY_CATALOG_PATH, mmap_mode="r")
+    offsets = np.load(ZONES_PATH)
+
+    box = zones.footprint(ra, dec, pad=pad)
+    idxs = zones.select(catalog, offsets, box)
+    return np.array(catalog[idxs])
@@ -18,6 +18,11 @@
 # =============================================================================
 
 import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
 
 from psutil import virtual_memory
 
@@ -25,7 +30,8 @@ from texttable import Texttable
 
 from corral import cli, conf, db, core
 
-from carpyncho import bin
+from carpyncho import bin, api
+from carpyncho.lib import lcindex, lcstorage
 from carpyncho.models import (
     Tile, PawprintStack, PawprintStackXTile, LightCurves)
 
@@ -198,8 +204,10 @@ class SampleFeatures(cli.BaseCommand):
 
     def setup(self):
         self.parser.add_argument(
-            "tnames", action="store", nargs="+",
-            help="name of the tiles to sample")
+            "tnames", action="store", nargs="*",
+            help=(
+                "name of the tiles to sample. If is empty and a "
+                "cone-search is given all the tiles are used"))
 
         self.parser.add_argument(
             "--output", "-o", dest="output", required=True,
@@ -210,7 +218,8 @@ class SampleFeatures(cli.BaseCommand):
             type=float, metavar=('RA', 'DEC', 'RADIUS'), help=(
                 "Describes sky position and an angular distance, defining a "
                 "cone on the sky. The response returns a list of astronomical "
-                "sources from the catalog whose positions lie within the cone"))
+                "sources from the catalog whose positions lie within the cone "
+                "(all the values in degrees)"))
 
         self.parser.add_argument(
             "--ucls-size", "-u", dest="no_cls_size", default=2500,
@@ -245,44 +254,26 @@ class SampleFeatures(cli.BaseCommand):
             action="store_false",
             help="ignore the memory che before run the command")
 
-    def cone_search(self, features, ra_c, dec_c, sr_c):
-        import numpy as np
-
-        # sometimes the ra_k cames in str...
-        features.ra_k = features.ra_k.astype(float)
-        features.dec_k = features.dec_k.astype(float)
-
-        # the conesearch
-        # based on:
-        #   http://www.g-vo.org/pmwiki/Products/HEALPixIndexing
-        # ORIGINAL:
-        # SELECT *
-        # FROM RASS_PHOTONS
-        # WHERE 2 * ASIN(
-        #   SQRT(
-        #       SIN(($DEC_C-DEC)/2) *
-        #       SIN(($DEC_C-DEC)/2) +
-        #       COS($DEC_C) * COS(DEC) *
-        #       SIN(($RA_C - RA)/2) *
-        #       SIN(($RA_C - RA)/2))) <= $SR_C
-        query = 2. * np.arcsin(
-            np.sqrt(
-                np.sin((dec_c - features.dec_k) / 2.) *
-                np.sin((dec_c - features.dec_k) / 2.) +
-                np.cos(dec_c) * np.cos(features.dec_k) *
-                np.sin((ra_c - features.ra_k) / 2.) *
-                np.sin((ra_c - features.ra_k) / 2.))) <= sr_c
-
-        # filtering
-        features = features[query]
-        return features
+    def select(self, lc, features, cone_search):
+        """All the features of the sampled sources (the cone search already
+        has all the features)
 
+        """
+        if cone_search:
+            return features
+        return lc.features_frame(rows=np.sort(features.index.values))
 
     def handle(
         self, tnames, output, cone_search, no_cls_size, no_saturated,
         no_faint, include_vs, memory_check, vs_type):
+        if not (tnames or cone_search):
+            self.parser.error(
+                "You must provide at least one tile name or a "
+                "'--cone-search/-cs'")
+
+        # the cone search only read the sources inside the cone
         min_memory, mem = int(32e+9), virtual_memory()
-        if memory_check and mem.total < min_memory:
+        if memory_check and not cone_search and mem.total < min_memory:
             min_memory_gb = min_memory / 1e+9
             total_gb = mem.total / 1e+9
             msg = "You need at least {}GB of memory. Found {}GB"
@@ -300,14 +291,38 @@ class SampleFeatures(cli.BaseCommand):
 
         import pandas as pd
 
+        # the magnitude filters skip the row groups of the features
+        # that can't match
+        where = []
+        if no_saturated:
+            where.append(("Mean", ">", 12))
+        if no_faint:
+            where.append(("Mean", "<", 16.5))
+
         result = []
         with db.session_scope() as session:
-            query = session.query(
-                LightCurves).join(Tile).filter(Tile.name.in_(tnames))
+            query = session.query(LightCurves).join(Tile)
+            if tnames:
+                query = query.filter(Tile.name.in_(tnames))
             for lc in query:
-                print "Reading features of tile {}...".format(lc.tile.name)
-
-                features = pd.DataFrame(lc.features)
+                if cone_search:
+                    ra, dec, radius = cone_search
+                    # the tiles outside the cone are not opened
+                    if not lc.touches_cone(ra=ra, dec=dec, radius=radius):
+                        continue
+                    print "ConeSearch({}, {}, {}) of tile {} <-".format(
+                        ra, dec, radius, lc.tile.name)
+                    features = pd.DataFrame(
+                        lc.cone_search(ra=ra, dec=dec, radius=radius))
+                    if features.empty:
+                        continue
+                else:
+                    # only the columns of the filters are readed, and all
+                    # the features only of the selected sources
+                    print "Reading features of tile {}...".format(
+                        lc.tile.name)
+                    features = lc.features_frame(
+                        ["Mean", "vs_type"], where=where)
                 print "Sources {}".format(len(features))
 
                 if no_saturated:
@@ -318,19 +333,14 @@ class SampleFeatures(cli.BaseCommand):
                     print "No Faint <-"
                     features = features[features.Mean < 16.5]
 
-                if cone_search:
-                    ra, dec, radius = cone_search
-                    print "ConeSearch({}, {}, {}) <-".format(ra, dec, radius)
-                    features = self.cone_search(
-                        features=features, ra_c=ra, dec_c=dec, sr_c=radius)
-
                 if include_vs:
                     print "Retrieving '{}' VS <-".format(vs_type or all)
                     vss = features[features.vs_type != ""]
                     if vs_type:
                         vss = vss[vss.vs_type.str.contains(vs_type)]
                     if len(vss):
-                        result.append(vss)
+                        result.append(
+                            self.select(lc, vss, cone_search))
 
                 print "Sampling Unk Src <-"
                 unk = features[features.vs_type == ""]
@@ -342,8 +352,12 @@ class SampleFeatures(cli.BaseCommand):
                         continue
                 else:
                     sample_size = no_cls_size
-                unk = unk.sample(sample_size)
-                result.append(unk)
+                unk = unk.sample(min(sample_size, len(unk)))
+                result.append(self.select(lc, unk, cone_search))
+
+        if not result:
+            print "No sources found"
+            return
 
         print "Merging"
         result = pd.concat(result, ignore_index=True)
@@ -360,3 +374,145 @@ class SampleFeatures(cli.BaseCommand):
         else:
             msg = "unknow type {}".format(output)
             raise ValueError(msg)
+
+
+class BenchLCStorage(cli.BaseCommand):
+    """Compare the storage backends of the light curves of the given tile
+    (size, full scan time and per-source random access time)
+
+    """
+
+    options = {"title": "bench-lc-storage"}
+
+    def setup(self):
+        self.parser.add_argument(
+            "tname", action="store", help="name of the tile to benchmark")
+        self.parser.add_argument(
+            "--storages", "-s", dest="storages", action="store", nargs="+",
+            choices=sorted(lcstorage.STORAGES),
+            default=sorted(lcstorage.STORAGES),
+            help="storage backends to compare")
+        self.parser.add_argument(
+            "--sources", "-n", dest="sources", action="store", type=int,
+            default=1000, help="number of random sources to read")
+        self.parser.add_argument(
+            "--directory", "-d", dest="directory", action="store",
+            default=None, help="where the temporary files are written")
+
+    def bench(self, storage, path, obs, index, sources):
+        started = time.time()
+        storage.save(path, obs)
+        write_time = time.time() - started
+
+        # read all the file and touch every value
+        started = time.time()
+        full = storage.load(path)
+        full["pwp_stack_src_mag3"].sum()
+        scan_time = time.time() - started
+        del full
+
+        started = time.time()
+        for src_id in sources:
+            src_slice = lcindex.source_slice(index, src_id)
+            storage.read(path, src_slice.start, src_slice.stop)
+        random_time = time.time() - started
+
+        return (
+            lcstorage.size(path) / 1e6, write_time, scan_time,
+            random_time / len(sources) * 1e3)
+
+    def handle(self, tname, storages, sources, directory):
+        log2critcal()
+        with db.session_scope() as session:
+            lc = session.query(LightCurves).join(Tile).filter(
+                Tile.name == tname).one()
+            print("Reading observations of tile {}...".format(tname))
+            index = lc.observations_index
+            obs = np.array(lc.observations)
+
+        random = np.random.RandomState(42)
+        sources = random.choice(index["id"], min(sources, len(index)), False)
+
+        table = Texttable(max_width=0)
+        table.set_deco(Texttable.BORDER | Texttable.HEADER | Texttable.VLINES)
+        table.header((
+            "Storage", "Size (MB)", "Write (s)", "Full Scan (s)",
+            "Per Source (ms)"))
+
+        path = tempfile.mkdtemp(suffix="_carpyncho_bench", dir=directory)
+        try:
+            for name in storages:
+                print("Benchmarking {}...".format(name))
+                storage = lcstorage.get_storage(name)
+                fpath = os.path.join(path, "bench" + storage.extension)
+                row = self.bench(storage, fpath, obs, index, sources)
+                table.add_row((name,) + row)
+        finally:
+            shutil.rmtree(path)
+        print(table.draw())
+
+
+class GetLightCurves(cli.BaseCommand):
+    """Retrieve the light curves of the given sources of any tile"""
+
+    options = {"title": "get-lc"}
+
+    def setup(self):
+        self.parser.add_argument(
+            "src_ids", action="store", nargs="+", type=int,
+            help="ids of the sources")
+        self.parser.add_argument(
+            "--output", "-o", dest="output", default=None,
+            help="path of the file (csv, pkl or bz2) to store the light curves")
+        self.parser.add_argument(
+            "--columns", "-c", dest="columns", nargs="+", default=None,
+            help="only retrieve this columns of the observations")
+        self.parser.add_argument(
+            "--cache-bytes", "-cb", dest="max_bytes", type=int, default=None,
+            help="memory limit of the cache (LC_CACHE_BYTES by default)")
+
+    def handle(self, src_ids, output, columns, max_bytes):
+        log2critcal()
+        import pandas as pd
+
+        with db.session_scope() as session:
+            reader = api.LightCurvesReader(session, max_bytes=max_bytes)
+            try:
+                lcs = reader.light_curves(src_ids, columns=columns)
+            except ValueError as err:
+                self.parser.error(str(err))
+
+        table = Texttable(max_width=0)
+        table.set_deco(Texttable.BORDER | Texttable.HEADER | Texttable.VLINES)
+        table.header(("Source", "Tile", "Observations"))
+        for src_id, obs in lcs.items():
+            table.add_row((
+                src_id, api.tile_name_of(src_id),
+                "-" if obs is None else len(obs)))
+        print(table.draw())
+
+        if output:
+            result = []
+            for src_id, obs in lcs.items():
+                if obs is None or not len(obs):
+                    continue
+                obs = pd.DataFrame(obs)
+                if "bm_src_id" not in obs.columns:
+                    obs.insert(0, "bm_src_id", src_id)
+                result.append(obs)
+            if not result:
+                print("No observations found")
+                return
+            result = pd.concat(result, ignore_index=True)
+
+            print("Saving to {}".format(output))
+            ext = os.path.splitext(output)[-1]
+            if ext == ".csv":
+                result.to_csv(output, index=False)
+            elif ext == ".pkl":
+                result.to_pickle(output)
+            elif ext == ".bz2":
+                result.to_pickle(output, compression="bz2")
+            else:
+                msg = "unknow type {}".format(output)
+                raise ValueError(msg)
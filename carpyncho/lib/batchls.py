@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Generalized Lomb-Scargle periodogram of many sources at once.
+
+All the sources of a tile are observed in the same pawprint epochs (their
+hjd only differs by the heliocentric correction of every position), so
+the sin/cos basis of every epoch and frequency can be computed only once
+and the periodogram of all the sources is a few matrix products.
+
+The missing epochs of every source have weight 0. The power uses the
+``standard`` normalization of the floating mean periodogram (like
+``astropy.stats.LombScargle`` with errors and ``fit_mean=True``).
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import numpy as np
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+#: Number of frequencies evaluated in every matrix product
+FREQUENCY_CHUNK = 2048
+
+PERIODS_DTYPE = [
+    ("id", np.int64), ("frequency", float), ("power", float),
+    ("fmax", np.int64)]
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def autofrequency(baseline, n_samples, minimum_frequency=None,
+                  maximum_frequency=None, samples_per_peak=5,
+                  nyquist_factor=5, **kwargs):
+    """The frequency grid of ``LombScargle.autopower`` for the given
+    baseline and number of observations (the other keywords of the
+    autopower are ignored)
+
+    """
+    df = 1. / baseline / samples_per_peak
+    if minimum_frequency is None:
+        minimum_frequency = .5 * df
+    if maximum_frequency is None:
+        avg_nyquist = .5 * n_samples / baseline
+        maximum_frequency = nyquist_factor * avg_nyquist
+    n_frequencies = 1 + int(np.round(
+        (maximum_frequency - minimum_frequency) / df))
+    return minimum_frequency + df * np.arange(n_frequencies)
+
+
+def best_frequencies(time, magnitude, weights, frequency,
+                     chunk_size=FREQUENCY_CHUNK):
+    """Frequency with the max power of every source.
+
+    Parameters
+    ----------
+
+    time : np.ndarray
+        Time of every one of the E epochs.
+    magnitude : np.ndarray
+        (S, E) magnitudes of every source in every epoch.
+    weights : np.ndarray
+        (S, E) weights (``1 / error ** 2``) of every magnitude; 0 for the
+        missing epochs.
+    frequency : np.ndarray
+        Frequencies to evaluate.
+
+    Returns
+    -------
+
+    fmax : np.ndarray
+        Position of the best frequency of every source.
+    power : np.ndarray
+        Power of the best frequency of every source.
+
+    """
+    time = np.asarray(time, dtype=float)
+    time = time - time.min()
+
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / weights.sum(axis=1)[:, np.newaxis]
+
+    # the magnitudes of the missing epochs can be anything (even NaN)
+    magnitude = np.where(weights > 0, magnitude, 0.)
+    mean = np.sum(weights * magnitude, axis=1)
+    centered = np.where(
+        weights > 0, magnitude - mean[:, np.newaxis], 0.)
+    wy = weights * centered
+    yy = np.sum(wy * centered, axis=1)[:, np.newaxis]
+
+    n_sources = len(weights)
+    best_power = np.full(n_sources, -np.inf)
+    fmax = np.zeros(n_sources, dtype=np.int64)
+    for start in range(0, len(frequency), chunk_size):
+        freqs = frequency[start:start + chunk_size]
+        size = len(freqs)
+
+        # the basis is shared by all the sources
+        arg = 2 * np.pi * np.outer(time, freqs)
+        cos, sin = np.cos(arg), np.sin(arg)
+
+        w_sums = weights.dot(np.hstack((cos, sin, cos * cos, cos * sin)))
+        c = w_sums[:, :size]
+        s = w_sums[:, size:2 * size]
+        cc_hat = w_sums[:, 2 * size:3 * size]
+        cs_hat = w_sums[:, 3 * size:]
+
+        y_sums = wy.dot(np.hstack((cos, sin)))
+        yc, ys = y_sums[:, :size], y_sums[:, size:]
+
+        cc = cc_hat - c * c
+        ss = (1. - cc_hat) - s * s
+        cs = cs_hat - c * s
+        d = cc * ss - cs * cs
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            power = (
+                (ss * yc * yc + cc * ys * ys - 2 * cs * yc * ys) / (yy * d))
+        power[~np.isfinite(power)] = -np.inf
+
+        chunk_best = np.argmax(power, axis=1)
+        chunk_power = power[np.arange(n_sources), chunk_best]
+        better = chunk_power > best_power
+        best_power[better] = chunk_power[better]
+        fmax[better] = chunk_best[better] + start
+
+    return fmax, best_power
+
+
+def from_observations(obs, src_ids, autopower_kwds=None,
+                      source_id="bm_src_id", epoch="pwp_id",
+                      time="pwp_stack_src_hjd",
+                      magnitude="pwp_stack_src_mag3",
+                      error="pwp_stack_src_mag_err3"):
+    """Best frequency of the given sources from their observations. The
+    time of every epoch (pawprint) is the mean time of their
+    observations and the frequency grid is the autopower grid of the
+    baseline of the epochs.
+
+    Returns
+    -------
+
+    np.ndarray
+        The ``id``, best ``frequency``, their ``power`` and their
+        position in the grid (``fmax``) of every source.
+
+    """
+    autopower_kwds = autopower_kwds or {}
+    src_ids = np.asarray(src_ids)
+
+    valid = np.in1d(obs[source_id], src_ids) & (
+        np.isfinite(obs[time]) & np.isfinite(obs[magnitude]) &
+        np.isfinite(obs[error]) & (obs[error] > 0))
+    obs = obs[valid]
+
+    epochs, cols = np.unique(obs[epoch], return_inverse=True)
+    sorter = np.argsort(src_ids)
+    rows = sorter[np.searchsorted(src_ids, obs[source_id], sorter=sorter)]
+
+    shape = (len(src_ids), len(epochs))
+    mags = np.zeros(shape)
+    weights = np.zeros(shape)
+    mags[rows, cols] = obs[magnitude]
+    weights[rows, cols] = 1. / obs[error] ** 2
+
+    epoch_time = (
+        np.bincount(cols, weights=obs[time], minlength=len(epochs)) /
+        np.bincount(cols, minlength=len(epochs)))
+
+    result = np.zeros(len(src_ids), dtype=PERIODS_DTYPE)
+    result["id"] = src_ids
+    result["frequency"] = np.nan
+    with_obs = weights.sum(axis=1) > 0
+    if len(epochs) < 2 or not with_obs.any():
+        return result
+
+    frequency = autofrequency(
+        baseline=epoch_time.max() - epoch_time.min(),
+        n_samples=len(epochs), **autopower_kwds)
+    fmax, power = best_frequencies(
+        epoch_time, mags[with_obs], weights[with_obs], frequency)
+
+    result["frequency"][with_obs] = frequency[fmax]
+    result["power"][with_obs] = power
+    result["fmax"][with_obs] = fmax
+    return result
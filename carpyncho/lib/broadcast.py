@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Publish big read-only numpy arrays to worker processes without copies.
+
+The arrays are written once into a shared memory backed directory
+(``/dev/shm`` when is available) and the workers receive only the path of
+the file, which is memory mapped again when is unpickled. This works with
+joblib and with the raw multiprocessing pools.
+
+Example
+-------
+
+>>> with Broadcast() as bcast:
+...     tile_data = bcast.publish(tile_data)
+...     with Parallel(n_jobs=CPUS) as jobs:
+...         jobs(delayed(func)(tile_data) for _ in range(100))
+...     print(bcast.report())
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+__all__ = ["Broadcast", "SharedArray"]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+SHM_PATH = "/dev/shm"
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def attach(path):
+    """Memory map (read-only) a published array"""
+    return np.load(path, mmap_mode="r")
+
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+class SharedArray(np.memmap):
+    """Memory mapped array that are pickled as a reference to their file.
+
+    Only the array returned by `Broadcast.publish` is shared; any view
+    of it (a slice or a column) is pickled as a regular array.
+
+    """
+
+    def __reduce__(self):
+        broadcast = self.__dict__.get("_broadcast")
+        if broadcast is None:
+            return np.asarray(self).__reduce__()
+        broadcast.saved += self.nbytes
+        return attach, (self.filename,)
+
+
+class Broadcast(object):
+    """Context manager to publish read-only arrays to the workers.
+
+    Parameters
+    ----------
+
+    directory : str or None
+        Where the temporary files of the arrays are stored. By default
+        ``/dev/shm`` if exists or the default temporary directory.
+
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = (
+                SHM_PATH if os.path.isdir(SHM_PATH) else
+                tempfile.gettempdir())
+        self.directory = directory
+        self.path = None
+        self.published = 0
+        self.published_bytes = 0
+        self.saved = 0
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(
+            suffix="_carpyncho_bcast", dir=self.directory)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.path and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.path = None
+
+    def publish(self, arr):
+        """Store the array in the shared directory and return a read-only
+        memory mapped version of it that can be sended to the workers
+        without copies.
+
+        """
+        if self.path is None:
+            raise RuntimeError("Broadcast must be used as a context manager")
+        fname = "array_{}.npy".format(self.published)
+        path = os.path.join(self.path, fname)
+        np.save(path, arr)
+
+        shared = attach(path).view(SharedArray)
+        shared._broadcast = self
+
+        self.published += 1
+        self.published_bytes += shared.nbytes
+        return shared
+
+    def report(self):
+        """Resume of the published arrays and the bytes that are not
+        copied to the workers
+
+        """
+        return (
+            "Broadcast: {} arrays ({:.2f} MB) published, "
+            "{:.2f} MB of copies saved").format(
+                self.published, self.published_bytes / 1e6,
+                self.saved / 1e6)
@@ -1,9 +1,9 @@
+import hashlib
+
 import feets
 
 import numpy as np
 
-from scipy.optimize import curve_fit
-
 from astropy.stats import lombscargle
 
 from feets.libs import ls_fap
@@ -17,23 +17,141 @@ from feets import Extractor
 
 EPS = np.finfo(float).eps
 
+LSCARGLE_KWDS = {
+    "autopower_kwds": {
+        "normalization": "standard",
+        "maximum_frequency": 10.,
+        "minimum_frequency": 1./200}}
+
+FAP_KWDS = {
+    "normalization": "standard",
+    "method": "simple"}
+
+#: Keywords of the autopower that define the frequency grid
+GRID_KWDS = (
+    "samples_per_peak", "nyquist_factor",
+    "minimum_frequency", "maximum_frequency")
+
+#: Frequencies of the own grid of a light curve around the seeded
+#: frequency where the best frequency is searched
+SEED_WINDOW = 2
+
 
 # =============================================================================
 # FUNCTIONS
 # =============================================================================
 
-def lscargle_error(time, magnitude, error,
-                   model_kwds=None, autopower_kwds=None):
+def adaptive_power(model, autopower_kwds=None, coarse_factor=5, top_k=5):
+    """Search the best frequency of the autopower grid in two stages: the
+    power is evaluated in a grid ``coarse_factor`` times coarser and then
+    with the full resolution only around the ``top_k`` highest peaks of
+    the coarse grid.
+
+    Returns
+    -------
+
+    frequency : np.ndarray
+        The (sorted) evaluated frequencies; all of them are frequencies
+        of the full grid.
+    power : np.ndarray
+        The power of every evaluated frequency.
+    fmax : int
+        The position of the best frequency in the full grid.
+
+    """
+    autopower_kwds = dict(autopower_kwds or {})
+    grid_kwds = dict(
+        (k, autopower_kwds.pop(k)) for k in GRID_KWDS if k in autopower_kwds)
+    full = model.autofrequency(**grid_kwds)
+
+    def power_of(idxs):
+        return model.power(
+            full[idxs], assume_regular_frequency=True, **autopower_kwds)
+
+    coarse_idxs = np.arange(0, len(full), coarse_factor)
+    coarse_power = power_of(coarse_idxs)
+
+    # the local maxima of the coarse grid, from the highest
+    padded = np.concatenate(([-np.inf], coarse_power, [-np.inf]))
+    peaks = np.flatnonzero(
+        (coarse_power >= padded[:-2]) & (coarse_power >= padded[2:]))
+    peaks = peaks[np.argsort(coarse_power[peaks])[::-1][:top_k]]
+
+    evaluated = {}
+    evaluated.update(zip(coarse_idxs, coarse_power))
+    for peak in coarse_idxs[peaks]:
+        start = max(peak - coarse_factor + 1, 0)
+        stop = min(peak + coarse_factor, len(full))
+        fine_idxs = np.arange(start, stop)
+        evaluated.update(zip(fine_idxs, power_of(fine_idxs)))
+
+    idxs = np.array(sorted(evaluated), dtype=int)
+    power = np.array([evaluated[idx] for idx in idxs])
+    return full[idxs], power, idxs[np.argmax(power)]
+
+
+def lscargle_error(time, magnitude, error, model_kwds=None,
+                   autopower_kwds=None, grid="full", grid_kwds=None):
+    """Lomb-Scargle periodogram of the light curve.
+
+    The ``grid`` can be ``"full"`` (all the frequencies of the autopower)
+    or ``"adaptive"`` (a coarse to fine search, see `adaptive_power`,
+    configured with ``grid_kwds``). The returned frequencies are the
+    evaluated ones, so their size is the number of evaluated frequencies,
+    but ``fmax`` is always the position of the best frequency in the full
+    grid (the best frequency is ``frequency[np.argmax(power)]``).
+
+    """
     model_kwds = model_kwds or {}
     autopower_kwds = autopower_kwds or {}
     model = lombscargle.LombScargle(time, magnitude, error, **model_kwds)
-    frequency, power = model.autopower(**autopower_kwds)
-
-    fmax = np.argmax(power)
+    if grid == "full":
+        frequency, power = model.autopower(**autopower_kwds)
+        fmax = np.argmax(power)
+    elif grid == "adaptive":
+        frequency, power, fmax = adaptive_power(
+            model, autopower_kwds, **(grid_kwds or {}))
+    else:
+        raise ValueError("Unknown grid '{}'".format(grid))
 
     return frequency, power, fmax
 
 
+def _freeze(obj):
+    """Hashable version of the (nested) keywords of a computation"""
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def harmonic_fit(time, magnitude, frequency, error=None):
+    """Fit ``a * sin(2 pi f t) + b * cos(2 pi f t) + c`` with linear least
+    squares (weighted by ``1 / error`` if the error is given).
+
+    Returns
+    -------
+
+    coefficients : tuple
+        The ``(a, b, c)`` of the fit.
+    model : np.ndarray
+        The fitted model evaluated in every time.
+
+    """
+    phase = 2 * np.pi * frequency * time
+    design = np.column_stack(
+        (np.sin(phase), np.cos(phase), np.ones_like(phase)))
+    if error is None:
+        coefficients = np.linalg.lstsq(design, magnitude, rcond=-1)[0]
+    else:
+        weights = 1. / np.asarray(error)
+        coefficients = np.linalg.lstsq(
+            design * weights[:, np.newaxis], magnitude * weights,
+            rcond=-1)[0]
+    return tuple(coefficients), design.dot(coefficients)
+
+
 def fap_error(max_power, fmax, time, magnitude, error,
         method, normalization, method_kwds=None):
     method_kwds = method_kwds or {}
@@ -44,6 +162,176 @@ def fap_error(max_power, fmax, time, magnitude, error,
         method_kwds=method_kwds)
 
 
+# =============================================================================
+# INTERMEDIATE RESULTS
+# =============================================================================
+
+class Intermediates(object):
+    """Results of one light curve shared by all the extractors of this
+    module: the periodogram (and their best frequency) and the data folded
+    with the best period. Every result is computed only once by every
+    combination of keywords.
+
+    The best frequency can be seeded with the result of a batched
+    periodogram (see `carpyncho.lib.batchls`); the seed is only used by
+    the extractors with the ``batch`` param. The seed is moved to the
+    best frequency of the own frequency grid of the light curve, so the
+    batch best period is the same of the periodogram of the light curve.
+
+    The power of a seeded best frequency is evaluated exactly, so the
+    false alarm probability of the batch results is only close to the
+    one of the periodogram of the light curve (the ``fast`` method of the
+    autopower is an approximation).
+
+    The periodogram is computed with the time shifted to start at 0 (the
+    periodogram is shift invariant and the shifted time keeps the
+    precision of the phases). The ``n_frequencies`` attribute counts the
+    frequencies evaluated by all the periodograms of the light curve, and
+    the ``total_frequencies`` class attribute the frequencies evaluated
+    by all the light curves of the process.
+
+    """
+
+    total_frequencies = 0
+
+    def __init__(self, time, magnitude, error, key):
+        self.time = time
+        self.magnitude = magnitude
+        self.error = error
+        self.key = key
+        self.shifted_time = time - np.min(time)
+        self._periodograms = {}
+        self._folded = {}
+        self._seeds = {}
+        self._grids = {}
+        self.n_frequencies = 0
+
+    def periodogram(self, lscargle_kwds):
+        """The (frequency, power, fmax) of the first periodogram"""
+        key = _freeze(lscargle_kwds)
+        if key not in self._periodograms:
+            self._periodograms[key] = self.lscargle(lscargle_kwds)
+        return self._periodograms[key]
+
+    def lscargle(self, lscargle_kwds, magnitude=None):
+        """Compute a new periodogram of the light curve (or of other
+        magnitudes in the same times) and count their evaluated
+        frequencies
+
+        """
+        magnitude = self.magnitude if magnitude is None else magnitude
+        result = lscargle_error(
+            time=self.shifted_time, magnitude=magnitude,
+            error=self.error, **lscargle_kwds)
+        self.n_frequencies += len(result[0])
+        Intermediates.total_frequencies += len(result[0])
+        return result
+
+    def model(self, lscargle_kwds):
+        """The LombScargle model of the light curve"""
+        return lombscargle.LombScargle(
+            self.shifted_time, self.magnitude, self.error,
+            **(lscargle_kwds.get("model_kwds") or {}))
+
+    def grid(self, lscargle_kwds):
+        """The full frequency grid of the autopower of the light curve"""
+        key = _freeze(lscargle_kwds)
+        if key not in self._grids:
+            autopower_kwds = lscargle_kwds.get("autopower_kwds") or {}
+            self._grids[key] = self.model(lscargle_kwds).autofrequency(**dict(
+                (k, v) for k, v in autopower_kwds.items() if k in GRID_KWDS))
+        return self._grids[key]
+
+    def exact_power(self, lscargle_kwds, frequency):
+        """Power of the given frequencies without approximations"""
+        autopower_kwds = lscargle_kwds.get("autopower_kwds") or {}
+        power_kwds = dict(
+            (k, v) for k, v in autopower_kwds.items()
+            if k not in GRID_KWDS + ("method", "method_kwds"))
+        return self.model(lscargle_kwds).power(
+            np.atleast_1d(frequency), **power_kwds)
+
+    def seed(self, lscargle_kwds, frequency, window=SEED_WINDOW):
+        """Set the best frequency computed outside this light curve. The
+        best frequency is searched in the ``window`` frequencies of the
+        own grid around the seed.
+
+        """
+        grid = self.grid(lscargle_kwds)
+        df = grid[1] - grid[0] if len(grid) > 1 else 1.
+        center = int(np.round((frequency - grid[0]) / df))
+        fmaxs = np.arange(center - window, center + window + 1)
+        fmaxs = fmaxs[(fmaxs >= 0) & (fmaxs < len(grid))]
+        if not len(fmaxs):
+            return
+        power = self.exact_power(lscargle_kwds, grid[fmaxs])
+        fmax = int(fmaxs[np.argmax(power)])
+        self._seeds[_freeze(lscargle_kwds)] = grid[fmax], np.max(power), fmax
+
+    def best(self, lscargle_kwds, batch=False):
+        """The best frequency, their power and their position in the
+        frequency grid (from the seed if ``batch`` is True and exists)
+
+        """
+        key = _freeze(lscargle_kwds)
+        if batch and key in self._seeds:
+            return self._seeds[key]
+        frequency, power, fmax = self.periodogram(lscargle_kwds)
+        best = np.argmax(power)
+        return frequency[best], power[best], fmax
+
+    def best_frequency(self, lscargle_kwds, batch=False):
+        return self.best(lscargle_kwds, batch)[0]
+
+    def folded(self, lscargle_kwds, batch=False):
+        """The magnitudes sorted by the phase of two times the best
+        period
+
+        """
+        key = (_freeze(lscargle_kwds), batch)
+        if key not in self._folded:
+            period = 2 / self.best_frequency(lscargle_kwds, batch)
+            new_time = np.mod(self.time, period) / period
+            self._folded[key] = self.magnitude[np.argsort(new_time)]
+        return self._folded[key]
+
+
+_intermediates = None
+
+
+def intermediates(time, magnitude, error):
+    """The intermediate results of the light curve. Only the last light
+    curve is keeped, because all the extractors process the same light
+    curve before continue with the next one.
+
+    """
+    global _intermediates
+
+    hasher = hashlib.md5()
+    for arr in (time, magnitude, error):
+        arr = np.ascontiguousarray(arr, dtype=float)
+        hasher.update(str(len(arr)))
+        hasher.update(arr.data)
+    key = hasher.hexdigest()
+
+    if _intermediates is None or _intermediates.key != key:
+        _intermediates = Intermediates(
+            time=np.asarray(time, dtype=float),
+            magnitude=np.asarray(magnitude, dtype=float),
+            error=np.asarray(error, dtype=float), key=key)
+    return _intermediates
+
+
+def seed(time, magnitude, error, lscargle_kwds, frequency):
+    """Seed the best frequency of the light curve (see
+    `Intermediates.seed`)
+
+    """
+    lc = intermediates(time, magnitude, error)
+    lc.seed(lscargle_kwds, frequency)
+    return lc
+
+
 # =============================================================================
 # EXTRACTOR CLASS
 # =============================================================================
@@ -54,24 +342,20 @@ class LombScargleWithError(Extractor):
     data = ['magnitude', 'time', 'error']
     features = ["PeriodLS", "Period_fit", "Psi_CS", "Psi_eta"]
     params = {
-        "lscargle_kwds": {
-            "autopower_kwds": {
-                "normalization": "standard",
-                "maximum_frequency": 10.,
-                "minimum_frequency": 1./200}},
-        "fap_kwds": {
-            "normalization": "standard",
-            "method": "simple"}}
-
-    def _compute_ls(self, magnitude, time, error, lscargle_kwds):
-        frequency, power, fmax = lscargle_error(
-            time=time, magnitude=magnitude, error=error, **lscargle_kwds)
-        best_period = 1 / frequency[fmax]
-        return frequency, power, fmax, best_period
-
-    def _compute_fap(self, power, fmax, time, magnitude, error, fap_kwds):
+        "lscargle_kwds": LSCARGLE_KWDS,
+        "batch": False,
+        "fap_kwds": FAP_KWDS}
+
+    def _compute_ls(self, magnitude, time, error, lscargle_kwds, batch):
+        frequency, max_power, fmax = intermediates(
+            time, magnitude, error).best(lscargle_kwds, batch)
+        best_period = 1 / frequency
+        return max_power, fmax, best_period
+
+    def _compute_fap(self, max_power, fmax, time, magnitude, error,
+                     fap_kwds):
         return fap_error(
-            max_power=np.max(power), fmax=fmax, time=time,
+            max_power=max_power, fmax=fmax, time=time,
             magnitude=magnitude, error=error, **fap_kwds)
 
     def _compute_cs(self, folded_data, N):
@@ -87,21 +371,20 @@ class LombScargleWithError(Extractor):
                    np.sum(np.power(folded_data[1:] - folded_data[:-1], 2)))
         return Psi_eta
 
-    def fit(self, magnitude, time, error, lscargle_kwds, fap_kwds):
-        # first we retrieve the frequencies, power,
-        # max frequency and best_period
-        frequency, power, fmax, best_period = self._compute_ls(
+    def fit(self, magnitude, time, error, lscargle_kwds, batch, fap_kwds):
+        # first we retrieve the max power, max frequency and best_period
+        max_power, fmax, best_period = self._compute_ls(
             magnitude=magnitude, time=time, error=error,
-            lscargle_kwds=lscargle_kwds)
+            lscargle_kwds=lscargle_kwds, batch=batch)
 
         # false alarm probability
         fap = self._compute_fap(
-            power=power, fmax=fmax, time=time,
+            max_power=max_power, fmax=fmax, time=time,
             magnitude=magnitude, error=error, fap_kwds=fap_kwds)
 
         # fold the data
-        new_time = np.mod(time, 2 * best_period) / (2 * best_period)
-        folded_data = magnitude[np.argsort(new_time)]
+        folded_data = intermediates(
+            time, magnitude, error).folded(lscargle_kwds, batch)
         N = len(folded_data)
 
         # CS and Psi_eta
@@ -145,45 +428,37 @@ class FourierComponentsWithError(Extractor):
                 'Freq3_harmonics_rel_phase_2',
                 'Freq3_harmonics_rel_phase_3']
     params = {
-        "lscargle_kwds": {
-            "autopower_kwds": {
-                "normalization": "standard",
-                "maximum_frequency": 10.,
-                "minimum_frequency": 1./200}}
+        "lscargle_kwds": LSCARGLE_KWDS,
+        "batch": False,
+        "weighted": False
     }
 
-    def _model(self, x, a, b, c, Freq):
-        return (a * np.sin(2 * np.pi * Freq * x) +
-                b * np.cos(2 * np.pi * Freq * x) + c)
-
-    def _yfunc_maker(self, Freq):
-        def func(x, a, b, c):
-            return (a * np.sin(2 * np.pi * Freq * x) +
-                    b * np.cos(2 * np.pi * Freq * x) + c)
-        return func
-
-    def _components(self, magnitude, time, error, lscargle_kwds):
-        time = time - np.min(time)
+    def _components(self, magnitude, time, error, lscargle_kwds, batch,
+                    weighted):
+        # the first periodogram is the same of the LombScargleWithError
+        lc = intermediates(time, magnitude, error)
+        time = lc.shifted_time
         A, PH = [], []
         for i in range(3):
-            frequency, power, fmax = lscargle_error(
-                time=time, magnitude=magnitude, error=error, **lscargle_kwds)
+            if i == 0:
+                fundamental_Freq = lc.best_frequency(lscargle_kwds, batch)
+            else:
+                frequency, power, fmax = lc.lscargle(
+                    lscargle_kwds, magnitude=magnitude)
+                fundamental_Freq = frequency[np.argmax(power)]
 
-            fundamental_Freq = frequency[fmax]
             Atemp, PHtemp = [], []
             omagnitude = magnitude
 
             for j in range(4):
-                function_to_fit = self._yfunc_maker((j + 1) * fundamental_Freq)
-                popt0, popt1, popt2 = curve_fit(
-                    function_to_fit, time, omagnitude)[0][:3]
+                # the model is linear for a fixed frequency
+                (popt0, popt1, popt2), model = harmonic_fit(
+                    time, omagnitude, (j + 1) * fundamental_Freq,
+                    error=error if weighted else None)
 
                 Atemp.append(np.sqrt(popt0 ** 2 + popt1 ** 2))
                 PHtemp.append(np.arctan(popt1 / popt0))
 
-                model = self._model(
-                    time, popt0, popt1, popt2,
-                    (j + 1) * fundamental_Freq)
                 magnitude = np.array(magnitude) - model
 
             A.append(Atemp)
@@ -194,12 +469,12 @@ class FourierComponentsWithError(Extractor):
 
         return A, scaledPH
 
-    def fit(self, magnitude, time, error, lscargle_kwds):
+    def fit(self, magnitude, time, error, lscargle_kwds, batch, weighted):
         lscargle_kwds = lscargle_kwds or {}
 
         A, sPH = self._components(
             magnitude=magnitude, time=time, error=error,
-            lscargle_kwds=lscargle_kwds)
+            lscargle_kwds=lscargle_kwds, batch=batch, weighted=weighted)
         result = {
             "Freq1_harmonics_amplitude_0": A[0][0],
             "Freq1_harmonics_amplitude_1": A[0][1],
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Compressed sparse row (CSR) index of the light curves observations.
+
+The observations of a tile are stored sorted by source and by time inside
+every source, so all the observations of a source are a contiguous range
+of rows. The index is a small array with one row per source with the
+``id`` of the source, the ``start`` row and the ``cnt`` of observations;
+and a source can be sliced with a binary search instead of a full scan
+of the observations.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import numpy as np
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+INDEX_DTYPE = [("id", np.int64), ("start", np.int64), ("cnt", np.int64)]
+
+SOURCE_ID = "bm_src_id"
+
+TIME = "pwp_stack_src_hjd"
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def sort_order(arr, source_id=SOURCE_ID, time=TIME):
+    """Order of the rows sorted by source and by time"""
+    return np.lexsort((arr[time], arr[source_id]))
+
+
+def is_sorted(arr, source_id=SOURCE_ID, time=TIME):
+    """True if the rows are sorted by source and by time"""
+    ids, times = arr[source_id], arr[time]
+    if len(ids) < 2:
+        return True
+    same = ids[1:] == ids[:-1]
+    return bool(
+        np.all(ids[1:] >= ids[:-1]) and
+        np.all(times[1:][same] >= times[:-1][same]))
+
+
+def build(ids):
+    """Create the index from the (sorted) ids of the observations"""
+    uids, starts, cnts = np.unique(ids, return_index=True, return_counts=True)
+    index = np.empty(len(uids), dtype=INDEX_DTYPE)
+    index["id"] = uids
+    index["start"] = starts
+    index["cnt"] = cnts
+    return index
+
+
+def source_slice(index, src_id):
+    """Slice of the observations of the source (empty if the source has
+    no observations)
+
+    """
+    pos = np.searchsorted(index["id"], src_id)
+    if pos >= len(index) or index["id"][pos] != src_id:
+        return slice(0, 0)
+    start = int(index["start"][pos])
+    return slice(start, start + int(index["cnt"][pos]))
+
+
+def chunk(index, first_id, last_id):
+    """Contiguous rows of the observations of all the sources with ids
+    between ``first_id`` and ``last_id`` (inclusive).
+
+    Returns
+    -------
+
+    rows : slice
+        The rows of the sources.
+    index : np.ndarray
+        The index of the sources relative to the ``rows``.
+
+    """
+    lo = np.searchsorted(index["id"], first_id, side="left")
+    hi = np.searchsorted(index["id"], last_id, side="right")
+    sub = np.array(index[lo:hi])
+    if not len(sub):
+        return slice(0, 0), sub
+    offset = int(sub["start"][0])
+    stop = int(sub["start"][-1] + sub["cnt"][-1])
+    sub["start"] -= offset
+    return slice(offset, stop), sub
+
+
+def merge(indexes):
+    """Index of the observations of many indexed parts merged by source
+    (the ``cnt`` of every source is the sum of their ``cnt`` in all the
+    parts)
+
+    """
+    ids = np.concatenate([index["id"] for index in indexes])
+    cnts = np.concatenate([index["cnt"] for index in indexes])
+    uids, inverse = np.unique(ids, return_inverse=True)
+
+    index = np.empty(len(uids), dtype=INDEX_DTYPE)
+    index["id"] = uids
+    index["cnt"] = np.bincount(inverse, weights=cnts, minlength=len(uids))
+    index["start"] = np.cumsum(index["cnt"]) - index["cnt"]
+    return index
+
+
+def blocks(index, max_rows):
+    """Split the sources of the index in consecutive blocks with at most
+    ``max_rows`` observations (or only one source with more observations).
+
+    Yields the ``(first_id, last_id)`` of every block (see `chunk`).
+
+    """
+    ends = np.cumsum(index["cnt"])
+    first = 0
+    while first < len(index):
+        limit = ends[first] - index["cnt"][first] + max_rows
+        last = max(np.searchsorted(ends, limit, side="right") - 1, first)
+        yield index["id"][first], index["id"][last]
+        first = last + 1
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Compact schema of the light curves observations.
+
+Every observation is stored in 20 bytes instead of the 48 bytes of the
+full layout:
+
+- ``pwp_idx``: row of the pawprint stack in the pawprints table of the
+  light curves (the ``pwp_id`` and the ``hjd_base`` of every pawprint).
+- ``pwp_row``: row of the source inside the pawprint stack.
+- ``hjd_offset``: the hjd minus the ``hjd_base`` (the midpoint of the hjd)
+  of the pawprint, as float32 only if every hjd is rebuilded exactly from
+  it (the spread of the hjd of a pawprint is small). Otherwise as float64
+  (28 bytes by observation).
+- ``mag`` and ``mag_err``: as float32.
+
+The ``bm_src_id`` is taken from the CSR index of the observations and the
+``pwp_stack_src_id`` is rebuilded from the pawprint stack id and the row
+(see `carpyncho.steps.read_pawprint_stack`). The files stored with the full
+layout are readed as is.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import numpy as np
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+OBS_DTYPE = [
+    ("bm_src_id", np.int64),
+    ("pwp_id", np.int64),
+    ("pwp_stack_src_id", np.int64),
+    ("pwp_stack_src_hjd", float),
+    ("pwp_stack_src_mag3", float),
+    ("pwp_stack_src_mag_err3", float)]
+
+COMPACT_DTYPE = [
+    ("pwp_idx", np.int32),
+    ("pwp_row", np.int32),
+    ("hjd_offset", np.float32),
+    ("mag", np.float32),
+    ("mag_err", np.float32)]
+
+COMPACT_HJD64_DTYPE = [
+    ("pwp_idx", np.int32),
+    ("pwp_row", np.int32),
+    ("hjd_offset", float),
+    ("mag", np.float32),
+    ("mag_err", np.float32)]
+
+PAWPRINTS_DTYPE = [("pwp_id", np.int64), ("hjd_base", float)]
+
+PWP_SRC_PREFIX = 3 * 10 ** 15
+
+PWP_SRC_FACTOR = 10 ** 8
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def is_compact(arr):
+    return "pwp_idx" in arr.dtype.names
+
+
+def pwp_src_id(pwp_id, pwp_row):
+    """Id of the source of the row ``pwp_row`` of the pawprint stack"""
+    pwp_id = np.asarray(pwp_id, dtype=np.int64)
+    return PWP_SRC_PREFIX + pwp_id * PWP_SRC_FACTOR + pwp_row + 1
+
+
+def pwp_src_row(pwp_src_id):
+    """Row of the source inside their pawprint stack"""
+    return np.asarray(pwp_src_id, dtype=np.int64) % PWP_SRC_FACTOR - 1
+
+
+def hjd_base(hjd):
+    """Epoch base of a pawprint stack: the midpoint of their hjd, so the
+    offsets are as small as possible
+
+    """
+    return (np.min(hjd) + np.max(hjd)) / 2. if len(hjd) else 0.
+
+
+def exact_offsets(hjd, hjd_base):
+    """True if every hjd is rebuilded exactly from their float32 offset to
+    the ``hjd_base``
+
+    """
+    offsets = (np.asarray(hjd) - hjd_base).astype(np.float32)
+    return bool(np.all(hjd_base + offsets.astype(float) == hjd))
+
+
+def compact_dtype(exact):
+    """The compact dtype with float32 offsets if they are ``exact`` or with
+    float64 offsets if not
+
+    """
+    return COMPACT_DTYPE if exact else COMPACT_HJD64_DTYPE
+
+
+def encode_rows(pwp_idx, pwp_row, hjd, hjd_base, mag, mag_err,
+                dtype=COMPACT_DTYPE):
+    """Create the compact rows of the observations of one or more pawprint
+    stacks (``hjd_base`` must be the base of every row)
+
+    """
+    arr = np.empty(len(pwp_row), dtype=dtype)
+    arr["pwp_idx"] = pwp_idx
+    arr["pwp_row"] = pwp_row
+    arr["hjd_offset"] = hjd - hjd_base
+    arr["mag"] = mag
+    arr["mag_err"] = mag_err
+    return arr
+
+
+def pawprints_of(blocks):
+    """Create the pawprints table of observations with the full layout,
+    given as an iterable of blocks (only the ``pwp_id``,
+    ``pwp_stack_src_id`` and ``pwp_stack_src_hjd`` columns are used). The
+    hjd base of every pawprint is computed over all the blocks.
+
+    Returns None if the ids of the pawprints sources can't be rebuilded.
+
+    """
+    pwp_ids, lower, upper = [], [], []
+    for obs in blocks:
+        ids, idx = np.unique(obs["pwp_id"], return_inverse=True)
+        pwp_row = pwp_src_row(obs["pwp_stack_src_id"])
+        if np.any(pwp_src_id(ids[idx], pwp_row) != obs["pwp_stack_src_id"]):
+            return None
+        hjd = obs["pwp_stack_src_hjd"]
+        lower.append(np.full(len(ids), np.inf))
+        upper.append(np.full(len(ids), -np.inf))
+        np.minimum.at(lower[-1], idx, hjd)
+        np.maximum.at(upper[-1], idx, hjd)
+        pwp_ids.append(ids)
+
+    if not pwp_ids:
+        return np.empty(0, dtype=PAWPRINTS_DTYPE)
+    ids, idx = np.unique(np.concatenate(pwp_ids), return_inverse=True)
+    lo, hi = np.full(len(ids), np.inf), np.full(len(ids), -np.inf)
+    np.minimum.at(lo, idx, np.concatenate(lower))
+    np.maximum.at(hi, idx, np.concatenate(upper))
+
+    pawprints = np.empty(len(ids), dtype=PAWPRINTS_DTYPE)
+    pawprints["pwp_id"] = ids
+    pawprints["hjd_base"] = (lo + hi) / 2.
+    return pawprints
+
+
+def hjd_bases(pawprints, pwp_id):
+    """The hjd base of the pawprint of every observation"""
+    return pawprints["hjd_base"][
+        np.searchsorted(pawprints["pwp_id"], pwp_id)]
+
+
+def encode_with(obs, pawprints, dtype=COMPACT_DTYPE):
+    """Convert the observations with the full layout into the compact
+    schema, with an already created pawprints table (see `pawprints_of`)
+
+    """
+    pwp_idx = np.searchsorted(pawprints["pwp_id"], obs["pwp_id"])
+    return encode_rows(
+        pwp_idx=pwp_idx, pwp_row=pwp_src_row(obs["pwp_stack_src_id"]),
+        hjd=obs["pwp_stack_src_hjd"],
+        hjd_base=pawprints["hjd_base"][pwp_idx],
+        mag=obs["pwp_stack_src_mag3"], mag_err=obs["pwp_stack_src_mag_err3"],
+        dtype=dtype)
+
+
+def encode(obs):
+    """Convert the observations with the full layout into the compact
+    schema.
+
+    Returns
+    -------
+
+    arr : np.ndarray or None
+        The compact observations (with float64 hjd offsets if the float32
+        ones are not exact) or None if the ids of the pawprints sources
+        can't be rebuilded.
+    pawprints : np.ndarray or None
+        The pawprints table.
+
+    """
+    pawprints = pawprints_of([obs])
+    if pawprints is None:
+        return None, None
+
+    hjd = obs["pwp_stack_src_hjd"]
+    exact = exact_offsets(hjd, hjd_bases(pawprints, obs["pwp_id"]))
+    arr = encode_with(obs, pawprints, compact_dtype(exact))
+    return arr, pawprints
+
+
+def full_layout(obs):
+    """Copy of the observations with exactly the full layout"""
+    arr = np.empty(len(obs), dtype=OBS_DTYPE)
+    for name, _ in OBS_DTYPE:
+        arr[name] = obs[name]
+    return arr
+
+
+def row_source_ids(index, rows):
+    """Id of the source of every row (a slice or an array of rows) of the
+    observations, from their CSR index
+
+    """
+    if isinstance(rows, slice):
+        rows = np.arange(*rows.indices(int(index["cnt"].sum())))
+    owners = np.searchsorted(index["start"], rows, side="right") - 1
+    return index["id"][owners]
+
+
+def decode(arr, pawprints, src_ids, columns=None):
+    """Convert compact observations into the full layout (or only the given
+    columns of the full layout)
+
+    """
+    names = [n for n, _ in OBS_DTYPE]
+    if isinstance(columns, basestring):
+        single, names = True, [columns]
+    else:
+        single, names = False, names if columns is None else list(columns)
+
+    pwp_idx = arr["pwp_idx"]
+    decoders = {
+        "bm_src_id": lambda: src_ids,
+        "pwp_id": lambda: pawprints["pwp_id"][pwp_idx],
+        "pwp_stack_src_id": lambda: pwp_src_id(
+            pawprints["pwp_id"][pwp_idx], arr["pwp_row"]),
+        "pwp_stack_src_hjd": lambda: (
+            pawprints["hjd_base"][pwp_idx] + arr["hjd_offset"]),
+        "pwp_stack_src_mag3": lambda: arr["mag"],
+        "pwp_stack_src_mag_err3": lambda: arr["mag_err"]}
+
+    dtype = dict(OBS_DTYPE)
+    if single:
+        return np.asarray(decoders[names[0]](), dtype=dtype[names[0]])
+
+    obs = np.empty(len(arr), dtype=[(n, dtype[n]) for n in names])
+    for name in names:
+        obs[name] = decoders[name]()
+    return obs
+
+
+def read_rows(arr, pawprints, index, rows, columns=None):
+    """Read the given rows (a slice or an array of indexes) of the stored
+    observations (with the compact or the full layout) in the full layout.
+    Only the rows are decoded.
+
+    """
+    part = arr[rows]
+    if not is_compact(part):
+        return np.array(part if columns is None else part[columns])
+    return decode(part, pawprints, row_source_ids(index, rows), columns)
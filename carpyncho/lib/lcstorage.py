@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Storage backends of the light curves arrays.
+
+Every backend stores one numpy record array per file and knows how to
+read all the array, a range of rows or a set of rows, optionally only with
+some columns.
+
+- ``npy``: the plain numpy format; read memory mapped.
+- ``hdf5``: a chunked and compressed pytables Table.
+- ``columns``: a directory with one npy file per column; only the
+  requested columns are readed (memory mapped) and new columns can be
+  added without rewrite the others. The min/max of every column of every
+  row group are stored too (see `carpyncho.lib.zonemap`), so the filters
+  only read the groups that can match.
+
+The backend of an existing file is detected by their extension, so the
+files stored with different backends can coexist.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+import pandas as pd
+
+import tables
+
+from . import zonemap as zmap
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+DEFAULT = "npy"
+
+
+# =============================================================================
+# BACKENDS
+# =============================================================================
+
+class NpyStorage(object):
+    """Plain npy files, the readed arrays are memory mapped"""
+
+    extension = ".npy"
+    mmap = True
+
+    def save(self, path, arr):
+        # the old file is replaced only when the new one is complete, so
+        # the arrays already memory mapped remains valid
+        tmp_path = path[:-len(self.extension)] + "_tmp" + self.extension
+        np.save(tmp_path, arr)
+        os.rename(tmp_path, path)
+
+    def dtype(self, path):
+        return np.load(path, mmap_mode="r").dtype
+
+    def load(self, path, columns=None):
+        arr = np.load(path, mmap_mode="r")
+        return arr if columns is None else arr[columns]
+
+    def read(self, path, start, stop, columns=None):
+        return np.array(self.load(path, columns)[start:stop])
+
+    def take(self, path, rows, columns=None):
+        return np.array(self.load(path, columns)[rows])
+
+
+class HDF5Storage(object):
+    """Chunked and compressed pytables Table.
+
+    Parameters
+    ----------
+
+    complib : str
+        Compression library (see tables.Filters).
+    complevel : int
+        Compression level from 0 (no compression) to 9.
+    chunk_rows : int or None
+        Rows of every chunk. None means that pytables choose it from the
+        number of rows.
+
+    """
+
+    extension = ".h5"
+    mmap = False
+    node = "data"
+
+    def __init__(self, complib="blosc", complevel=5, chunk_rows=None):
+        self.complib = complib
+        self.complevel = complevel
+        self.chunk_rows = chunk_rows
+
+    def save(self, path, arr):
+        filters = tables.Filters(
+            complevel=self.complevel, complib=self.complib, shuffle=True)
+        chunkshape = (self.chunk_rows,) if self.chunk_rows else None
+
+        tmp_path = path[:-len(self.extension)] + "_tmp" + self.extension
+        with tables.open_file(tmp_path, mode="w") as h5:
+            h5.create_table(
+                "/", self.node, obj=arr, filters=filters,
+                expectedrows=len(arr), chunkshape=chunkshape)
+        os.rename(tmp_path, path)
+
+    def _read(self, path, columns, **kwargs):
+        with tables.open_file(path, mode="r") as h5:
+            table = h5.get_node("/", self.node)
+            method = table.read_coordinates if "coords" in kwargs else (
+                table.read)
+
+            if columns is None:
+                return method(**kwargs)
+            elif isinstance(columns, basestring):
+                return method(field=columns, **kwargs)
+
+            # pytables only read one field at time
+            dtype = [(name, table.coldtypes[name]) for name in columns]
+            fields = [(name, method(field=name, **kwargs)) for name in columns]
+            arr = np.empty(len(fields[0][1]), dtype=dtype)
+            for name, values in fields:
+                arr[name] = values
+            return arr
+
+    def dtype(self, path):
+        with tables.open_file(path, mode="r") as h5:
+            return h5.get_node("/", self.node).dtype
+
+    def load(self, path, columns=None):
+        return self._read(path, columns)
+
+    def read(self, path, start, stop, columns=None):
+        return self._read(path, columns, start=start, stop=stop)
+
+    def take(self, path, rows, columns=None):
+        return self._read(path, columns, coords=np.asarray(rows))
+
+
+class ColumnarStorage(object):
+    """A directory with one npy file per column (all with the same row
+    order) and the dtype of the array. Only the requested columns are
+    readed and are memory mapped.
+
+    """
+
+    extension = ".cols"
+    mmap = False
+    dtype_file = "_dtype.npy"
+    zonemap_file = "_zonemap.npy"
+
+    def __init__(self, row_group_size=zmap.ROW_GROUP_SIZE):
+        self.row_group_size = row_group_size
+
+    def _column_path(self, path, name):
+        return os.path.join(path, name + ".npy")
+
+    def save(self, path, arr):
+        tmp_path = path[:-len(self.extension)] + "_tmp" + self.extension
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in arr.dtype.names:
+            np.save(self._column_path(tmp_path, name), arr[name])
+        np.save(
+            os.path.join(tmp_path, self.dtype_file),
+            np.empty(0, dtype=arr.dtype))
+        np.save(
+            os.path.join(tmp_path, self.zonemap_file),
+            zmap.build(arr, self.row_group_size))
+
+        # a directory can't be replaced in one step, but the columns
+        # already memory mapped remains valid after the old one is removed
+        old_path = path[:-len(self.extension)] + "_old" + self.extension
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+    def dtype(self, path):
+        return np.load(os.path.join(path, self.dtype_file)).dtype
+
+    def zonemap(self, path):
+        """The min/max of every numeric column of every row group (is
+        created if the directory was stored without it)
+
+        """
+        zonemap_path = os.path.join(path, self.zonemap_file)
+        if not os.path.exists(zonemap_path):
+            NpyStorage().save(
+                zonemap_path, zmap.build(self.load(path), self.row_group_size))
+        return np.load(zonemap_path)
+
+    def column(self, path, name):
+        """The memory mapped values of one column"""
+        return np.load(self._column_path(path, name), mmap_mode="r")
+
+    def columns(self, path, columns=None, rows=slice(None)):
+        """The given rows of every column (the columns as a slice are
+        memory mapped)
+
+        """
+        names = self.dtype(path).names if columns is None else columns
+        return OrderedDict(
+            (name, self.column(path, name)[rows]) for name in names)
+
+    def _read(self, path, columns, rows):
+        if isinstance(columns, basestring):
+            return np.array(self.column(path, columns)[rows])
+
+        dtype = self.dtype(path)
+        values = self.columns(path, columns, rows)
+        arr = np.empty(
+            len(values.values()[0]) if values else 0,
+            dtype=[(name, dtype[name]) for name in values])
+        for name, column in values.items():
+            arr[name] = column
+        return arr
+
+    def load(self, path, columns=None):
+        return self._read(path, columns, slice(None))
+
+    def read(self, path, start, stop, columns=None):
+        return self._read(path, columns, slice(start, stop))
+
+    def take(self, path, rows, columns=None):
+        return self._read(path, columns, np.asarray(rows))
+
+    def add_column(self, path, name, values):
+        """Add (or replace) one column without rewrite the others"""
+        dtype = self.dtype(path)
+        size = len(self.column(path, dtype.names[0]))
+        values = np.asarray(values)
+        if len(values) != size:
+            raise ValueError(
+                "The column '{}' has {} rows but the array has {}".format(
+                    name, len(values), size))
+
+        zonemap = zmap.add(self.zonemap(path), name, values)
+        NpyStorage().save(self._column_path(path, name), values)
+        NpyStorage().save(os.path.join(path, self.zonemap_file), zonemap)
+        if name not in dtype.names:
+            dtype = np.dtype(dtype.descr + [(name, values.dtype)])
+            NpyStorage().save(
+                os.path.join(path, self.dtype_file),
+                np.empty(0, dtype=dtype))
+
+
+STORAGES = {
+    "npy": NpyStorage,
+    "hdf5": HDF5Storage,
+    "columns": ColumnarStorage}
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def get_storage(name=DEFAULT, **kwargs):
+    """Create the storage backend with the given name"""
+    if name not in STORAGES:
+        raise ValueError("Unknown storage '{}'. Options: {}".format(
+            name, ", ".join(sorted(STORAGES))))
+    return STORAGES[name](**kwargs)
+
+
+def find(base_path, prefer=None):
+    """Retrieve the (path, storage) of the file ``base_path`` + the extension
+    of any storage. If exists more than one ``prefer`` is used first.
+
+    """
+    storages = [cls() for cls in STORAGES.values()]
+    if prefer is not None:
+        storages.insert(0, prefer)
+    for storage in storages:
+        path = base_path + storage.extension
+        if os.path.exists(path):
+            return path, storage
+    return None, None
+
+
+def _remove_others(base_path, path):
+    for cls in STORAGES.values():
+        other = base_path + cls.extension
+        if other == path or not os.path.exists(other):
+            continue
+        elif os.path.isdir(other):
+            shutil.rmtree(other)
+        else:
+            os.remove(other)
+
+
+def save(base_path, arr, storage):
+    """Store the array in ``base_path`` with the extension of the storage
+    and remove the files of the same array stored with other backends
+
+    """
+    path = base_path + storage.extension
+    storage.save(path, arr)
+    _remove_others(base_path, path)
+    return path
+
+
+def save_file(base_path, npy_path, storage):
+    """Like `save` but with an array already written in the npy file
+    ``npy_path``; that is moved (or converted) into the storage
+
+    """
+    path = base_path + storage.extension
+    if isinstance(storage, NpyStorage):
+        os.rename(npy_path, path)
+    else:
+        storage.save(path, np.load(npy_path, mmap_mode="r"))
+        os.remove(npy_path)
+    _remove_others(base_path, path)
+    return path
+
+
+def size(path):
+    """Bytes of the stored file (or of all the files of the directory)"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(path, fname))
+        for fname in os.listdir(path))
+
+
+def where(path, storage, predicates):
+    """Sorted numbers of the rows that satisfy all the predicates (see
+    `carpyncho.lib.zonemap`). Only the columns of the predicates are
+    readed, and with the ``columns`` storage only the row groups that
+    can match.
+
+    """
+    names = zmap.columns_of(predicates)
+    if not names:
+        return np.arange(len(storage.load(path, storage.dtype(path).names[0])))
+    elif not isinstance(storage, ColumnarStorage):
+        data = storage.load(path, names)
+        return np.flatnonzero(zmap.evaluate(data, predicates))
+
+    rows = [np.empty(0, dtype=np.int64)]
+    for start, stop in zmap.ranges(storage.zonemap(path), predicates):
+        data = storage.columns(path, names, slice(start, stop))
+        rows.append(start + np.flatnonzero(zmap.evaluate(data, predicates)))
+    return np.concatenate(rows)
+
+
+def load_frame(path, storage, columns=None, rows=None):
+    """Read the array (or only the given columns and rows) as a
+    pandas.DataFrame indexed by the row numbers. With the ``columns``
+    storage the DataFrame is created directly from the memory mapped
+    columns.
+
+    """
+    if isinstance(columns, basestring):
+        columns = [columns]
+    if rows is None:
+        rows = slice(None)
+    elif not isinstance(rows, slice):
+        rows = np.asarray(rows)
+
+    if isinstance(storage, ColumnarStorage):
+        data = storage.columns(path, columns, rows)
+        size = len(data.values()[0]) if data else 0
+    elif isinstance(rows, slice):
+        data = storage.load(path, columns)[rows]
+        size = len(data)
+    else:
+        data = storage.take(path, rows, columns)
+        size = len(data)
+
+    if isinstance(rows, slice):
+        index = np.arange(rows.start or 0, (rows.start or 0) + size)
+    else:
+        index = rows
+    return pd.DataFrame(data, index=index, columns=columns)
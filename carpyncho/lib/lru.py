@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Least recently used cache of numpy arrays limited by memory.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+from collections import OrderedDict
+
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+class LRUCache(object):
+    """Dict-like cache that forget the least recently used arrays when the
+    total of bytes of the stored arrays exceeds ``max_bytes``.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __repr__(self):
+        return "<LRUCache {} items, {}/{} bytes>".format(
+            len(self._data), self.nbytes, self.max_bytes)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        if key in self._data:
+            self.nbytes -= self._data.pop(key).nbytes
+
+        # an array bigger than the cache is never stored
+        if value.nbytes > self.max_bytes:
+            return value
+
+        self._data[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self._data.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
@@ -1,11 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Mutual nearest neighbour cross-match between two sky catalogs.
+
+Every coordinate is projected into a 3D unit vector and indexed with a
+KD-tree, so the angular distance criteria ``sep <= eps`` becomes the
+euclidean criteria ``chord <= 2 * sin(eps / 2)``.
+
+Unlike the ``match_coords`` of astropysics (that uses the flat distance
+over ra and dec) the separation is the true angular distance, so the
+matched pairs are not the same: the flat distance overestimates the
+separation in ra by a factor ``1 / cos(dec)``.
+
+"""
+
+
 # =============================================================================
 # IMPORTS
 # =============================================================================
 
-from astropysics import coords
+import numpy as np
+
+from scipy.spatial import cKDTree
 
 
 # =============================================================================
@@ -16,17 +36,155 @@ MAX_MATCH = 3 * 9.2592592592592588e-5
 
 MODE = "nearest"
 
+#: Distance between the catalogs in the extra dimension used by
+#: batch_matchs (must be greater than 2, the max distance between two unit
+#: vectors)
+LABEL_SEPARATION = 3.
+
 
 # =============================================================================
-# MANAGERS
+# FUNCTIONS
 # =============================================================================
 
-def matchs(ra0, ra1, dec0, dec1, eps=MAX_MATCH, mode=MODE):
-    nearestind1, _, match1 = coords.match_coords(
-        ra0, dec0, ra1, dec1, eps=eps, mode=mode)
-    nearestind0, _, match0 = coords.match_coords(
-        ra1, dec1, ra0, dec0, eps=eps, mode=mode)
+def to_xyz(ra, dec):
+    """Convert ra and dec (in degrees) into an array of (N, 3) unit
+    vectors
+
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack(
+        (cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
+def chord(eps):
+    """Convert an angular distance in degrees into the euclidean distance
+    between two unit vectors with that separation
+
+    """
+    return 2 * np.sin(np.radians(eps) / 2.)
+
+
+def build_tree(ra, dec):
+    """Create a KD-tree over the unit vectors of the given coordinates"""
+    return cKDTree(to_xyz(ra, dec))
+
+
+def nearest(tree, ra, dec, eps=MAX_MATCH, n_jobs=1):
+    """Retrieve for every coordinate the index of the nearest point of the
+    tree inside ``eps`` degrees.
+
+    The coordinates without any neighbour inside ``eps`` has the index
+    ``tree.n``.
+
+    """
+    _, idxs = tree.query(
+        to_xyz(ra, dec), k=1, distance_upper_bound=chord(eps),
+        n_jobs=n_jobs)
+    return idxs
+
+
+def matchs(ra0, ra1, dec0, dec1, eps=MAX_MATCH, mode=MODE,
+           tree0=None, tree1=None, n_jobs=1):
+    """Match two catalogs keeping only the mutual nearest pairs with
+    a separation lesser than ``eps`` degrees.
+
+    Parameters
+    ----------
+
+    ra0, dec0 : array-like
+        Coordinates in degrees of the first catalog.
+    ra1, dec1 : array-like
+        Coordinates in degrees of the second catalog.
+    eps : float
+        Maximum separation in degrees.
+    mode : str
+        Only "nearest" is supported.
+    tree0, tree1 : scipy.spatial.cKDTree or None
+        Already builded trees (see `build_tree`) of the catalogs. If is
+        None the tree is created.
+    n_jobs : int
+        Number of processes used to query the trees (-1 means all).
+
+    Returns
+    -------
+
+    idx0, idx1 : np.ndarray
+        Index arrays of the matched pairs, ``(ra0[idx0[i]], dec0[idx0[i]])``
+        match with ``(ra1[idx1[i]], dec1[idx1[i]])``. The pairs are sorted
+        by ``idx1``.
+
+    """
+    if mode != MODE:
+        raise ValueError("Unsuported mode '{}'".format(mode))
+
+    if not (len(ra0) and len(ra1)):
+        empty = np.array([], dtype=int)
+        return empty, empty
+
+    tree0 = build_tree(ra0, dec0) if tree0 is None else tree0
+    tree1 = build_tree(ra1, dec1) if tree1 is None else tree1
+
+    # nearest1[i] is the nearest source of the catalog 1 for ra0[i]
+    nearest1 = nearest(tree1, ra0, dec0, eps=eps, n_jobs=n_jobs)
+    nearest0 = nearest(tree0, ra1, dec1, eps=eps, n_jobs=n_jobs)
+
+    # only the sources of catalog 1 with a neighbour can be matched
+    idx1 = np.where(nearest0 < tree0.n)[0]
+    idx0 = nearest0[idx1]
+
+    # and only if the neighbour points back
+    mutual = nearest1[idx0] == idx1
+    return idx0[mutual], idx1[mutual]
+
+
+def batch_matchs(ra0, ra1, dec0, dec1, labels, eps=MAX_MATCH,
+                 tree0=None, n_jobs=1):
+    """Match one catalog against many catalogs in a single pass.
+
+    The catalogs 1 are concatenated in ``ra1`` and ``dec1`` and ``labels``
+    indicates (with an integer) to which catalog belongs every source. The
+    result is the same as call `matchs` for every catalog 1, but with only
+    two vectorized queries.
+
+    To find the nearest source of the same catalog 1, the unit vectors are
+    extended with a fourth coordinate ``label * LABEL_SEPARATION``; so the
+    distance between sources of different catalogs are always bigger than
+    any match.
+
+    Returns
+    -------
+
+    idx0, idx1 : np.ndarray
+        Index arrays of the matched pairs (``idx1`` is over the
+        concatenated catalogs) sorted by ``idx1``.
+
+    """
+    if not (len(ra0) and len(ra1)):
+        empty = np.array([], dtype=int)
+        return empty, empty
+
+    tree0 = build_tree(ra0, dec0) if tree0 is None else tree0
+    labels = np.asarray(labels)
+
+    # the nearest source of the catalog 0 for every source of the catalogs 1
+    nearest0 = nearest(tree0, ra1, dec1, eps=eps, n_jobs=n_jobs)
+    idx1 = np.where(nearest0 < tree0.n)[0]
+    idx0 = nearest0[idx1]
+
+    # a tree with all the catalogs 1 separated by the extra dimension (the
+    # median split degrades with the few distinct values of the labels, so
+    # the sliding midpoint rule is used)
+    tree1 = cKDTree(
+        np.column_stack((to_xyz(ra1, dec1), labels * LABEL_SEPARATION)),
+        balanced_tree=False)
+
+    # now we query only the candidates in their own catalog
+    candidates = np.column_stack((
+        to_xyz(np.take(ra0, idx0), np.take(dec0, idx0)),
+        labels[idx1] * LABEL_SEPARATION))
+    _, nearest1 = tree1.query(
+        candidates, k=1, distance_upper_bound=chord(eps), n_jobs=n_jobs)
 
-    for idx1, idx0 in enumerate(nearestind0):
-        if match0[idx1] and nearestind1[idx0] == idx1 and match1[idx0]:
-            yield idx0, idx1
+    mutual = nearest1 == idx1
+    return idx0[mutual], idx1[mutual]
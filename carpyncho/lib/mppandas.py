@@ -20,17 +20,71 @@ import pandas as pd
 CORES = mp.cpu_count()
 
 
+#: Resources attached to the current worker of a WorkerPool
+_resources = {}
+
+
 # =============================================================================
 # FUNCTIONS
 # =============================================================================
 
+def _attach(resources):
+    _resources.clear()
+    _resources.update(resources)
+
+
+def resource(name):
+    """Retrieve a resource attached to the current worker of a
+    `WorkerPool`
+
+    """
+    return _resources[name]
+
+
 def mp_apply(data, func, procs=None, chunks=None):
-    procs = procs or CORES
-    chunks = chunks or CORES
-
-    data_split = np.array_split(data, chunks)
-    pool = mp.Pool(procs)
-    data = pd.concat(pool.map(func, data_split))
-    pool.close()
-    pool.join()
-    return data
+    with WorkerPool(procs) as pool:
+        return pool.apply(data, func, chunks=chunks)
+
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+class WorkerPool(object):
+    """Long lived pool of processes to apply many functions over
+    dataframes.
+
+    The ``resources`` (a dict) are attached only once by every worker when
+    is started and can be retrieved by the functions with `resource`. The
+    big arrays should be published with `carpyncho.lib.broadcast` so every
+    worker only memory maps their file.
+
+    """
+
+    def __init__(self, procs=None, resources=None):
+        self.procs = procs or CORES
+        self.resources = resources or {}
+        self._pool = mp.Pool(self.procs, _attach, (self.resources,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+
+    def apply(self, data, func, chunks=None):
+        """Split the dataframe in ``chunks`` parts and concatenate the result
+        of ``func`` over every part
+
+        """
+        if self._pool is None:
+            raise RuntimeError("The pool is closed")
+        chunks = chunks or CORES
+        data_split = np.array_split(data, chunks)
+        return pd.concat(self._pool.map(func, data_split))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Min/max statistics (zone maps) of fixed size row groups.
+
+The rows of an array are splitted in groups of ``ROW_GROUP_SIZE`` rows and
+the minimum and maximum of every numeric column of every group are keeped
+in a small array. A range filter (like ``Mean > 12``) only needs to read
+the groups where their bounds can match.
+
+The predicates are tuples ``(column, op, value)`` with the ops ``<``,
+``<=``, ``>``, ``>=``, ``==``, ``!=`` and ``between`` (inclusive, with a
+``(low, high)`` value), and all of them must be satisfied. The NaN never
+matches a predicate (except ``!=``).
+
+The groups are only skipped if the values of the filtered column are
+clustered by row (for example the features stored in id order has almost
+all the range of the Mean in every group), so the rows must be sorted by
+the column most used in the filters before store them (see
+`cluster_order`). The filters over other columns only skip groups if
+their values are correlated with that column.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import operator
+
+import numpy as np
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+#: Default number of rows of every group
+ROW_GROUP_SIZE = 2 ** 16
+
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "between": lambda values, bounds: (
+        (values >= bounds[0]) & (values <= bounds[1]))}
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def is_numeric(dtype):
+    return np.dtype(dtype).kind in "biuf"
+
+
+def _bounds(values, starts):
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return np.empty(0), np.empty(0)
+    # fmin and fmax ignore the NaN (and an all NaN group has NaN bounds)
+    return np.fmin.reduceat(values, starts), np.fmax.reduceat(values, starts)
+
+
+def build(arr, group_size=ROW_GROUP_SIZE):
+    """Create the zone map of the numeric columns of the record array
+    ``arr``.
+
+    Returns
+    -------
+
+    np.ndarray
+        One row per group with the ``start`` and ``stop`` rows of the
+        group and the ``min`` and ``max`` of every numeric column
+        (``zonemap["min"]["Mean"]``).
+
+    """
+    names = [n for n in arr.dtype.names if is_numeric(arr.dtype[n])]
+    stats_dtype = [(name, float) for name in names]
+
+    starts = np.arange(0, len(arr), group_size, dtype=np.int64)
+    zonemap = np.empty(len(starts), dtype=[
+        ("start", np.int64), ("stop", np.int64),
+        ("min", stats_dtype), ("max", stats_dtype)])
+    zonemap["start"] = starts
+    zonemap["stop"] = np.minimum(starts + group_size, len(arr))
+    for name in names:
+        zonemap["min"][name], zonemap["max"][name] = _bounds(
+            arr[name], starts)
+    return zonemap
+
+
+def add(zonemap, name, values):
+    """Create a new zone map with the statistics of one more column (or
+    with the new values of an existing one)
+
+    """
+    values = np.asarray(values)
+    if not is_numeric(values.dtype):
+        return zonemap
+
+    names = [n for n in zonemap.dtype["min"].names if n != name] + [name]
+    stats_dtype = [(n, float) for n in names]
+    new = np.empty(len(zonemap), dtype=[
+        ("start", np.int64), ("stop", np.int64),
+        ("min", stats_dtype), ("max", stats_dtype)])
+    new["start"] = zonemap["start"]
+    new["stop"] = zonemap["stop"]
+    for old_name in names[:-1]:
+        new["min"][old_name] = zonemap["min"][old_name]
+        new["max"][old_name] = zonemap["max"][old_name]
+    new["min"][name], new["max"][name] = _bounds(values, zonemap["start"])
+    return new
+
+
+def cluster_order(values):
+    """Order of the rows sorted by the given values (with the NaN at the
+    end), so every row group covers a narrow range of the values
+
+    """
+    return np.argsort(np.asarray(values, dtype=float), kind="mergesort")
+
+
+def _may_match(low, high, op, value):
+    """Groups with bounds ``low`` and ``high`` that can has values that
+    satisfy the predicate
+
+    """
+    if op == "<":
+        return low < value
+    elif op == "<=":
+        return low <= value
+    elif op == ">":
+        return high > value
+    elif op == ">=":
+        return high >= value
+    elif op == "==":
+        return (low <= value) & (high >= value)
+    elif op == "!=":
+        return ~((low == value) & (high == value))
+    elif op == "between":
+        return (high >= value[0]) & (low <= value[1])
+    raise ValueError("Unknown operator '{}'".format(op))
+
+
+def groups(zonemap, predicates):
+    """Boolean mask of the groups that can has rows that satisfy all
+    the predicates. The predicates over columns without statistics never
+    skip a group.
+
+    """
+    mask = np.ones(len(zonemap), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        for column, op, value in predicates:
+            if column in zonemap.dtype["min"].names:
+                mask &= _may_match(
+                    zonemap["min"][column], zonemap["max"][column], op, value)
+            elif op not in OPERATORS:
+                raise ValueError("Unknown operator '{}'".format(op))
+    return mask
+
+
+def ranges(zonemap, predicates):
+    """The (start, stop) rows of the groups that can satisfy the predicates
+    (the consecutive groups are merged in one range)
+
+    """
+    selected = zonemap[groups(zonemap, predicates)]
+    result = []
+    for start, stop in zip(selected["start"], selected["stop"]):
+        if result and result[-1][1] == start:
+            result[-1] = (result[-1][0], stop)
+        else:
+            result.append((start, stop))
+    return result
+
+
+def evaluate(data, predicates):
+    """Boolean mask of the rows of ``data`` (a record array or a mapping of
+    columns) that satisfy all the predicates
+
+    """
+    mask = None
+    with np.errstate(invalid="ignore"):
+        for column, op, value in predicates:
+            if op not in OPERATORS:
+                raise ValueError("Unknown operator '{}'".format(op))
+            pmask = np.asarray(OPERATORS[op](data[column], value))
+            mask = pmask if mask is None else (mask & pmask)
+    return mask
+
+
+def columns_of(predicates):
+    """Name of the columns used by the predicates (without repetitions)"""
+    names = []
+    for column, _, _ in predicates:
+        if column not in names:
+            names.append(column)
+    return names
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# DOCS
+# =============================================================================
+
+"""Declination zones index for sky catalogs.
+
+The sky is splitted in bands of declination (zones) of a fixed height.
+If the rows of a catalog are sorted by zone (and by ra inside every zone)
+all the sources inside a box of the sky are in a contiguous range of rows,
+and can be read from a memory mapped file without touching the rest of
+the catalog.
+
+The index is only an array of ``n_zones + 1`` offsets where the rows of
+the zone ``z`` are ``offsets[z]:offsets[z + 1]``.
+
+"""
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import numpy as np
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+#: Default height in degrees of every zone
+ZONE_HEIGHT = 0.1
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def zones_number(height=ZONE_HEIGHT):
+    return int(np.ceil(180. / height))
+
+
+def zone_height(offsets):
+    """Retrieve the height of the zones used to create the given offsets"""
+    return 180. / (len(offsets) - 1)
+
+
+def zone_of(dec, height=ZONE_HEIGHT):
+    """Zone number of the given declinations"""
+    zones = np.floor((np.asarray(dec) + 90.) / height).astype(int)
+    return np.clip(zones, 0, zones_number(height) - 1)
+
+
+def build(ra, dec, height=ZONE_HEIGHT):
+    """Create the zones index of the given coordinates.
+
+    Returns
+    -------
+
+    order : np.ndarray
+        The order in which the rows must be stored.
+    offsets : np.ndarray
+        First row of every zone (over the sorted rows) plus the total of
+        rows at the end.
+
+    """
+    zones = zone_of(dec, height)
+    order = np.lexsort((ra, zones))
+    offsets = np.searchsorted(
+        zones[order], np.arange(zones_number(height) + 1), side="left")
+    return order, offsets
+
+
+def rows_range(offsets, dec_min, dec_max):
+    """Return the (start, stop) rows of all the zones between the two
+    declinations
+
+    """
+    height = zone_height(offsets)
+    zmin, zmax = zone_of([dec_min, dec_max], height)
+    return int(offsets[zmin]), int(offsets[zmax + 1])
+
+
+def ra_between(ra, ra_min, ra_max):
+    """Mask of the ra between ra_min and ra_max. If ``ra_min > ra_max`` the
+    interval cross the ra=0.
+
+    """
+    if ra_min <= ra_max:
+        return (ra >= ra_min) & (ra <= ra_max)
+    return (ra >= ra_min) | (ra <= ra_max)
+
+
+def in_box(ra, dec, box):
+    """Mask of the coordinates inside the box
+    (ra_min, ra_max, dec_min, dec_max)
+
+    """
+    ra_min, ra_max, dec_min, dec_max = box
+    return (
+        (dec >= dec_min) & (dec <= dec_max) &
+        ra_between(ra, ra_min, ra_max))
+
+
+def footprint(ra, dec, pad=0.):
+    """Box (ra_min, ra_max, dec_min, dec_max) that contains all the given
+    coordinates plus a margin of pad degrees.
+
+    If the box cross the ra=0 the ``ra_min`` is greater than ``ra_max``.
+
+    """
+    ra, dec = np.asarray(ra), np.asarray(dec)
+    dec_min = max(np.min(dec) - pad, -90.)
+    dec_max = min(np.max(dec) + pad, 90.)
+
+    # the same box but with the ra origin moved to 180
+    shifted = np.mod(ra + 180., 360.)
+    if np.ptp(shifted) < np.ptp(ra):
+        ra_min = np.mod(np.min(shifted) - 180., 360.)
+        ra_max = np.mod(np.max(shifted) - 180., 360.)
+        width = np.ptp(shifted)
+    else:
+        ra_min, ra_max, width = np.min(ra), np.max(ra), np.ptp(ra)
+
+    # the pad in ra grows with the declination
+    cos_dec = np.cos(np.radians(max(abs(dec_min), abs(dec_max))))
+    ra_pad = pad / cos_dec if cos_dec > 0 else 360.
+    if width + 2 * ra_pad >= 360.:
+        return 0., 360., dec_min, dec_max
+
+    ra_min = np.mod(ra_min - ra_pad, 360.)
+    ra_max = np.mod(ra_max + ra_pad, 360.)
+    return ra_min, ra_max, dec_min, dec_max
+
+
+def ra_intervals(box):
+    """The ra intervals of the box (two if the box cross the ra=0)"""
+    ra_min, ra_max = box[0], box[1]
+    if ra_min <= ra_max:
+        return [(ra_min, ra_max)]
+    return [(ra_min, 360.), (0., ra_max)]
+
+
+def overlap(box_a, box_b):
+    """True if the two boxes (ra_min, ra_max, dec_min, dec_max) has at
+    least one point in common
+
+    """
+    if box_a[2] > box_b[3] or box_b[2] > box_a[3]:
+        return False
+    return any(
+        a_min <= b_max and b_min <= a_max
+        for a_min, a_max in ra_intervals(box_a)
+        for b_min, b_max in ra_intervals(box_b))
+
+
+def select(arr, offsets, box, ra="ra", dec="dec"):
+    """Retrieve the rows of the zone sorted array inside the box. Only the
+    zones that intersect the box are readed.
+
+    """
+    start, stop = rows_range(offsets, box[2], box[3])
+    part = arr[start:stop]
+    mask = in_box(part[ra], part[dec], box)
+    return start + np.where(mask)[0]
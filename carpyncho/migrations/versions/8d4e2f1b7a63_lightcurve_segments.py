@@ -0,0 +1,33 @@
+"""lightcurve segments
+
+Revision ID: 8d4e2f1b7a63
+Revises: 19e8e023f5fb
+Create Date: 2026-10-18 10:12:40.518236
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4e2f1b7a63'
+down_revision = '19e8e023f5fb'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('PawprintStackXTile', sa.Column('lcurve_segment', sa.Integer(), nullable=True))
+    op.add_column('LightCurves', sa.Column('segments', sa.Integer(), nullable=False, server_default="0"))
+
+    # all the matched pxts of the tiles with light curves are in the
+    # first segment
+    op.execute(
+        'UPDATE "PawprintStackXTile" SET lcurve_segment = 0 '
+        'WHERE status = \'matched\' AND '
+        'tile_id IN (SELECT tile_id FROM "LightCurves")')
+
+
+def downgrade():
+    op.drop_column('LightCurves', 'segments')
+    op.drop_column('PawprintStackXTile', 'lcurve_segment')
@@ -0,0 +1,26 @@
+"""obs counter to file
+
+Revision ID: b5a9c3d07e21
+Revises: 8d4e2f1b7a63
+Create Date: 2026-10-18 11:03:17.240961
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5a9c3d07e21'
+down_revision = '8d4e2f1b7a63'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # the counter is now stored next to the observations and the old
+    # light curves rebuild it from the observations index
+    op.drop_column('LightCurves', 'src_obs_cnt')
+
+
+def downgrade():
+    op.add_column('LightCurves', sa.Column('src_obs_cnt', sa.PickleType(), nullable=True))
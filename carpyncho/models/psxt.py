@@ -16,6 +16,43 @@ from corral import db
 from corral.conf import settings
 
 
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def join_matchs(tile_name, tile_id, pawprint_stack_id, band,
+                tile_data, pwp_data, idx_ms, idx_pwp):
+    """Create an array with all the columns of the matched sources of
+    the tile (prefixed with 'bm_src_') and all the columns of the matched
+    sources of the pawprint stack (prefixed with 'pwp_stack_src_')
+
+    """
+    dtype = {
+        "names": (
+            ["tile_name", "tile_id"] +
+            ["bm_src_{}".format(n) for n in tile_data.dtype.names] +
+            ["pwp_stack_id", "pwp_stack_band"] +
+            ["pwp_stack_src_{}".format(n) for n in pwp_data.dtype.names]),
+        "formats": (
+            ["|S10", int] + [e[-1] for e in tile_data.dtype.descr] +
+            [int, "|S10"] + [e[-1] for e in pwp_data.dtype.descr])
+    }
+
+    arr = np.empty(len(idx_ms), dtype=dtype)
+
+    arr["tile_name"] = tile_name
+    arr["tile_id"] = tile_id
+    for name in tile_data.dtype.names:
+        arr["bm_src_{}".format(name)] = tile_data[name][idx_ms]
+
+    arr["pwp_stack_id"] = pawprint_stack_id
+    arr["pwp_stack_band"] = band
+    for name in pwp_data.dtype.names:
+        arr["pwp_stack_src_{}".format(name)] = pwp_data[name][idx_pwp]
+
+    return arr
+
+
 # =============================================================================
 # PawprintStackXTile
 # =============================================================================
@@ -24,6 +61,12 @@ class PawprintStackXTile(db.Model):
     """Relation between a pawprint-stack and a tile. Because the virca, overlap
     some pawprints can be in two tiles
 
+    The matches are stored only as the pair of rows of the tile and the
+    pawprint stack (``bm_src_idx`` and ``pwp_stack_src_idx``) plus the
+    columns needed for the light curves. All the others columns of the tile
+    and the pawprint-stack can be retrieved with
+    ``load_npy_file(join=True)``.
+
     """
 
     __tablename__ = "PawprintStackXTile"
@@ -32,6 +75,15 @@ class PawprintStackXTile(db.Model):
                             name='_pawprint_tile_uc'),
     )
 
+    MATCH_DTYPE = [
+        ("bm_src_idx", np.int32),
+        ("bm_src_id", np.int64),
+        ("pwp_stack_src_idx", np.int32),
+        ("pwp_stack_src_id", np.int64),
+        ("pwp_stack_src_hjd", float),
+        ("pwp_stack_src_mag3", float),
+        ("pwp_stack_src_mag_err3", float)]
+
     statuses = db.Enum(
         "raw", "ready-to-match", "matched", name="pxt_statuses")
 
@@ -49,6 +101,10 @@ class PawprintStackXTile(db.Model):
 
     matched_number = db.Column(db.Integer, nullable=True)
 
+    # the segment of the light curves of the tile where the matches are
+    # stored (None if the matches are not in the light curves)
+    lcurve_segment = db.Column(db.Integer, nullable=True)
+
     status = db.Column(statuses, default="raw")
 
     def __repr__(self):
@@ -69,5 +125,24 @@ class PawprintStackXTile(db.Model):
             os.makedirs(file_dir)
         np.save(self.npy_file_path, arr)
 
-    def load_npy_file(self):
-        return np.load(self.npy_file_path)
+    def load_npy_file(self, join=False):
+        arr = np.load(self.npy_file_path)
+        if join:
+            arr = self.join(arr)
+        return arr
+
+    def join(self, arr):
+        """Resolve all the columns of the tile and the pawprint stack
+        of the given matches
+
+        """
+        # old matches files already has all the columns
+        if "bm_src_idx" not in arr.dtype.names:
+            return arr
+        return join_matchs(
+            tile_name=self.tile.name, tile_id=self.tile.id,
+            pawprint_stack_id=self.pawprint_stack.id,
+            band=self.pawprint_stack.band,
+            tile_data=self.tile.load_npy_file(),
+            pwp_data=self.pawprint_stack.load_npy_file(),
+            idx_ms=arr["bm_src_idx"], idx_pwp=arr["pwp_stack_src_idx"])
@@ -9,16 +9,42 @@
 # =============================================================================
 
 import os
+import glob
 import shutil
-from collections import Counter
 
 import numpy as np
 
+import joblib
+
+from numpy.lib.format import open_memmap
+
 from sqlalchemy.orm import validates
 
 from corral import db
 from corral.conf import settings
 
+from ..lib import matcher, zones, lcindex, lcstorage, lcschema, zonemap
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+#: Maximum number of observations merged at once by LightCurves.compact
+COMPACT_BLOCK_SIZE = 10 ** 6
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+def _segment_reader(segment):
+    """Reader of the rows (and columns) of a memory mapped segment"""
+    def read(rows, columns=None):
+        arr = segment[rows]
+        return np.array(arr if columns is None else arr[columns])
+    return read
+
 
 # =============================================================================
 # TILE
@@ -118,18 +144,63 @@ class Tile(db.Model):
         self._raw_filename = os.path.basename(fpath)
         shutil.copyfile(fpath, self.raw_file_path)
 
-    def store_npy_file(self, arr):
+    @property
+    def index_file_path(self):
+        if self._npy_filename:
+            return os.path.splitext(self.npy_file_path)[0] + "_skyidx.pkl"
+
+    def store_npy_file(self, arr, index=False):
+        """Store the sources of the tile. If index is True also the sky
+        index is rebuilded (this is needed every time the rows of the
+        array changes)
+
+        """
         self._npy_filename = os.path.splitext(self._raw_filename)[0] + ".npy"
         np.save(self.npy_file_path, arr)
+        if index:
+            self.store_index(arr)
 
     def load_npy_file(self):
         return np.load(self.npy_file_path)
 
+    def store_index(self, arr):
+        """Build a KD-tree over the ra_k and dec_k of the sources and store
+        it next to the npy file. The arrays of the tree are stored by joblib
+        in a way that can be memory mapped when is loaded (the node buffer
+        of the tree, ~12 bytes by source, is stored pickled).
+
+        """
+        tree = matcher.build_tree(arr["ra_k"], arr["dec_k"])
+        joblib.dump(tree, self.index_file_path)
+        return tree
+
+    def load_index(self):
+        """Return the KD-tree of the sources of the tile with their arrays
+        memory mapped (only the node buffer is readed in memory). If the
+        index not exists is created.
+
+        """
+        if not os.path.exists(self.index_file_path):
+            return self.store_index(self.load_npy_file())
+        return joblib.load(self.index_file_path, mmap_mode="r")
+
+    def cone_search(self, ra, dec, radius):
+        """Return the sorted row indexes of all the sources of the tile
+        inside the given cone (all the values are in degrees)
+
+        """
+        tree = self.load_index()
+        center = matcher.to_xyz(ra, dec)[0]
+        idxs = tree.query_ball_point(center, matcher.chord(radius))
+        return np.sort(np.asarray(idxs, dtype=int))
+
 
 class LightCurves(db.Model):
     """Stores the sources of the tile and also their observations
-    inside a pawprint. This resume are stores inside an hdf5 for
-    eficient access
+    inside a pawprint. This resume are stores as npy files or inside
+    a compressed hdf5 (see the LC_STORAGE setting) for eficient access.
+    The features are stored by default with one file per column (see the
+    FEATURES_STORAGE setting).
 
     """
 
@@ -144,7 +215,8 @@ class LightCurves(db.Model):
 
     # ~ feats_version  = db.Column(db.String(10), default="1.0")
 
-    _src_obs_counter = db.Column("src_obs_cnt", db.PickleType, nullable=True)
+    # number of appended segments of observations not compacted yet
+    segments = db.Column(db.Integer, nullable=False, default=0)
 
     def __repr__(self):
         return "<LightCurves of '{}'>".format(self.tile.name)
@@ -154,11 +226,29 @@ class LightCurves(db.Model):
             msg = "Tile {} are ready so the Lightcurve.{} is readonly"
             raise AttributeError(msg.format(self.tile.name, attr))
 
+    def _save_cnt(self, ids, cnts):
+        cnt = np.empty(len(ids), dtype=[("id", np.int64), ("cnt", int)])
+        cnt["id"] = ids
+        cnt["cnt"] = cnts
+        self._save(self._counter_path, cnt)
+
     def _set_cnt(self, ids):
-        cnt = Counter(ids)
-        gen = (e for e in cnt.items())
-        dtype = [("id", np.int64), ("cnt", int)]
-        self._src_obs_counter = np.fromiter(gen, dtype=dtype)
+        self._save_cnt(*np.unique(ids, return_counts=True))
+
+    def _add_cnt(self, ids, cnts=None):
+        """Add the observations of the given ids (or the given number of
+        observations of every id) to the counter
+
+        """
+        if cnts is None:
+            ids, cnts = np.unique(ids, return_counts=True)
+        old = self.obs_counter
+        if old is not None:
+            ids = np.concatenate((old["id"], ids))
+            cnts = np.concatenate((old["cnt"], cnts))
+
+        uids, inverse = np.unique(ids, return_inverse=True)
+        self._save_cnt(uids, np.bincount(inverse, weights=cnts))
 
     @property
     def lc_path(self):
@@ -167,35 +257,602 @@ class LightCurves(db.Model):
             os.makedirs(path)
         return path
 
+    @property
+    def _counter_path(self):
+        return self._base_path("lc_cnt") + ".npy"
+
     @property
     def obs_counter(self):
-        return self._src_obs_counter
+        """Number of observations of every source (including the segments
+        not compacted yet). Is stored outside the database so the queries
+        of the light curves not load it.
+
+        """
+        path = self._counter_path
+        if not os.path.exists(path):
+            # old light curves has the counter only in the index
+            index = self.observations_index
+            if index is None:
+                return None
+            self._save_cnt(index["id"], index["cnt"])
+        return np.load(path)
+
+    # =========================================================================
+    # FILES
+    # =========================================================================
+
+    @property
+    def storage(self):
+        """Backend used to write the observations and the features
+        (settings LC_STORAGE and LC_STORAGE_OPTIONS). The files are readed
+        with the backend of their extension.
+
+        """
+        return lcstorage.get_storage(
+            settings.get("LC_STORAGE", lcstorage.DEFAULT),
+            **settings.get("LC_STORAGE_OPTIONS", {}))
+
+    @property
+    def features_storage(self):
+        """Backend used to write the features (setting FEATURES_STORAGE,
+        by default one file per column)
+
+        """
+        return lcstorage.get_storage(
+            settings.get("FEATURES_STORAGE", "columns"),
+            **settings.get("FEATURES_STORAGE_OPTIONS", {}))
+
+    def _base_path(self, name):
+        fname = "{}_{}".format(name, self.tile.name)
+        return os.path.join(self.lc_path, fname)
+
+    @property
+    def _observations_index_path(self):
+        return self._base_path("lc_idx") + ".npy"
+
+    @property
+    def _pawprints_path(self):
+        return self._base_path("lc_pwp") + ".npy"
+
+    def _save(self, path, arr):
+        """Write a npy sidecar file, replacing the old one only when the
+        new one is complete (so the arrays already memory mapped from the
+        old file remains valid).
+
+        """
+        lcstorage.NpyStorage().save(path, arr)
+
+    def _write(self, name, attr, arr, storage=None):
+        storage = self.storage if storage is None else storage
+        lcstorage.save(self._base_path(name), arr, storage)
+        setattr(self, attr, None)
+
+    def _load(self, name, attr, columns):
+        """Read the file (only the first time) and return the projection of
+        the given columns (or all the array if columns is None)
+
+        """
+        arr = getattr(self, attr, None)
+        if arr is None:
+            path, storage = lcstorage.find(
+                self._base_path(name), prefer=self.storage)
+            if path is None:
+                return None
+            elif columns is not None and not storage.mmap:
+                # only the requested columns are readed from the disk
+                return storage.load(path, columns)
+            arr = storage.load(path)
+            setattr(self, attr, arr)
+        return arr if columns is None else arr[columns]
+
+    def _load_rows(self, name, attr, rows, columns):
+        """Read only the given rows (a slice or an array of indexes) of the
+        file
+
+        """
+        path, storage = lcstorage.find(
+            self._base_path(name), prefer=self.storage)
+        if path is None:
+            return None
+        elif storage.mmap or getattr(self, attr, None) is not None:
+            arr = self._load(name, attr, None)[rows]
+            return np.array(arr if columns is None else arr[columns])
+        elif isinstance(rows, slice):
+            return storage.read(path, rows.start, rows.stop, columns)
+        return storage.take(path, rows, columns)
+
+    # =========================================================================
+    # OBSERVATIONS
+    # =========================================================================
 
     @property
     def observations(self):
-        fname = "lc_obs_{}.npy".format(self.tile.name)
-        path = os.path.join(self.lc_path, fname)
-        if os.path.exists(path):
-            return np.load(path)
+        return self.get_observations()
 
     @observations.setter
     def observations(self, arr):
         self._check_write("observations")
         self._set_cnt(arr["bm_src_id"])
-        fname = "lc_obs_{}.npy".format(self.tile.name)
-        path = os.path.join(self.lc_path, fname)
+        self._store_observations(arr)
+
+    def get_observations(self, columns=None):
+        """The (read only) observations of the tile. The observations
+        stored with the full layout are memory mapped; the compact ones are
+        decoded (only the given columns) from the memory mapped file.
+
+        Parameters
+        ----------
+
+        columns : str, list of str or None
+            If is not None only this columns are returned.
+
+        """
+        arr = self._load("lc_obs", "_observations_cache", None)
+        if arr is None or not lcschema.is_compact(arr):
+            return arr if arr is None or columns is None else arr[columns]
+        return self._decode(arr, slice(0, len(arr)), columns)
+
+    @property
+    def stored_observations(self):
+        """The observations as they are stored (with the compact or the
+        full layout) without decode. Every part can be decoded with
+        `carpyncho.lib.lcschema.read_rows`.
+
+        """
+        return self._load("lc_obs", "_observations_cache", None)
+
+    @property
+    def pawprints(self):
+        """The (pwp_id, hjd_base) of the pawprints of the compact
+        observations
+
+        """
+        pawprints = getattr(self, "_pawprints_cache", None)
+        if pawprints is None and os.path.exists(self._pawprints_path):
+            pawprints = np.load(self._pawprints_path)
+            self._pawprints_cache = pawprints
+        return pawprints
+
+    def _decode(self, arr, rows, columns):
+        src_ids = lcschema.row_source_ids(self.observations_index, rows)
+        return lcschema.decode(arr, self.pawprints, src_ids, columns)
+
+    def _store_observations(self, arr):
+        """Store the observations sorted by source and time (with the
+        compact schema if is possible) and the CSR index of the sources
+
+        """
+        if not lcindex.is_sorted(arr):
+            arr = arr[lcindex.sort_order(arr)]
+        compact, pawprints = lcschema.encode(arr)
+        if compact is None:
+            self._write("lc_obs", "_observations_cache", arr)
+            if os.path.exists(self._pawprints_path):
+                os.remove(self._pawprints_path)
+        else:
+            self._save(self._pawprints_path, pawprints)
+            self._write("lc_obs", "_observations_cache", compact)
+        self._save(
+            self._observations_index_path, lcindex.build(arr["bm_src_id"]))
+        self._observations_index_cache = None
+        self._pawprints_cache = None
+
+    def _building_path(self, segment):
+        if segment is None:
+            return self._base_path("lc_obs") + "_building.npy"
+        return "{}_{}.npy".format(self._base_path("lc_seg"), segment)
+
+    def open_observations(self, size, dtype, segment=None):
+        """Create an empty npy file for ``size`` observations (or for the
+        observations of a new segment) to be filled in place, even by many
+        processes. When the file is filled must be stored with
+        `commit_observations`.
+
+        Returns the path of the file.
+
+        """
+        self._check_write("observations")
+        path = self._building_path(segment)
+        open_memmap(path, mode="w+", dtype=dtype, shape=(size,)).flush()
+        return path
+
+    def commit_observations(self, index, segment=None, pawprints=None):
+        """Store the observations filled in the file created with
+        `open_observations`. The observations must be sorted by source and
+        time and ``index`` must be their CSR index. If the observations
+        has the compact schema ``pawprints`` must be their pawprints table.
+
+        """
+        self._check_write("observations")
+        if segment is not None:
+            self._add_cnt(index["id"], index["cnt"])
+            self.segments = (self.segments or 0) + 1
+            return
+
+        if pawprints is not None:
+            self._save(self._pawprints_path, pawprints)
+        elif os.path.exists(self._pawprints_path):
+            os.remove(self._pawprints_path)
+        lcstorage.save_file(
+            self._base_path("lc_obs"), self._building_path(segment),
+            self.storage)
+        self._save(self._observations_index_path, index)
+        self._save_cnt(index["id"], index["cnt"])
+        self._observations_cache = None
+        self._observations_index_cache = None
+        self._pawprints_cache = None
+
+    @property
+    def observations_index(self):
+        """The (id, start, cnt) of the observations of every source (see
+        `build_observations_index`)
+
+        """
+        return self.build_observations_index()
+
+    def build_observations_index(self):
+        """Retrieve the index of the observations, creating it if not
+        exists. The observations stored before the index existed are
+        sorted and indexed here.
+
+        """
+        index = getattr(self, "_observations_index_cache", None)
+        if index is not None:
+            return index
+
+        path = self._observations_index_path
+        if not os.path.exists(path):
+            obs = self.observations
+            if obs is None:
+                return None
+            elif lcindex.is_sorted(obs):
+                self._save(path, lcindex.build(obs["bm_src_id"]))
+            else:
+                self._store_observations(obs)
+
+        self._observations_index_cache = np.load(path)
+        return self._observations_index_cache
+
+    def source_slice(self, src_id, index=None):
+        """Rows of the observations of the given source"""
+        index = self.observations_index if index is None else index
+        return lcindex.source_slice(index, src_id)
+
+    def read_observations(self, rows, columns=None):
+        """Read only the given rows (a slice or an array of indexes) of the
+        observations
+
+        """
+        arr = self._load_rows("lc_obs", "_observations_cache", rows, None)
+        if arr is None or not lcschema.is_compact(arr):
+            return arr if arr is None or columns is None else arr[columns]
+        return self._decode(arr, rows, columns)
+
+    def source_observations(self, src_id, columns=None):
+        """All the observations (sorted by time) of the given source.
+        Only the rows of the source are readed from the disk.
+
+        """
+        index = self.observations_index
+        if index is None:
+            return None
+        return self.read_observations(
+            self.source_slice(src_id, index), columns)
+
+    # =========================================================================
+    # SEGMENTS
+    # =========================================================================
+
+    @property
+    def _segments_paths(self):
+        """Paths of the segments not compacted yet, sorted by number"""
+        pattern = self._base_path("lc_seg") + "_*.npy"
+        paths = glob.glob(pattern)
+        return sorted(
+            paths, key=lambda p: int(p.rsplit("_", 1)[-1][:-len(".npy")]))
+
+    def append_segment(self, arr, number):
+        """Store new observations of the tile without rewrite the already
+        stored ones. The segments are merged with the observations with
+        `compact`.
+
+        """
+        self._check_write("observations")
+        if not lcindex.is_sorted(arr):
+            arr = arr[lcindex.sort_order(arr)]
+        path = "{}_{}.npy".format(self._base_path("lc_seg"), number)
         np.save(path, arr)
+        self._add_cnt(arr["bm_src_id"])
+        self.segments = (self.segments or 0) + 1
+
+    def compact(self, block_size=COMPACT_BLOCK_SIZE):
+        """Merge all the appended segments into the sorted and indexed
+        observations. The observations are merged by blocks of at most
+        ``block_size`` observations in a new file, so only one block is
+        in memory.
+
+        """
+        self._check_write("observations")
+        paths = self._segments_paths
+        if paths:
+            self._merge_segments(paths, block_size)
+            for path in paths:
+                os.remove(path)
+        self.segments = 0
+
+    def _merge_segments(self, paths, block_size):
+        # every part is the index of their observations and a reader of
+        # their rows in the full layout
+        parts = []
+        index = self.build_observations_index()
+        if index is not None:
+            parts.append((index, self.read_observations))
+        for path in paths:
+            segment = np.load(path, mmap_mode="r")
+            parts.append((
+                lcindex.build(segment["bm_src_id"]),
+                _segment_reader(segment)))
+
+        def row_blocks(columns):
+            for index, read in parts:
+                size = int(index["cnt"].sum())
+                for start in range(0, size, block_size):
+                    stop = min(start + block_size, size)
+                    yield read(slice(start, stop), columns)
+
+        # the pawprints table (and if the float32 hjd offsets are exact)
+        # is computed over all the observations before write anyone
+        columns = ["pwp_id", "pwp_stack_src_id", "pwp_stack_src_hjd"]
+        pawprints = lcschema.pawprints_of(row_blocks(columns))
+        if pawprints is None:
+            dtype = lcschema.OBS_DTYPE
+        else:
+            dtype = lcschema.compact_dtype(all(
+                lcschema.exact_offsets(
+                    obs["pwp_stack_src_hjd"],
+                    lcschema.hjd_bases(pawprints, obs["pwp_id"]))
+                for obs in row_blocks(["pwp_id", "pwp_stack_src_hjd"])))
+
+        merged = lcindex.merge([index for index, _ in parts])
+        path = self.open_observations(int(merged["cnt"].sum()), dtype)
+        out = np.load(path, mmap_mode="r+")
+        for first_id, last_id in lcindex.blocks(merged, block_size):
+            rows, _ = lcindex.chunk(merged, first_id, last_id)
+            obs = np.concatenate([
+                lcschema.full_layout(
+                    read(lcindex.chunk(index, first_id, last_id)[0]))
+                for index, read in parts])
+            obs = obs[lcindex.sort_order(obs)]
+            if pawprints is not None:
+                obs = lcschema.encode_with(obs, pawprints, dtype)
+            out[rows] = obs
+        out.flush()
+        del out
+
+        self.commit_observations(merged, pawprints=pawprints)
+
+    # =========================================================================
+    # FEATURES
+    # =========================================================================
 
     @property
     def features(self):
-        fname = "features_{}.npy".format(self.tile.name)
-        path = os.path.join(self.lc_path, fname)
-        if os.path.exists(path):
-            return np.load(path)
+        return self.get_features()
 
     @features.setter
     def features(self, arr):
         self._check_write("features")
-        fname = "features_{}.npy".format(self.tile.name)
-        path = os.path.join(self.lc_path, fname)
-        np.save(path, arr)
+        key = self.features_cluster_key
+        if key is not None and key in arr.dtype.names:
+            arr = arr[zonemap.cluster_order(arr[key])]
+        self._write(
+            "features", "_features_cache", arr, self.features_storage)
+        self._store_features_index(arr)
+
+    @property
+    def features_cluster_key(self):
+        """Column used to sort the features before store them (setting
+        FEATURES_CLUSTER_KEY, by default the Mean), so the filters over
+        that column skip most of the row groups (see
+        `carpyncho.lib.zonemap`). None keeps the order of the sources.
+
+        """
+        return settings.get("FEATURES_CLUSTER_KEY", "Mean")
+
+    def get_features(self, columns=None):
+        """The (read only) features of the sources. Only the given columns
+        are readed if the features are stored by column.
+
+        Parameters
+        ----------
+
+        columns : str, list of str or None
+            If is not None only this columns are returned.
+
+        """
+        return self._load("features", "_features_cache", columns)
+
+    def read_features(self, rows, columns=None):
+        """Read only the given rows (a slice or an array of indexes) of the
+        features
+
+        """
+        return self._load_rows("features", "_features_cache", rows, columns)
+
+    def features_frame(self, columns=None, rows=None, where=None):
+        """The features (only the given columns and rows) as a
+        pandas.DataFrame indexed by the number of row. With the features
+        stored by column only the requested columns are readed.
+
+        Parameters
+        ----------
+
+        columns : str, list of str or None
+            If is not None only this columns are returned.
+        rows : slice, array of int or None
+            If is not None only this rows are returned.
+        where : list of predicates or None
+            Only the rows that satisfy all the ``(column, op, value)``
+            predicates are returned (see `carpyncho.lib.zonemap`). The row
+            groups of the features that can't match are not readed. Can't
+            be used with ``rows``.
+
+        """
+        if where and rows is not None:
+            raise ValueError("Use 'rows' or 'where', not both")
+
+        path, storage = lcstorage.find(
+            self._base_path("features"), prefer=self.features_storage)
+        if path is None:
+            return None
+        if where:
+            rows = lcstorage.where(path, storage, where)
+        return lcstorage.load_frame(path, storage, columns, rows)
+
+    def select_features(self, where):
+        """Numbers of the rows of the features that satisfy all the
+        predicates (see `features_frame`)
+
+        """
+        path, storage = lcstorage.find(
+            self._base_path("features"), prefer=self.features_storage)
+        if path is None:
+            return None
+        return lcstorage.where(path, storage, where)
+
+    @property
+    def features_columns(self):
+        """Names of the stored features"""
+        path, storage = lcstorage.find(
+            self._base_path("features"), prefer=self.features_storage)
+        return None if path is None else storage.dtype(path).names
+
+    def add_feature_column(self, name, values):
+        """Store a new feature of every source (or replace an existing
+        one). With the features stored by column only the new column is
+        written; otherwise all the features are rewritten with the
+        FEATURES_STORAGE backend.
+
+        """
+        self._check_write("features")
+        path, storage = lcstorage.find(
+            self._base_path("features"), prefer=self.features_storage)
+        if path is None:
+            raise ValueError(
+                "The tile {} has no features".format(self.tile.name))
+        elif isinstance(storage, lcstorage.ColumnarStorage):
+            storage.add_column(path, name, values)
+        else:
+            feats = self.features
+            names = [n for n in feats.dtype.names if n != name]
+            arr = np.empty(len(feats), dtype=(
+                [(n, feats.dtype[n]) for n in names] +
+                [(name, np.asarray(values).dtype)]))
+            for column in names:
+                arr[column] = feats[column]
+            arr[name] = values
+            self._write(
+                "features", "_features_cache", arr, self.features_storage)
+        self._features_cache = None
+
+    # =========================================================================
+    # FEATURES SKY INDEX
+    # =========================================================================
+
+    @property
+    def _features_index_paths(self):
+        coords = "features_{}_coords.npy".format(self.tile.name)
+        offsets = "features_{}_zones.npy".format(self.tile.name)
+        footprint = "features_{}_footprint.npy".format(self.tile.name)
+        return (
+            os.path.join(self.lc_path, coords),
+            os.path.join(self.lc_path, offsets),
+            os.path.join(self.lc_path, footprint))
+
+    def _store_features_index(self, arr):
+        """Store the ra_k and dec_k of every row of the features sorted by
+        declination zones (and the offsets of every zone) plus the box
+        that contains all the sources.
+
+        """
+        # sometimes the ra_k and dec_k are stored as strings
+        ra = arr["ra_k"].astype(float)
+        dec = arr["dec_k"].astype(float)
+
+        order, offsets = zones.build(ra, dec)
+
+        coords = np.empty(
+            len(arr), dtype=[("row", np.int64), ("ra", float), ("dec", float)])
+        coords["row"] = order
+        coords["ra"] = ra[order]
+        coords["dec"] = dec[order]
+
+        footprint = (
+            zones.footprint(ra, dec) if len(arr) else (np.nan,) * 4)
+
+        coords_path, offsets_path, footprint_path = self._features_index_paths
+        self._save(coords_path, coords)
+        self._save(offsets_path, offsets)
+        self._save(footprint_path, np.array(footprint, dtype=float))
+
+    def _check_features_index(self):
+        """Create the index from the stored ra_k and dec_k if not exists.
+        Return False if the tile has no features.
+
+        """
+        if all(map(os.path.exists, self._features_index_paths)):
+            return True
+        arr = self.get_features(["ra_k", "dec_k"])
+        if arr is None:
+            return False
+        self._store_features_index(arr)
+        return True
+
+    @property
+    def features_index(self):
+        """The zone sorted coordinates of the features (memory mapped) and
+        the offsets of every declination zone. If the index not exists is
+        created from the stored coordinates of the features.
+
+        """
+        self._check_features_index()
+        coords_path, offsets_path, _ = self._features_index_paths
+        return np.load(coords_path, mmap_mode="r"), np.load(offsets_path)
+
+    @property
+    def features_footprint(self):
+        """The box (ra_min, ra_max, dec_min, dec_max) that contains all the
+        sources with features or None if the tile has no features.
+
+        """
+        if not self._check_features_index():
+            return None
+        return tuple(np.load(self._features_index_paths[-1]))
+
+    def touches_cone(self, ra, dec, radius):
+        """False if no source of the tile can be inside the cone (all the
+        values in degrees). Only the footprint of the tile is readed.
+
+        """
+        footprint = self.features_footprint
+        return footprint is not None and zones.overlap(
+            footprint, zones.footprint([ra], [dec], pad=radius))
+
+    def cone_search(self, ra, dec, radius):
+        """Retrieve the features of the sources inside the cone (all the
+        values in degrees). Only the coordinates of the declination zones
+        of the cone and the selected rows of features are readed.
+
+        """
+        coords, offsets = self.features_index
+
+        box = zones.footprint([ra], [dec], pad=radius)
+        coords = coords[zones.select(coords, offsets, box)]
+
+        center = matcher.to_xyz(ra, dec)
+        distances = np.sqrt(np.sum(
+            (matcher.to_xyz(coords["ra"], coords["dec"]) - center) ** 2,
+            axis=1))
+        rows = np.sort(coords["row"][distances <= matcher.chord(radius)])
+
+        return self._load_rows("features", "_features_cache", rows, None)
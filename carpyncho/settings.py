@@ -70,6 +70,7 @@ STEPS = [
     "carpyncho.steps.match.Match",
 
     "carpyncho.steps.create_lc.CreateLightCurves",
+    "carpyncho.steps.compact_lc.CompactLightCurves",
 
     "carpyncho.steps.features_extractor.FeaturesExtractor",
 ]
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+from corral import run
+
+from ..models import LightCurves
+
+
+# =============================================================================
+# STEP
+# =============================================================================
+
+class CompactLightCurves(run.Step):
+    """Merge the segments of observations appended to the light curves
+    into the source sorted observations
+
+    """
+
+    model = LightCurves
+    conditions = [model.segments > 0]
+    groups = ["postprocess"]
+
+    def process(self, lc):
+        print("Compacting {} segments of {}".format(lc.segments, lc))
+        lc.compact()
+        yield lc
+        self.session.commit()
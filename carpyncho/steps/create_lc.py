@@ -9,10 +9,12 @@ import numpy as np
 
 from joblib import Parallel, delayed, cpu_count
 
+import sqlalchemy as sa
+
 from corral import run
 
 from ..models import Tile, PawprintStackXTile, LightCurves
-from ..lib import beamc
+from ..lib import lcindex, lcschema
 
 
 # =============================================================================
@@ -28,6 +30,8 @@ S_COLUMNS = [
     "bm_src_id", "pwp_id", "pwp_stack_src_id", "pwp_stack_src_hjd",
     "pwp_stack_src_mag3", "pwp_stack_src_mag_err3"]
 
+OBS_DTYPE = lcschema.OBS_DTYPE
+
 CPUS = cpu_count()
 
 
@@ -35,18 +39,55 @@ CPUS = cpu_count()
 # FUNCTION
 # =============================================================================
 
-def read_pxt(pxt_path, pwp_id, total, idx, tile_name):
-    print("Processing pxt {} of {} (Tile {})".format(idx, total, tile_name))
-    arr = np.load(pxt_path)[COLUMNS]
+def read_src_idx(pxt_path, tile_ids, sorter):
+    """Rows of the tile of every match of the pxt"""
+    arr = np.load(pxt_path, mmap_mode="r")
+    if "bm_src_idx" in arr.dtype.names:
+        return np.array(arr["bm_src_idx"])
 
-    ids = np.empty(len(arr)).astype(int)
-    ids[:] = int(pwp_id)
+    # the old matches files only has the id of the tile sources
+    return sorter[np.searchsorted(tile_ids, arr["bm_src_id"], sorter=sorter)]
 
-    extra_cols = [("pwp_id", ids, )]
 
-    arr = beamc.add_columns(arr, extra_cols)[S_COLUMNS]
+def fill_pxt(out_path, pxt_path, pwp_id, pwp_idx,
+             positions, total, idx, tile_name):
+    """Write the observations of the pxt in the given positions of the
+    observations file. If ``pwp_idx`` is not None the observations are
+    written with the compact schema and the pxt has this row in the
+    pawprints table.
 
-    return arr
+    Returns the hjd base of the pawprint (None with the full layout).
+
+    """
+    print("Processing pxt {} of {} (Tile {})".format(idx, total, tile_name))
+    arr = np.load(pxt_path, mmap_mode="r")
+    out = np.load(out_path, mmap_mode="r+")
+
+    if pwp_idx is None:
+        base = None
+        rows = np.empty(len(arr), dtype=OBS_DTYPE)
+        for column in COLUMNS:
+            rows[column] = arr[column]
+        rows["pwp_id"] = int(pwp_id)
+    else:
+        hjd = arr["pwp_stack_src_hjd"]
+        base = lcschema.hjd_base(hjd)
+        rows = lcschema.encode_rows(
+            pwp_idx=pwp_idx,
+            pwp_row=lcschema.pwp_src_row(arr["pwp_stack_src_id"]),
+            hjd=hjd, hjd_base=base, mag=arr["pwp_stack_src_mag3"],
+            mag_err=arr["pwp_stack_src_mag_err3"], dtype=out.dtype)
+
+        # the compact observations must be lossless
+        if np.any(base + rows["hjd_offset"].astype(float) != hjd):
+            raise ValueError(
+                "The hjd of the pxt {} can't be stored as offsets of {} "
+                "bytes".format(pxt_path, rows["hjd_offset"].itemsize))
+
+    out[positions] = rows
+    out.flush()
+
+    return base
 
 
 # =============================================================================
@@ -59,10 +100,15 @@ class CreateLightCurves(run.Step):
     This file is used for the feature extractor for allow to only retrieve
     a fraction of the information and don't fullfill the memory.
 
+    If the tile already has light curves only the new matched pawprints
+    are readed and stored as a new segment of the light curves, that are
+    merged later by the CompactLightCurves step.
+
     """
 
     model = Tile
-    conditions = [model.status == "ready-to-match"]
+    conditions = [
+        model.status.in_(["ready-to-match", "ready-to-extract-features"])]
     groups = ["postprocess"]
 
     def generate(self):
@@ -71,33 +117,132 @@ class CreateLightCurves(run.Step):
                 PawprintStackXTile.tile_id == tile.id)
             not_matched = query.filter(
                 PawprintStackXTile.status != "matched").count()
-            if tile.lcurves is None and not not_matched and query.count():
+            if not_matched:
+                continue
+            if tile.lcurves is None and query.count():
                 yield tile, query
+            elif tile.lcurves is not None:
+                new_pxts = query.filter(
+                    PawprintStackXTile.lcurve_segment.is_(None))
+                if new_pxts.count():
+                    yield tile, new_pxts
 
     def validate(self, generated):
-        if isinstance(generated, (LightCurves, Tile)):
+        if isinstance(generated, (LightCurves, Tile, PawprintStackXTile)):
             return True
         tile, query = generated
         return isinstance(tile, Tile) and hasattr(query, "__iter__")
 
+    def next_segment(self, tile):
+        query = self.session.query(
+            sa.func.max(PawprintStackXTile.lcurve_segment)).filter(
+                PawprintStackXTile.tile_id == tile.id)
+        last = query.scalar()
+        return 0 if last is None else last + 1
+
+    def csr_positions(self, tile, pxts_paths, check_hjd=False):
+        """Compute the position of every source inside the source sorted
+        observations.
+
+        Returns the tile ids, the order of the tile rows by id, the first
+        position of every source, the number of observations of every
+        source and if the hjd of all the pxts can be stored as exact
+        float32 offsets (only if ``check_hjd`` is True, otherwise None).
+
+        """
+        tile_ids = np.load(tile.npy_file_path, mmap_mode="r")["id"]
+        sorter = np.argsort(tile_ids, kind="mergesort")
+
+        # only the tile rows of the matches are readed, one pxt at time
+        counts = np.zeros(len(tile_ids), dtype=np.int64)
+        exact_hjd = True if check_hjd else None
+        for path in pxts_paths:
+            src_idx = read_src_idx(path, tile_ids, sorter)
+            counts += np.bincount(src_idx, minlength=len(tile_ids))
+            if exact_hjd:
+                hjd = np.load(path, mmap_mode="r")["pwp_stack_src_hjd"]
+                exact_hjd = lcschema.exact_offsets(
+                    hjd, lcschema.hjd_base(hjd))
+
+        starts = np.empty(len(tile_ids), dtype=np.int64)
+        starts[sorter] = np.cumsum(counts[sorter]) - counts[sorter]
+        return tile_ids, sorter, starts, counts, exact_hjd
+
+    def tasks(self, out_path, tile, pxts, tile_ids, sorter, starts,
+              compact):
+        """Generate the jobs that fill the observations of every pxt. The
+        pxts are sorted by time, so every source is filled in time order.
+        The tile rows of the matches of a pxt are readed again only when
+        their job is dispatched, so only a few pxts are in memory.
+
+        """
+        cursor = starts.copy()
+        total = len(pxts)
+        for idx, pxt in enumerate(pxts):
+            # every source is only once in a pxt
+            src_idx = read_src_idx(pxt.npy_file_path, tile_ids, sorter)
+            positions = cursor[src_idx]
+            cursor[src_idx] += 1
+
+            yield delayed(fill_pxt)(
+                out_path=out_path, pxt_path=pxt.npy_file_path,
+                pwp_id=pxt.pawprint_stack_id,
+                pwp_idx=idx if compact else None, positions=positions,
+                total=total, idx=idx, tile_name=tile.name)
+
     def process(self, tile_pxts):
         tile, pxts = tile_pxts
+        pxts = sorted(pxts, key=lambda pxt: pxt.pawprint_stack.mjd)
         print tile, "<<" * 40
 
-        # new light curve
-        lc = LightCurves(tile=tile)
-
-        # variables for joblib
-        tile_name, total = tile.name, pxts.count()
-        pxts_paths_ids = [
-            (pxt.npy_file_path, pxt.pawprint_stack_id) for pxt in pxts]
-
+        lc = tile.lcurves
+        if lc is None:
+            # new light curve
+            lc, segment = LightCurves(tile=tile), None
+        else:
+            # the new observations are appended as a new segment and the
+            # features must be extracted again with the new epochs
+            tile.ready = False
+            segment = self.next_segment(tile)
+
+        # the segments uses the full layout and are compacted when merged
+        compact = segment is None
+        tile_ids, sorter, starts, counts, exact_hjd = self.csr_positions(
+            tile, [pxt.npy_file_path for pxt in pxts], check_hjd=compact)
+
+        # the size of the observations is known before read the pxts
+        numbers = [pxt.matched_number for pxt in pxts]
+        size = counts.sum() if None in numbers else sum(numbers)
+        if size != counts.sum():
+            raise ValueError(
+                "The pxts of tile {} has {} matches but {} are stored".format(
+                    tile.name, size, counts.sum()))
+
+        # the workers write their pxt directly in the observations file
+        dtype = lcschema.compact_dtype(exact_hjd) if compact else OBS_DTYPE
+        out_path = lc.open_observations(size, dtype, segment=segment)
         with Parallel(n_jobs=CPUS) as jobs:
-            data = jobs(
-                delayed(read_pxt)(pxt[0], pxt[1], total, idx, tile_name)
-                for idx, pxt in enumerate(pxts_paths_ids))
+            bases = jobs(self.tasks(
+                out_path, tile, pxts, tile_ids, sorter, starts, compact))
+
+        pawprints = None
+        if compact:
+            pawprints = np.empty(len(pxts), dtype=lcschema.PAWPRINTS_DTYPE)
+            pawprints["pwp_id"] = [pxt.pawprint_stack_id for pxt in pxts]
+            pawprints["hjd_base"] = bases
+
+        with_obs = sorter[counts[sorter] > 0]
+        index = np.empty(len(with_obs), dtype=lcindex.INDEX_DTYPE)
+        index["id"] = tile_ids[with_obs]
+        index["start"] = starts[with_obs]
+        index["cnt"] = counts[with_obs]
+        lc.commit_observations(index, segment=segment, pawprints=pawprints)
+
+        segment = segment or 0
+        for pxt in pxts:
+            pxt.lcurve_segment = segment
+            yield pxt
 
-        lc.observations = np.concatenate(data)
         tile.status = "ready-to-extract-features"
 
         yield lc
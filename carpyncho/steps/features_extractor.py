@@ -23,37 +23,157 @@ import feets
 
 from ..models import LightCurves
 
-from ..lib.mppandas import mp_apply, CORES
+from ..lib.mppandas import WorkerPool, resource, CORES
 from ..lib.beamc import add_columns
-from ..lib import feets_patch # Noqa
+from ..lib.broadcast import Broadcast
+from ..lib import lcindex, lcschema
+from ..lib import batchls
+from ..lib import feets_patch
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+#: Number of sources decoded at once to find their faintest observation
+PPMB_BLOCK_SIZE = 10000
+
+LC_COLUMNS = [
+    "pwp_stack_src_hjd", "pwp_stack_src_mag3", "pwp_stack_src_mag_err3"]
 
 
 # =============================================================================
 # HELPER FUNCTIONS
 # =============================================================================
 
+def faintest_hjd(lc, src_ids, block_size=PPMB_BLOCK_SIZE):
+    """The hjd of the faintest observation of every source. Only the
+    magnitude and the hjd of a block of sources are decoded at once.
+
+    Returns a dataframe with the ``bm_src_id`` and the
+    ``pwp_stack_src_hjd``.
+
+    """
+    index = lc.observations_index
+    index = index[np.in1d(index["id"], src_ids) & (index["cnt"] > 0)]
+
+    ids, hjds = [], []
+    for first in range(0, len(index), block_size):
+        block = index[first:first + block_size]
+        offset = int(block["start"][0])
+        rows = slice(offset, int(block["start"][-1] + block["cnt"][-1]))
+        obs = lc.read_observations(
+            rows, ["pwp_stack_src_mag3", "pwp_stack_src_hjd"])
+
+        # rows of the block sources relative to the readed rows
+        firsts = np.cumsum(block["cnt"]) - block["cnt"]
+        local = (
+            np.repeat(block["start"] - offset, block["cnt"]) +
+            np.arange(block["cnt"].sum()) - np.repeat(firsts, block["cnt"]))
+        mag = obs["pwp_stack_src_mag3"][local]
+        hjd = obs["pwp_stack_src_hjd"][local]
+
+        # the first observation with the max magnitude of every source
+        owners = np.repeat(np.arange(len(block)), block["cnt"])
+        maxs = np.fmax.reduceat(mag, firsts)
+        positions = np.flatnonzero(mag == maxs[owners])
+        _, uniques = np.unique(owners[positions], return_index=True)
+        positions = positions[uniques]
+
+        ids.append(block["id"][owners[positions]])
+        hjds.append(hjd[positions])
+
+    return pd.DataFrame({
+        "bm_src_id": np.concatenate(ids) if ids else [],
+        "pwp_stack_src_hjd": np.concatenate(hjds) if hjds else []})
+
+
 class Extractor(object):
+    """Extract the features of the sources of a dataframe.
+
+    Without ``obs``, ``index`` and ``pawprints`` the stored observations
+    (sorted by source, with the compact or the full layout), their index
+    and their pawprints are the resources attached to the worker (see
+    `carpyncho.lib.mppandas.WorkerPool`), so the extractor that is sended
+    with every task only carries the sources. Only the observations of
+    every source are decoded.
+
+    With ``batch_ls`` the best frequency of all the sources of every task
+    is computed in batch (see `carpyncho.lib.batchls`) before extract
+    their features.
 
-    def __init__(self, fs, obs, tile_name, chunkn, chunkst):
+    """
+
+    def __init__(self, fs, tile_name, chunkn, chunkst, obs=None,
+                 index=None, pawprints=None, batch_ls=False,
+                 lscargle_kwds=feets_patch.LSCARGLE_KWDS):
         self._fs = fs
         self._obs = obs
+        self._index = index
+        self._pawprints = pawprints
         self._tname = tile_name
         self._chunkn = chunkn
         self._chunkst = chunkst
+        self._batch_ls = batch_ls
+        self._lscargle_kwds = lscargle_kwds
 
     def __call__(self, srcs):
         fs = self._fs
         self._cnt, self._total = 1, len(srcs)
+        self._periods = self.batch_periods(srcs) if self._batch_ls else None
         srcs[fs.features_as_array_] = srcs.id.apply(self.extract)
-        del self._cnt, self._total
+        del self._cnt, self._total, self._periods
         return srcs
 
+    def resources(self):
+        """The observations, their index and their pawprints"""
+        obs = resource("observations") if self._obs is None else self._obs
+        index = resource("index") if self._index is None else self._index
+        pawprints = (
+            resource("pawprints") if self._pawprints is None
+            else self._pawprints)
+        return obs, index, pawprints
+
+    def batch_periods(self, srcs):
+        """The best frequency of all the sources computed in batch (sorted
+        by id)
+
+        """
+        if not len(srcs):
+            return None
+        obs, index, pawprints = self.resources()
+        src_ids = np.sort(srcs.id.values)
+
+        # the sources are sorted so their observations are only one slice
+        # of the sorted observations
+        rows, _ = lcindex.chunk(index, src_ids[0], src_ids[-1])
+        return batchls.from_observations(
+            lcschema.read_rows(obs, pawprints, index, rows), src_ids,
+            self._lscargle_kwds["autopower_kwds"])
+
+    def seed(self, src_id, time, mag, mag_err):
+        """Seed the batch best frequency of the source"""
+        periods = self._periods
+        pos = np.searchsorted(periods["id"], src_id)
+        if pos < len(periods) and periods["id"][pos] == src_id:
+            frequency = periods["frequency"][pos]
+            if np.isfinite(frequency):
+                feets_patch.seed(
+                    time, mag, mag_err, self._lscargle_kwds, frequency)
+
+    def read_observations(self, src_id):
+        """The observations of the source (sorted by time)"""
+        obs, index, pawprints = self.resources()
+        return lcschema.read_rows(
+            obs, pawprints, index, lcindex.source_slice(index, src_id),
+            LC_COLUMNS)
+
     def extract(self, src_id):
         print("!!! START:",  src_id)
         self._cnt += 1
 
-        fs, obs = self._fs, self._obs
-        src_obs = obs[obs["bm_src_id"] == src_id]
+        fs = self._fs
+        src_obs = self.read_observations(src_id)
 
         time = src_obs["pwp_stack_src_hjd"]
         mag = src_obs["pwp_stack_src_mag3"]
@@ -71,19 +191,22 @@ class Extractor(object):
             mag = np.delete(mag, to_remove)
             mag_err = np.delete(mag_err, to_remove)
 
-        sort_mask = time.argsort()
-        data = {
-            "magnitude": mag[sort_mask],
-            "time": time[sort_mask],
-            "error": mag_err[sort_mask]}
+        # the best frequency of the batched periodogram of the task
+        if self._periods is not None:
+            self.seed(src_id, time, mag, mag_err)
 
+        data = {"magnitude": mag, "time": time, "error": mag_err}
+
+        # the frequencies evaluated by the periodograms of the source
+        evaluated = feets_patch.Intermediates.total_frequencies
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             features, values = fs.extract(**data)
             result = dict(zip(features, values))
 
         series = pd.Series(result)
-        print("!!! END:",  src_id)
+        evaluated = feets_patch.Intermediates.total_frequencies - evaluated
+        print("!!! END:",  src_id, "- frequencies:", evaluated)
         return series
 
 # =============================================================================
@@ -98,7 +221,8 @@ class FeaturesExtractor(run.Step):
     model = LightCurves
     conditions = [
         model.tile.has(status="ready-to-extract-features"),
-        model.tile.has(ready=False)]
+        model.tile.has(ready=False),
+        model.segments == 0]
     groups = ["fe"]
 
     min_observation = conf.settings.get("FE_MIN_OBSERVATION", 30)
@@ -106,6 +230,10 @@ class FeaturesExtractor(run.Step):
     write_limit = conf.settings.get("FE_WRITE_LIMIT", 1000)
     mp_cores = conf.settings.get("FE_MP_CORES", CORES)
     mp_split = conf.settings.get("FE_MP_SPLIT", CORES)
+    broadcast_dir = conf.settings.get("BROADCAST_DIR", None)
+    batch_ls = conf.settings.get("FE_BATCH_LS", False)
+    ls_grid = conf.settings.get("FE_LS_GRID", "full")
+    ls_grid_kwds = conf.settings.get("FE_LS_GRID_KWDS", {})
 
     def setup(self):
         raise Exception("Add vs_catalog and version")
@@ -115,13 +243,25 @@ class FeaturesExtractor(run.Step):
         print("write_limit:", self.write_limit)
         print("mp_cores:", self.mp_cores)
         print("mp_split:", self.mp_split)
+        print("batch_ls:", self.batch_ls)
+        print("ls_grid:", self.ls_grid, self.ls_grid_kwds)
+
+        # the frequency grid of the periodograms
+        self.lscargle_kwds = dict(
+            feets_patch.LSCARGLE_KWDS,
+            grid=self.ls_grid, grid_kwds=self.ls_grid_kwds)
+        ls_kwargs = {
+            "lscargle_kwds": self.lscargle_kwds,
+            "batch": self.batch_ls}
+
         self.fs = feets.FeatureSpace(
             data=["magnitude", "time", "error"],
             exclude=["SlottedA_length",
                      "StetsonK_AC",
                      "StructureFunction_index_21",
                      "StructureFunction_index_31",
-                     "StructureFunction_index_32"])
+                     "StructureFunction_index_32"],
+            PeriodLS=ls_kwargs, Freq1_harmonics_amplitude_0=ls_kwargs)
 
     def get_cache_path(self, lc):
         """Return a cache directory for the given lightcurve"""
@@ -186,11 +326,13 @@ class FeaturesExtractor(run.Step):
         return sources
 
     def chunk_it(self, sources):
-        """Split the source in many parts to low the memory footprint in pandas
-        mp_apply
+        """Split the source (sorted by id) in many parts to low the memory
+        footprint of every task of the pool. The observations of every part
+        are a contiguous slice of the observations sorted by source.
 
         """
-        split_size = int(len(sources) / self.chunk_size)
+        sources = sources.sort_values("id")
+        split_size = max(int(len(sources) / self.chunk_size), 1)
         chunks = np.array_split(sources, split_size)
         return chunks
 
@@ -308,20 +450,13 @@ class FeaturesExtractor(run.Step):
             ("AmplitudeJK", ampJ - feats["Amplitude"])]
         return add_columns(feats, columns, append=True)
 
-    def add_ppmb(self, feats, sources, obs):
+    def add_ppmb(self, feats, sources, lc):
         feats_df = pd.DataFrame(feats[["id", "PeriodLS"]])
 
         sources = pd.DataFrame(sources[["id", "hjd_h", "hjd_j", "hjd_k"]])
         sources = sources[sources.id.isin(feats_df.id)]
 
-        obs = pd.DataFrame(
-            obs[["bm_src_id", "pwp_stack_src_mag3", 'pwp_stack_src_hjd']])
-        obs = obs[obs.bm_src_id.isin(feats_df.id)]
-        obs = obs.groupby("bm_src_id")
-        obs = obs.apply(
-            lambda g: g.sort_values(
-                "pwp_stack_src_mag3", ascending=False).head(1))
-        obs = obs[["bm_src_id", "pwp_stack_src_hjd"]]
+        obs = faintest_hjd(lc, feats_df.id.values)
         df = pd.merge(
             pd.merge(feats_df, sources, on="id"),
             obs, left_on="id", right_on="bm_src_id")
@@ -340,6 +475,31 @@ class FeaturesExtractor(run.Step):
         ]
         return add_columns(feats, columns, append=True)
 
+    def extract_chunks(self, lc, pool, chunks):
+        """Extract the features of every chunk of sources and store them
+        into the cache
+
+        """
+        chunkst = len(chunks)
+        features = None
+        for chunkn, sources in enumerate(chunks):
+            print("Chunk {}/{} START!".format(chunkn + 1, chunkst))
+
+            extractor = Extractor(
+                fs=self.fs, tile_name=lc.tile.name,
+                chunkn=chunkn + 1, chunkst=chunkst,
+                batch_ls=self.batch_ls, lscargle_kwds=self.lscargle_kwds)
+            result = pool.apply(sources, extractor, chunks=self.mp_split)
+            result = self.to_recarray(result)
+
+            if features is None:
+                features = result
+            else:
+                features = np.append(features, result)
+            features = self.to_cache(lc, features, force=True)
+
+        self.to_cache(lc, features, force=True)
+
     def process(self, lc):
         print("Selecting sources...")
         all_sources = self.get_sources(lc)
@@ -347,66 +507,49 @@ class FeaturesExtractor(run.Step):
         if len(all_sources) == 0:
             yield lc
 
-        observations = lc.observations
-
-        # chunk all the sources (the rename is for free memory
+        # chunk all the sources
         if len(all_sources):
-            all_obs = observations
-            all_obs = all_obs[np.in1d(all_obs["bm_src_id"], all_sources.id)]
+            # the observations stored by old versions are sorted by source
+            # here; the compact observations are keeped without decode
+            index = lc.build_observations_index()
+            observations = lc.stored_observations
+            pawprints = lc.pawprints
 
             chunks = self.chunk_it(all_sources)
-            chunkst = len(chunks)
 
             # free memory
             del all_sources
 
-            features = None
-            for chunkn, sources in enumerate(chunks):
-                print("Chunk {}/{} START!".format(chunkn + 1, chunkst))
-
-                print("Filtering observarions...")
-                obs = all_obs[np.in1d(all_obs["bm_src_id"], sources.id)]
-                all_obs = all_obs[~np.in1d(all_obs["bm_src_id"], sources.id)]
-
-                extractor = Extractor(
-                    fs=self.fs, obs=obs, tile_name=lc.tile.name,
-                    chunkn=chunkn + 1, chunkst=chunkst)
-                result = mp_apply(
-                    sources, extractor, procs=self.mp_cores,
-                    chunks=self.mp_split)
-                result = self.to_recarray(result)
-
-                if features is None:
-                    features = result
-                else:
-                    features = np.append(features, result)
-                features = self.to_cache(lc, features, force=True)
-
-            self.to_cache(lc, features, force=True)
-            del features
-        else:
-            all_obs = []
+            # the observations are attached only once by every worker of
+            # the pool, so the tasks only carry the sources
+            with Broadcast(self.broadcast_dir) as bcast:
+                resources = {
+                    "observations": bcast.publish(observations),
+                    "index": bcast.publish(index),
+                    "pawprints": pawprints}
+                with WorkerPool(self.mp_cores, resources) as pool:
+                    self.extract_chunks(lc, pool, chunks)
+                print(bcast.report())
 
-        if len(all_obs) == 0:
-            sources = lc.tile.load_npy_file()
+        sources = lc.tile.load_npy_file()
 
-            print("Combining cache")
-            feats = self.combine_cache(lc)
+        print("Combining cache")
+        feats = self.combine_cache(lc)
 
-            print("Adding First-Epoch Colors")
-            feats = self.add_color(feats, sources)
+        print("Adding First-Epoch Colors")
+        feats = self.add_color(feats, sources)
 
-            print("Adding Stellar Classes")
-            feats = self.add_stellar_classes(feats, sources)
+        print("Adding Stellar Classes")
+        feats = self.add_stellar_classes(feats, sources)
 
-            print("Adding Pseudo Colors and Amplitudes")
-            feats = self.add_pseudo_colors_and_amplitude(feats, sources)
+        print("Adding Pseudo Colors and Amplitudes")
+        feats = self.add_pseudo_colors_and_amplitude(feats, sources)
 
-            print("Adding Multi-Band Pseudo-Phases")
-            feats = self.add_ppmb(feats, sources, observations)
+        print("Adding Multi-Band Pseudo-Phases")
+        feats = self.add_ppmb(feats, sources, lc)
 
-            print("Saving")
-            lc.features = feats
+        print("Saving")
+        lc.features = feats
 
         lc.tile.ready = True
         self.session.commit()
@@ -5,15 +5,17 @@
 # IMPORTS
 # =============================================================================
 
-from corral import run
+from corral import run, conf
 
 import numpy as np
 
+import joblib
 from joblib import Parallel, delayed, cpu_count
 
 from ..lib import matcher
+from ..lib.broadcast import Broadcast
 
-from ..models import PawprintStackXTile
+from ..models import Tile, PawprintStackXTile
 
 # =============================================================================
 # FUNCTIONS
@@ -21,53 +23,93 @@ from ..models import PawprintStackXTile
 
 CPUS = cpu_count()
 
+#: The KD-tree of the tile already loaded by this (worker) process
+_TREES = {}
 
-def iter_matchs(tile_name, tile_id, pawprint_stack_id, band,
-                tile_data, pwp_data, tile_ra, tile_dec, pwp_ra, pwp_dec):
-    matchs = matcher.matchs(tile_ra, pwp_ra, tile_dec, pwp_dec)
-    for idx_ms, idx_pwp in matchs:
-        pwp_src = pwp_data[idx_pwp]
-        ms = tile_data[idx_ms]
-        row = tuple(
-            [tile_name, tile_id] +
-            [ms[n] for n in tile_data.dtype.names] +
-            [pawprint_stack_id, band] +
-            [pwp_src[n] for n in pwp_data.dtype.names])
-        yield row
-
-
-def match(
-    pxt_id, tile_name, tile_id,
-    pawprint_stack_id, band, tile_data, pwp_path
-):
-    pwp_data = np.load(pwp_path)
 
-    # create dtype
-    dtype = {
-        "names": (
-            ["tile_name", "tile_id"] +
-            ["bm_src_{}".format(n) for n in tile_data.dtype.names] +
-            ["pwp_stack_id", "pwp_stack_band"] +
-            ["pwp_stack_src_{}".format(n) for n in pwp_data.dtype.names]),
-        "formats": (
-            ["|S10", int] + [e[-1] for e in tile_data.dtype.descr] +
-            [int, "|S10"] + [e[-1] for e in pwp_data.dtype.descr])
-    }
+def load_tree(index_path):
+    """Load the KD-tree of a tile stored in ``index_path`` (see
+    `carpyncho.models.Tile.store_index`) only once by process. Only the
+    arrays of the tree are memory mapped, the node buffer is readed in
+    memory, so the tree is never sended to the workers.
+
+    """
+    if index_path not in _TREES:
+        _TREES.clear()
+        _TREES[index_path] = joblib.load(index_path, mmap_mode="r")
+    return _TREES[index_path]
+
+
+def build_matchs(tile_data, pwp_data, idx_ms, idx_pwp):
+    """Create the array of matches with only the pairs of rows and the
+    columns needed by the light curves
+
+    """
+    arr = np.empty(len(idx_ms), dtype=PawprintStackXTile.MATCH_DTYPE)
+
+    arr["bm_src_idx"] = idx_ms
+    arr["bm_src_id"] = tile_data["id"][idx_ms]
+
+    arr["pwp_stack_src_idx"] = idx_pwp
+    arr["pwp_stack_src_id"] = pwp_data["id"][idx_pwp]
+    arr["pwp_stack_src_hjd"] = pwp_data["hjd"][idx_pwp]
+    arr["pwp_stack_src_mag3"] = pwp_data["mag3"][idx_pwp]
+    arr["pwp_stack_src_mag_err3"] = pwp_data["mag_err3"][idx_pwp]
+
+    return arr
+
+
+def match(pxt_id, tile_data, index_path, pwp_path):
+    tile_tree = load_tree(index_path)
+    pwp_data = np.load(pwp_path)
 
     pwp_ra, pwp_dec = pwp_data["ra_deg"], pwp_data["dec_deg"]
     tile_ra, tile_dec = tile_data["ra_k"], tile_data["dec_k"]
 
-    matchs = iter_matchs(
-        tile_name=tile_name, tile_id=tile_id,
-        pawprint_stack_id=pawprint_stack_id, band=band,
+    idx_ms, idx_pwp = matcher.matchs(
+        tile_ra, pwp_ra, tile_dec, pwp_dec, tree0=tile_tree)
+
+    arr = build_matchs(
         tile_data=tile_data, pwp_data=pwp_data,
-        tile_ra=tile_ra, tile_dec=tile_dec,
-        pwp_ra=pwp_ra, pwp_dec=pwp_dec)
+        idx_ms=idx_ms, idx_pwp=idx_pwp)
 
-    arr = np.fromiter(matchs, dtype=dtype)
     return arr, pxt_id
 
 
+def batch_match(tile_data, tile_tree, pwp_paths):
+    """Match all the given pawprint stacks against the tile in a single
+    pass, and return a list with the array of matches of every pawprint.
+
+    """
+    pwps = [np.load(path, mmap_mode="r") for path in pwp_paths]
+    sizes = np.array([len(pwp_data) for pwp_data in pwps])
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+    # all the detections with the number of the pawprint as label
+    labels = np.repeat(np.arange(len(pwps)), sizes)
+    pwp_ra = np.concatenate([pwp_data["ra_deg"] for pwp_data in pwps])
+    pwp_dec = np.concatenate([pwp_data["dec_deg"] for pwp_data in pwps])
+    tile_ra, tile_dec = tile_data["ra_k"], tile_data["dec_k"]
+
+    idx_ms, idx_all = matcher.batch_matchs(
+        tile_ra, pwp_ra, tile_dec, pwp_dec, labels,
+        tree0=tile_tree, n_jobs=CPUS)
+
+    # the pairs are sorted by the concatenated index, so every pawprint
+    # has a contiguous range of pairs
+    bounds = np.searchsorted(idx_all, offsets)
+
+    matches = []
+    for pidx, pwp_data in enumerate(pwps):
+        start, end = bounds[pidx], bounds[pidx + 1]
+        arr = build_matchs(
+            tile_data=tile_data, pwp_data=pwp_data,
+            idx_ms=idx_ms[start:end],
+            idx_pwp=idx_all[start:end] - offsets[pidx])
+        matches.append(arr)
+    return matches
+
+
 # =============================================================================
 # STEP
 # =============================================================================
@@ -82,50 +124,109 @@ class Match(run.Step):
     groups = ["match"]
     production_procno = 1
 
-    def generate(self):
-        query = super(Match, self).generate()
-        models = list(query)
-        number = int(len(models) / CPUS) or 1
-        return iter(np.array_split(models, number))
-
-    def validate(self, chunk):
-        return isinstance(chunk, np.ndarray)
+    broadcast_dir = conf.settings.get("BROADCAST_DIR", None)
 
-    def read_arrs(self, chunk):
-        tile_buff, reads = {}, []
-        for pxt in chunk:
+    # match all the pawprints of a tile with one query instead of one joblib
+    # task by pawprint, MATCH_BATCH_SIZE pawprints at time
+    batch = conf.settings.get("MATCH_BATCH", True)
+    batch_size = conf.settings.get("MATCH_BATCH_SIZE", 64)
 
-            if pxt.tile.name not in tile_buff:
-                print("Reading {}...".format(pxt.tile))
-                tile_buff[pxt.tile.name] = pxt.tile.load_npy_file()
+    def generate(self):
+        """Group all the pending pxts by tile and sort the groups by the
+        size of the tile (the biggest first), so every tile is read only
+        once and the longest tasks are not left to the end of the run.
 
+        """
+        query = super(Match, self).generate()
+        groups = {}
+        for pxt in query:
+            groups.setdefault(pxt.tile_id, []).append(pxt)
+        groups = sorted(
+            groups.values(), key=lambda pxts: pxts[0].tile.size or 0,
+            reverse=True)
+        for pxts in groups:
+            yield pxts[0].tile, pxts
+
+    def validate(self, generated):
+        if isinstance(generated, PawprintStackXTile):
+            return True
+        tile, pxts = generated
+        return isinstance(tile, Tile) and isinstance(pxts, list)
+
+    def read_arrs(self, tile, pxts, bcast):
+        print("Reading {}...".format(tile))
+        tile_data = bcast.publish(tile.load_npy_file())
+
+        # the index is created if not exists, and every worker loads the
+        # tree from their file only once
+        tile.load_index()
+        reads = []
+        for pxt in pxts:
             reads.append({
                 "pxt_id": pxt.id,
-                "tile_name": pxt.tile.name,
-                "tile_id": pxt.tile.id,
-                "pawprint_stack_id": pxt.pawprint_stack.id,
-                "band": pxt.pawprint_stack.band,
-                "tile_data": tile_buff[pxt.tile.name],
+                "tile_data": tile_data,
+                "index_path": tile.index_file_path,
                 "pwp_path":  pxt.pawprint_stack.npy_file_path})
         return reads
 
-    def process(self, chunk):
-        chunk_arrs = self.read_arrs(chunk)
-        with Parallel(n_jobs=CPUS) as jobs:
-            matches = jobs(delayed(match)(**arrs) for arrs in chunk_arrs)
-        if len(chunk) != len(matches):
-            raise ValueError("We have {} chunks but {} matches".format(
-                len(chunk), len(matches)))
-
-        for pxt, mtch in zip(chunk, matches):
-            arr, pxt_id = mtch
-            if pxt.id != pxt_id:
-                raise ValueError("Pxt ID is {} but array ID is {}".format(
-                    pxt.id, pxt_id))
-
-            pxt.matched_number = len(arr)
-            pxt.store_npy_file(arr)
-            pxt.status = "matched"
-            yield pxt
-
-        self.session.commit()
+    def batch_matchs(self, tile, pxts):
+        print("Reading {}...".format(tile))
+        tile_data = tile.load_npy_file()
+        tile_tree = tile.load_index()
+
+        number = int(np.ceil(len(pxts) / float(self.batch_size))) or 1
+        for part in np.array_split(np.arange(len(pxts)), number):
+            chunk = [pxts[idx] for idx in part]
+            paths = [pxt.pawprint_stack.npy_file_path for pxt in chunk]
+            yield chunk, batch_match(tile_data, tile_tree, paths)
+
+    def parallel_matchs(self, tile, pxts):
+        # the tile array is published only once for all the workers
+        with Broadcast(self.broadcast_dir) as bcast:
+            tile_arrs = self.read_arrs(tile, pxts, bcast)
+
+            # the pawprints of the tile are spreaded between all the workers
+            # in parts of CPUS size
+            number = int(len(pxts) / CPUS) or 1
+            parts = np.array_split(np.arange(len(pxts)), number)
+
+            with Parallel(n_jobs=CPUS) as jobs:
+                for part in parts:
+                    chunk = [pxts[idx] for idx in part]
+                    matches = jobs(
+                        delayed(match)(**tile_arrs[idx]) for idx in part)
+
+                    arrs = []
+                    for pxt, mtch in zip(chunk, matches):
+                        arr, pxt_id = mtch
+                        if pxt.id != pxt_id:
+                            raise ValueError(
+                                "Pxt ID is {} but array ID is {}".format(
+                                    pxt.id, pxt_id))
+                        arrs.append(arr)
+                    yield chunk, arrs
+
+            print(bcast.report())
+
+    def process(self, generated):
+        tile, pxts = generated
+
+        results = (
+            self.batch_matchs(tile, pxts) if self.batch else
+            self.parallel_matchs(tile, pxts))
+
+        # the results of every part are stored before continue with the
+        # next one
+        for chunk, matches in results:
+            if len(chunk) != len(matches):
+                raise ValueError(
+                    "We have {} chunks but {} matches".format(
+                        len(chunk), len(matches)))
+
+            for pxt, arr in zip(chunk, matches):
+                pxt.matched_number = len(arr)
+                pxt.store_npy_file(arr)
+                pxt.status = "matched"
+                yield pxt
+
+            self.session.commit()
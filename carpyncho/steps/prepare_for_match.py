@@ -7,7 +7,7 @@
 
 from corral import run
 
-from ..models import PawprintStackXTile
+from ..models import Tile, PawprintStackXTile
 
 
 # =============================================================================
@@ -16,14 +16,18 @@ from ..models import PawprintStackXTile
 
 class PrepareForMatch(run.Step):
     """If the status of tile and a linked pawprint-stack are ready-match
-    set the link as ready-to-match
+    set the link as ready-to-match.
+
+    The tiles with light curves also accepts new pawprint-stacks, that are
+    appended to the light curves.
 
     """
 
     model = PawprintStackXTile
     conditions = [
         model.status == "raw",
-        model.tile.has(status="ready-to-match"),
+        model.tile.has(Tile.status.in_(
+            ["ready-to-match", "ready-to-extract-features"])),
         model.pawprint_stack.has(status="ready-to-match")]
     groups = ["preprocess", "preparation"]
     production_procno = 1
@@ -110,7 +110,7 @@ class ReadTile(run.Step):
             oarr, size = self.read_dat(fp)
         arr = self.add_columns(oarr, tile)
 
-        tile.store_npy_file(arr)
+        tile.store_npy_file(arr, index=True)
         tile.size = len(arr)
         tile.status = "ready-to-tag"
 
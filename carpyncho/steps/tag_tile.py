@@ -28,14 +28,6 @@ class VSTagTile(run.Step):
     groups = ["preprocess", "tag"]
     production_procno = 1
 
-    def setup(self):
-        df = bin.catalogs.load()
-        self.vs_id = df.ID.values
-        self.vs_cls = df.cls.values
-        self.vs_ra = df.ra.values
-        self.vs_dec = df.dec.values
-        self.vs_catalog = df.catalog.values
-
     def add_columns(self, tile_data):
         # create dtype
         dtype = {
@@ -70,17 +62,18 @@ class VSTagTile(run.Step):
 
         tile_ra, tile_dec = tile_data["ra_k"], tile_data["dec_k"]
 
-        matchs = matcher.matchs(tile_ra, self.vs_ra, tile_dec, self.vs_dec)
-        tile_idxs, vs_idxs = [], []
+        # only the variable stars near the tile can be matched
+        vs = bin.catalogs.load_footprint(
+            tile_ra, tile_dec, pad=matcher.MAX_MATCH)
 
-        for tile_idx, vs_idx in matchs:
-            tile_idxs.append(tile_idx)
-            vs_idxs.append(vs_idx)
+        tile_idxs, vs_idxs = matcher.matchs(
+            tile_ra, vs["ra"], tile_dec, vs["dec"],
+            tree0=tile.load_index())
 
-        if tile_idxs:
-            tile_data["vs_id"][tile_idxs] = self.vs_id[vs_idxs]
-            tile_data["vs_type"][tile_idxs] = self.vs_cls[vs_idxs]
-            tile_data["vs_catalog"][tile_idxs] = self.vs_catalog[vs_idxs]
+        if len(tile_idxs):
+            tile_data["vs_id"][tile_idxs] = vs["ID"][vs_idxs]
+            tile_data["vs_type"][tile_idxs] = vs["cls"][vs_idxs]
+            tile_data["vs_catalog"][tile_idxs] = vs["catalog"][vs_idxs]
 
         tile.store_npy_file(tile_data)
         tile.ogle3_tagged_number = len(tile_idxs)
@@ -183,7 +183,7 @@ class Unred(run.Step):
         sources = tile.load_npy_file()
         sources = self.unred(tile, sources)
         sources = self.vvv_colors(sources)
-        tile.store_npy_file(sources)
+        tile.store_npy_file(sources, index=True)
         tile.status = "ready-to-match"
         yield tile
         self.session.commit()
@@ -20,10 +20,21 @@
 import tempfile
 import os
 import shutil
+import unittest
+import warnings
+import pickle
 import sh
 
+import mock
+
+import joblib
+
+import six
+
 import numpy as np
 
+import pandas as pd
+
 from corral import qa, conf
 
 from . import models
@@ -34,14 +45,21 @@ from .steps.tag_tile import VSTagTile
 from .steps.unred import Unred
 from .steps.read_pawprint_stack import ReadPawprintStack
 from .steps.prepare_for_match import PrepareForMatch
-from .steps.match import Match
+from .steps.match import Match, load_tree
 from .steps.create_lc import CreateLightCurves
-from .steps.features_extractor import FeaturesExtractor
+from .steps.compact_lc import CompactLightCurves
+from .steps.features_extractor import FeaturesExtractor, Extractor
 
 from .commands import (
     Paths, BuildBin, LSTile, LSPawprint, LSSync, SetTileStatus, SampleFeatures)
 
 from .lib.beamc import add_columns
+from .lib import matcher, zones, lcindex, lcstorage, lcschema, zonemap
+from .lib.broadcast import Broadcast
+from .lib.lru import LRUCache
+from .lib import feets_patch, batchls, mppandas
+from . import api
+from .bin import catalogs
 
 
 # =============================================================================
@@ -160,6 +178,9 @@ class ReadTileTestCase(CarpynchoTestMixin, qa.TestCase):
             self.assertIn(name, arr.dtype.names)
         self.assertEquals(tile.status, "ready-to-tag")
 
+        tree = tile.load_index()
+        self.assertEquals(tree.n, len(arr))
+
 
 class VSTagTileTestCase(CarpynchoTestMixin, qa.TestCase):
 
@@ -271,6 +292,13 @@ class MatchTestCase(CarpynchoTestMixin, qa.TestCase):
     def validate(self):
         pxt = self.session.query(models.PawprintStackXTile).one()
         arr = pxt.load_npy_file()
+        names = (
+            'bm_src_idx', 'bm_src_id', 'pwp_stack_src_idx',
+            'pwp_stack_src_id', 'pwp_stack_src_hjd', 'pwp_stack_src_mag3',
+            'pwp_stack_src_mag_err3')
+        self.assertEquals(arr.dtype.names, names)
+
+        arr = pxt.load_npy_file(join=True)
         names = (
             'tile_name', 'tile_id', 'bm_src_id', 'bm_src_hjd_h',
             'bm_src_hjd_j', 'bm_src_hjd_k', 'bm_src_ra_h', 'bm_src_dec_h',
@@ -322,9 +350,175 @@ class CreateLightCurvesTestCase(CarpynchoTestMixin, qa.TestCase):
         self.patch(
             "carpyncho.models.psxt.PawprintStackXTile.npy_file_path", arr_path)
 
+        arr_path = os.path.join(self.test_cache, "tile_ready-to-match.npy")
+        self.patch(
+            "carpyncho.models.tile.Tile.npy_file_path", arr_path)
+
+    def validate(self):
+        self.assertStreamCount(1, models.LightCurves)
+
+        lc = self.session.query(models.LightCurves).one()
+        obs, index = lc.observations, lc.observations_index
+        self.assertEqual(obs.dtype, np.dtype(lcschema.OBS_DTYPE))
+        self.assertEqual(len(lc.pawprints), 1)
+        self.assertEqual(
+            lc.pawprints["hjd_base"][0],
+            lcschema.hjd_base(obs["pwp_stack_src_hjd"]))
+        np.testing.assert_array_equal(
+            lc.get_observations(["bm_src_id", "pwp_stack_src_hjd"]),
+            obs[["bm_src_id", "pwp_stack_src_hjd"]])
+        self.assertTrue(lcindex.is_sorted(obs))
+        self.assertEqual(index["cnt"].sum(), len(obs))
+        np.testing.assert_array_equal(lc.obs_counter["id"], index["id"])
+        np.testing.assert_array_equal(lc.obs_counter["cnt"], index["cnt"])
+        for src_id in index["id"][:10]:
+            np.testing.assert_array_equal(
+                lc.source_observations(src_id),
+                obs[obs["bm_src_id"] == src_id])
+
+
+class LightCurvesReaderTestCase(CreateLightCurvesTestCase):
+
+    def validate(self):
+        lc = self.session.query(models.LightCurves).one()
+        obs, index = lc.observations, lc.observations_index
+
+        src_ids = list(index["id"][:2])
+        missing = int(index["id"][-1]) + 1
+        other_tile = 40010000000130 if lc.tile.name[0] == "b" else (
+            30010000000130)
+
+        reader = api.LightCurvesReader(self.session)
+        lcs = reader.light_curves(src_ids + [missing, other_tile])
+        self.assertEqual(list(lcs), src_ids + [missing, other_tile])
+        for src_id in src_ids:
+            np.testing.assert_array_equal(
+                lcs[src_id], obs[obs["bm_src_id"] == src_id])
+        self.assertEqual(len(lcs[missing]), 0)
+        self.assertIsNone(lcs[other_tile])
+
+        # the cached sources don't touch the database
+        with mock.patch.object(api.LightCurvesReader, "get_lcurves") as get:
+            np.testing.assert_array_equal(
+                reader.light_curve(src_ids[0], columns="pwp_stack_src_hjd"),
+                lcs[src_ids[0]]["pwp_stack_src_hjd"])
+            self.assertFalse(get.called)
+
+        # only the last source fits in the cache
+        max_bytes = max(lcs[src_id].nbytes for src_id in src_ids)
+        reader = api.LightCurvesReader(self.session, max_bytes=max_bytes)
+        for src_id in src_ids:
+            reader.light_curve(src_id)
+        self.assertNotIn(("obs", src_ids[0]), reader.cache)
+        self.assertIn(("obs", src_ids[1]), reader.cache)
+
+        # the observations of segments not compacted are not readed
+        lc.segments = 1
+        reader = api.LightCurvesReader(self.session)
+        with warnings.catch_warnings(record=True) as record:
+            warnings.simplefilter("always")
+            reader.light_curves(src_ids)
+        self.assertEqual(len(record), 1)
+        self.assertIn(lc.tile.name, str(record[0].message))
+
+
+class CreateLightCurvesAppendTestCase(CarpynchoTestMixin, qa.TestCase):
+
+    run_before = [LoaderTestCase]
+    subject = CreateLightCurves
+
+    def setup(self):
+        super(CreateLightCurvesAppendTestCase, self).setup()
+
+        pxt = self.session.query(models.PawprintStackXTile).one()
+        pxt.status = "matched"
+        pxt.tile.status = "ready-to-extract-features"
+
+        # the tile already has light curves and features
+        self.obs = np.load(os.path.join(self.test_cache, "observations.npy"))
+        lc = models.LightCurves(tile=pxt.tile)
+        lc.observations = self.obs
+        pxt.tile.ready = True
+
+        self.save(lc)
+        self.save(pxt)
+
+        arr_path = os.path.join(self.test_cache, "matched.npy")
+        self.matched = np.load(arr_path)
+        self.patch(
+            "carpyncho.models.psxt.PawprintStackXTile.npy_file_path", arr_path)
+
+        arr_path = os.path.join(self.test_cache, "tile_ready-to-match.npy")
+        self.patch(
+            "carpyncho.models.tile.Tile.npy_file_path", arr_path)
+
     def validate(self):
         self.assertStreamCount(1, models.LightCurves)
 
+        pxt = self.session.query(models.PawprintStackXTile).one()
+        self.assertEqual(pxt.lcurve_segment, 0)
+        self.assertFalse(pxt.tile.ready)
+        self.assertEqual(pxt.tile.status, "ready-to-extract-features")
+
+        # the new observations are only in the segment
+        lc = pxt.tile.lcurves
+        self.assertEqual(lc.segments, 1)
+        self.assertEqual(len(lc.observations), len(self.obs))
+        paths = lc._segments_paths
+        self.assertEqual(len(paths), 1)
+
+        segment = np.load(paths[0])
+        self.assertEqual(segment.dtype, np.dtype(lcschema.OBS_DTYPE))
+        self.assertEqual(len(segment), len(self.matched))
+        self.assertTrue(lcindex.is_sorted(segment))
+        np.testing.assert_array_equal(
+            np.sort(segment["pwp_stack_src_id"]),
+            np.sort(self.matched["pwp_stack_src_id"]))
+
+        # and the counter has the observations of both
+        ids, cnts = np.unique(np.concatenate((
+            self.obs["bm_src_id"], segment["bm_src_id"])),
+            return_counts=True)
+        counter = np.sort(lc.obs_counter, order="id")
+        np.testing.assert_array_equal(counter["id"], ids)
+        np.testing.assert_array_equal(counter["cnt"], cnts)
+
+
+class CompactLightCurvesTestCase(CarpynchoTestMixin, qa.TestCase):
+
+    run_before = [LoaderTestCase]
+    subject = CompactLightCurves
+
+    def setup(self):
+        super(CompactLightCurvesTestCase, self).setup()
+
+        arr_path = os.path.join(self.test_cache, "observations.npy")
+        self.obs = np.load(arr_path)
+        half = int(len(self.obs) / 2)
+
+        tile = self.session.query(models.Tile).one()
+        tile.status = "ready-to-extract-features"
+
+        lc = models.LightCurves(tile=tile)
+        lc.observations = self.obs[:half]
+        lc.append_segment(self.obs[half:], 1)
+
+        self.save(lc)
+        self.save(tile)
+
+    def validate(self):
+        lc = self.session.query(models.LightCurves).one()
+        self.assertEqual(lc.segments, 0)
+
+        obs = lc.observations
+        self.assertEqual(len(obs), len(self.obs))
+        self.assertTrue(lcindex.is_sorted(obs))
+
+        ids, cnts = np.unique(self.obs["bm_src_id"], return_counts=True)
+        cnt = np.sort(lc.obs_counter, order="id")
+        np.testing.assert_array_equal(cnt["id"], ids)
+        np.testing.assert_array_equal(cnt["cnt"], cnts)
+
 
 class FeaturesExtractorTestCase(CarpynchoTestMixin, qa.TestCase):
 
@@ -353,13 +547,12 @@ class FeaturesExtractorTestCase(CarpynchoTestMixin, qa.TestCase):
 
         arr_path = os.path.join(self.test_cache, "observations.npy")
         arr = np.load(arr_path)
-        self.patch(
-            "carpyncho.models.tile.LightCurves.observations", arr)
 
         tile = self.session.query(models.Tile).one()
         tile.status = "ready-to-extract-features"
 
         lc = models.LightCurves(tile=tile)
+        lc.observations = arr
         ids = self.sample_with_min_obs(arr["bm_src_id"])
         lc._set_cnt(ids)
 
@@ -466,16 +659,62 @@ class SampleFeaturesTestCase(CarpynchoTestMixin, qa.TestCase):
 
         arr_path = os.path.join(self.test_cache, "features.npy")
         arr = np.load(arr_path)
-        self.patch(
-            "carpyncho.models.tile.LightCurves.features", arr)
 
         tile = self.session.query(models.Tile).one()
 
         lc = models.LightCurves(tile=tile)
+        lc.features = arr
+
+        self.save(lc)
+        self.save(tile)
+
+        self.patch("pandas.DataFrame.to_pickle")
+
+    def validate(self):
+        self.assertEquals(self.command_status.exit_status, 0)
+
+        import pandas as pd  # noqa
+        pd.DataFrame.to_pickle.assert_called_once_with("salida.pkl")
+
+
+def _haversine(ra0, dec0, ra1, dec1):
+    """Angular separation in degrees of the coordinates (in degrees)"""
+    ra0, dec0, ra1, dec1 = map(np.radians, (ra0, dec0, ra1, dec1))
+    hav = (
+        np.sin((dec0 - dec1) / 2) ** 2 +
+        np.cos(dec0) * np.cos(dec1) * np.sin((ra0 - ra1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(hav)))
+
+
+class SampleFeaturesConeSearchTestCase(CarpynchoTestMixin, qa.TestCase):
+
+    run_before = [LoaderTestCase]
+    subject = SampleFeatures
+
+    def setup(self):
+        super(SampleFeaturesConeSearchTestCase, self).setup()
+
+        arr_path = os.path.join(self.test_cache, "features.npy")
+        arr = np.load(arr_path)
+
+        tile = self.session.query(models.Tile).one()
+
+        lc = models.LightCurves(tile=tile)
+        lc.features = arr
 
         self.save(lc)
         self.save(tile)
 
+        # a cone around the first source with half of the sources inside
+        ra, dec = arr["ra_k"].astype(float), arr["dec_k"].astype(float)
+        distances = np.sort(_haversine(ra[0], dec[0], ra, dec))
+        half = len(distances) // 2
+        self.cone = (
+            ra[0], dec[0], (distances[half] + distances[half + 1]) / 2.)
+
+        self.cliargs.extend(["-o", "salida.pkl", "-u", "ALL", "-cs"])
+        self.cliargs.extend(map(repr, self.cone))
+
         self.patch("pandas.DataFrame.to_pickle")
 
     def validate(self):
@@ -483,3 +722,859 @@ class SampleFeaturesTestCase(CarpynchoTestMixin, qa.TestCase):
 
         import pandas as pd  # noqa
         pd.DataFrame.to_pickle.assert_called_once_with("salida.pkl")
+
+        ra, dec, radius = self.cone
+        lc = self.session.query(models.LightCurves).one()
+
+        feats = lc.get_features(["ra_k", "dec_k"])
+        distances = _haversine(
+            ra, dec, feats["ra_k"].astype(float), feats["dec_k"].astype(float))
+        expected = feats[distances <= radius]
+
+        found = lc.cone_search(ra=ra, dec=dec, radius=radius)
+        self.assertEqual(len(found), len(feats) // 2 + 1)
+        for column in ("ra_k", "dec_k"):
+            np.testing.assert_array_equal(found[column], expected[column])
+
+        # the oposite side of the sky is outside the footprint of the tile
+        self.assertTrue(lc.touches_cone(ra=ra, dec=dec, radius=radius))
+        self.assertFalse(lc.touches_cone(
+            ra=np.mod(ra + 180., 360.), dec=-dec, radius=radius))
+
+
+# =============================================================================
+# LIB TESTS
+# =============================================================================
+
+class MatcherTestCase(unittest.TestCase):
+
+    def brute_force_matchs(self, ra0, ra1, dec0, dec1, eps):
+        # the haversine angular separation of every pair of sources
+        sep = _haversine(
+            ra0[:, None], dec0[:, None], ra1[None, :], dec1[None, :])
+
+        nearestind1, nearestind0 = sep.argmin(axis=1), sep.argmin(axis=0)
+        for idx1, idx0 in enumerate(nearestind0):
+            if sep[idx0, idx1] <= eps and nearestind1[idx0] == idx1:
+                yield idx0, idx1
+
+    def test_same_pairs_as_brute_force(self):
+        random = np.random.RandomState(42)
+        size, noise = 2000, 1e-4
+
+        ra0 = 266. + random.rand(size) * 0.1
+        dec0 = -29. + random.rand(size) * 0.1
+
+        # the first 80% are the same sources with some noise
+        shared = int(size * .8)
+        ra1 = np.concatenate((
+            ra0[:shared] + random.randn(shared) * noise,
+            266. + random.rand(size - shared) * 0.1))
+        dec1 = np.concatenate((
+            dec0[:shared] + random.randn(shared) * noise,
+            -29. + random.rand(size - shared) * 0.1))
+
+        expected = list(self.brute_force_matchs(
+            ra0, ra1, dec0, dec1, eps=matcher.MAX_MATCH))
+        idx0, idx1 = matcher.matchs(ra0, ra1, dec0, dec1)
+
+        self.assertTrue(len(expected))
+        self.assertEqual(expected, list(zip(idx0, idx1)))
+
+    def test_batch_matchs(self):
+        random = np.random.RandomState(42)
+        size, noise = 5000, 1e-4
+
+        ra0 = 266. + random.rand(size) * 0.1
+        dec0 = -29. + random.rand(size) * 0.1
+
+        catalogs = []
+        for _ in range(5):
+            idxs = random.choice(size, random.randint(1000, size), False)
+            catalogs.append((
+                ra0[idxs] + random.randn(len(idxs)) * noise,
+                dec0[idxs] + random.randn(len(idxs)) * noise))
+        sizes = [len(ra1) for ra1, _ in catalogs]
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+        idx0, idx1 = matcher.batch_matchs(
+            ra0, np.concatenate([ra1 for ra1, _ in catalogs]),
+            dec0, np.concatenate([dec1 for _, dec1 in catalogs]),
+            np.repeat(np.arange(len(catalogs)), sizes))
+
+        for label, (ra1, dec1) in enumerate(catalogs):
+            mask = (idx1 >= offsets[label]) & (idx1 < offsets[label + 1])
+            expected0, expected1 = matcher.matchs(ra0, ra1, dec0, dec1)
+            np.testing.assert_array_equal(idx0[mask], expected0)
+            np.testing.assert_array_equal(
+                idx1[mask] - offsets[label], expected1)
+
+
+class LoadTreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp("carpyncho_tree_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_load_once(self):
+        random = np.random.RandomState(42)
+        ra, dec = random.rand(1000), random.rand(1000)
+        index_path = os.path.join(self.path, "skyidx.pkl")
+        joblib.dump(matcher.build_tree(ra, dec), index_path)
+
+        tree = load_tree(index_path)
+        self.assertIs(load_tree(index_path), tree)
+        np.testing.assert_array_equal(tree.data, matcher.to_xyz(ra, dec))
+        np.testing.assert_array_equal(
+            matcher.nearest(tree, ra, dec), np.arange(len(ra)))
+
+
+class BroadcastTestCase(unittest.TestCase):
+
+    def test_publish(self):
+        arr = np.zeros(100000, dtype=[("id", np.int64), ("mag", float)])
+        arr["id"] = np.arange(len(arr))
+
+        with Broadcast() as bcast:
+            shared = bcast.publish(arr)
+            dumped = pickle.dumps(shared, 2)
+            self.assertLess(len(dumped), 1000)
+
+            loaded = pickle.loads(dumped)
+            np.testing.assert_array_equal(loaded, arr)
+
+            # a view is copied as a regular array
+            column = pickle.loads(pickle.dumps(shared["id"], 2))
+            np.testing.assert_array_equal(column, arr["id"])
+
+        self.assertEqual(bcast.published, 1)
+        self.assertEqual(bcast.saved, arr.nbytes)
+
+
+def _double_idx(df):
+    return df * 2
+
+
+def _take_resource(df):
+    df = df.copy()
+    df["value"] = mppandas.resource("values")[df.idx.values]
+    return df
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+
+    def test_apply(self):
+        values = np.arange(1000) * 2.
+        df = pd.DataFrame({"idx": np.arange(0, 1000, 7)})
+
+        with Broadcast() as bcast:
+            resources = {"values": bcast.publish(values)}
+            with mppandas.WorkerPool(2, resources) as pool:
+                # the same pool is used by many calls
+                for chunks in (2, 5):
+                    result = pool.apply(df, _take_resource, chunks=chunks)
+                    np.testing.assert_array_equal(
+                        result.value.values, values[df.idx.values])
+
+        with self.assertRaises(RuntimeError):
+            pool.apply(df, _take_resource)
+
+    def test_mp_apply(self):
+        df = pd.DataFrame({"idx": np.arange(100)})
+        result = mppandas.mp_apply(df, _double_idx, procs=2, chunks=3)
+        np.testing.assert_array_equal(result.idx.values, df.idx.values * 2)
+
+
+class ZonesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        size = 100000
+        ra = random.rand(size) * 360.
+        dec = np.degrees(np.arcsin(random.rand(size) * 2. - 1.))
+
+        order, self.offsets = zones.build(ra, dec)
+        self.catalog = np.empty(size, dtype=[("ra", float), ("dec", float)])
+        self.catalog["ra"], self.catalog["dec"] = ra[order], dec[order]
+
+    def assertSelectAllNear(self, ra, dec, pad):
+        box = zones.footprint(ra, dec, pad=pad)
+        idxs = zones.select(self.catalog, self.offsets, box)
+
+        tree = matcher.build_tree(ra, dec)
+        near = np.isfinite(tree.query(
+            matcher.to_xyz(self.catalog["ra"], self.catalog["dec"]),
+            distance_upper_bound=matcher.chord(pad))[0])
+
+        self.assertTrue(np.all(np.in1d(np.where(near)[0], idxs)))
+
+    def test_select(self):
+        ra = 266. + np.linspace(-.75, .75, 100)
+        dec = -29. + np.linspace(-.75, .75, 100)
+        self.assertSelectAllNear(ra, dec, pad=.5)
+
+    def test_select_cross_ra_zero(self):
+        ra = np.mod(np.linspace(-.75, .75, 100), 360.)
+        dec = np.linspace(-.75, .75, 100)
+        box = zones.footprint(ra, dec)
+        self.assertGreater(box[0], box[1])
+        self.assertSelectAllNear(ra, dec, pad=.5)
+
+    def test_select_brute_force(self):
+        random = np.random.RandomState(7)
+        for _ in range(20):
+            ra = np.mod(random.uniform(0, 360) + random.normal(0, 1, 50), 360.)
+            dec = np.clip(random.uniform(-85, 85) + random.normal(0, 1, 50),
+                          -90., 90.)
+            box = zones.footprint(ra, dec, pad=random.uniform(0, 2))
+
+            idxs = zones.select(self.catalog, self.offsets, box)
+            expected = np.where(zones.in_box(
+                self.catalog["ra"], self.catalog["dec"], box))[0]
+            np.testing.assert_array_equal(idxs, expected)
+
+    def test_overlap(self):
+        box = zones.footprint([359.5, .5], [-29.5, -28.5])
+        self.assertTrue(zones.overlap(box, (.2, .3, -29., -28.8)))
+        self.assertTrue(zones.overlap(box, (359., 1., -28.6, -28.)))
+        self.assertFalse(zones.overlap(box, (350., 355., -29., -28.8)))
+        self.assertFalse(zones.overlap(box, (.2, .3, -28., -27.)))
+        self.assertFalse(zones.overlap(box, (1., 2., -29., -28.8)))
+
+
+class CatalogsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp("_carpyncho_catalogs")
+        self.patchs = [
+            mock.patch.object(
+                catalogs, name, os.path.join(self.path, fname))
+            for name, fname in (
+                ("CATALOG_PATH", "catalog.pkl"),
+                ("NPY_CATALOG_PATH", "catalog.npy"),
+                ("ZONES_PATH", "zones.npy"))]
+        for patch in self.patchs:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patchs:
+            patch.stop()
+        shutil.rmtree(self.path)
+
+    def save_catalog(self, ids, mtime):
+        df = pd.DataFrame({
+            "ID": ids, "ra": 266., "dec": -29.,
+            "cls": "RRLyr-RRab", "catalog": "OGLE-4"})
+        df.to_pickle(catalogs.CATALOG_PATH)
+        os.utime(catalogs.CATALOG_PATH, (mtime, mtime))
+
+    def test_rebuild_stale_index(self):
+        self.assertTrue(catalogs.index_is_stale())
+
+        self.save_catalog(["A"], 1000)
+        footprint = catalogs.load_footprint([266.], [-29.], pad=.1)
+        self.assertEqual(list(footprint["ID"]), ["A"])
+        self.assertFalse(catalogs.index_is_stale())
+
+        self.save_catalog(["A", "B"], os.path.getmtime(
+            catalogs.ZONES_PATH) + 10)
+        self.assertTrue(catalogs.index_is_stale())
+        footprint = catalogs.load_footprint([266.], [-29.], pad=.1)
+        self.assertEqual(sorted(footprint["ID"]), ["A", "B"])
+
+
+class LCIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        size = 10000
+        self.obs = np.empty(size, dtype=[
+            ("bm_src_id", np.int64), ("pwp_stack_src_hjd", float)])
+        self.obs["bm_src_id"] = random.randint(0, 500, size) * 7
+        self.obs["pwp_stack_src_hjd"] = random.rand(size)
+
+    def test_source_slice(self):
+        self.assertFalse(lcindex.is_sorted(self.obs))
+        obs = self.obs[lcindex.sort_order(self.obs)]
+        self.assertTrue(lcindex.is_sorted(obs))
+
+        index = lcindex.build(obs["bm_src_id"])
+        for src_id in np.unique(self.obs["bm_src_id"]):
+            src_obs = obs[lcindex.source_slice(index, src_id)]
+            expected = self.obs[self.obs["bm_src_id"] == src_id]
+            np.testing.assert_array_equal(
+                src_obs["pwp_stack_src_hjd"],
+                np.sort(expected["pwp_stack_src_hjd"]))
+
+    def test_chunk(self):
+        obs = self.obs[lcindex.sort_order(self.obs)]
+        index = lcindex.build(obs["bm_src_id"])
+        rows, chunk_index = lcindex.chunk(index, 700, 1400)
+
+        chunk_obs = obs[rows]
+        self.assertEqual(chunk_obs["bm_src_id"].min(), 700)
+        self.assertEqual(chunk_obs["bm_src_id"].max(), 1400)
+        for src_id in chunk_index["id"]:
+            np.testing.assert_array_equal(
+                chunk_obs[lcindex.source_slice(chunk_index, src_id)],
+                obs[lcindex.source_slice(index, src_id)])
+
+        rows, chunk_index = lcindex.chunk(index, 10 ** 6, 10 ** 7)
+        self.assertEqual(len(obs[rows]), 0)
+        self.assertEqual(len(chunk_index), 0)
+
+    def test_source_slice_missing(self):
+        obs = self.obs[lcindex.sort_order(self.obs)]
+        index = lcindex.build(obs["bm_src_id"])
+        self.assertEqual(len(obs[lcindex.source_slice(index, 3)]), 0)
+        self.assertEqual(len(obs[lcindex.source_slice(index, 10 ** 6)]), 0)
+
+    def test_merge_and_blocks(self):
+        half = int(len(self.obs) / 2)
+        parts = [self.obs[:half], self.obs[half:]]
+        merged = lcindex.merge([
+            lcindex.build(np.sort(part["bm_src_id"])) for part in parts])
+        obs = self.obs[lcindex.sort_order(self.obs)]
+        np.testing.assert_array_equal(
+            merged, lcindex.build(obs["bm_src_id"]))
+
+        for max_rows in (1, 100, len(obs)):
+            previous = None
+            for first_id, last_id in lcindex.blocks(merged, max_rows):
+                rows, chunk_index = lcindex.chunk(merged, first_id, last_id)
+                self.assertTrue(
+                    rows.stop - rows.start <= max_rows or
+                    len(chunk_index) == 1)
+                self.assertEqual(rows.start, 0 if previous is None else
+                                 previous)
+                previous = rows.stop
+            self.assertEqual(previous, len(obs))
+
+
+class LCStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        size = 10000
+        self.arr = np.empty(size, dtype=[
+            ("bm_src_id", np.int64), ("pwp_stack_src_hjd", float),
+            ("pwp_stack_src_mag3", float), ("vs_type", "|S13")])
+        self.arr["bm_src_id"] = np.sort(random.randint(0, 500, size))
+        self.arr["pwp_stack_src_hjd"] = random.rand(size)
+        self.arr["pwp_stack_src_mag3"] = random.rand(size)
+        self.arr["vs_type"] = "RRLyr-RRab"
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def assertStorage(self, storage):
+        base_path = os.path.join(self.path, "lc_obs_b000")
+        path = lcstorage.save(base_path, self.arr, storage)
+        self.assertEqual(lcstorage.find(base_path)[0], path)
+
+        columns = ["bm_src_id", "pwp_stack_src_mag3"]
+        rows = [3, 10, 9999]
+        np.testing.assert_array_equal(storage.load(path), self.arr)
+        np.testing.assert_array_equal(
+            storage.load(path, columns), self.arr[columns])
+        np.testing.assert_array_equal(
+            storage.read(path, 100, 200), self.arr[100:200])
+        np.testing.assert_array_equal(
+            storage.read(path, 100, 200, "vs_type"),
+            self.arr["vs_type"][100:200])
+        np.testing.assert_array_equal(
+            storage.take(path, rows, columns), self.arr[columns][rows])
+
+    def test_npy(self):
+        self.assertStorage(lcstorage.get_storage("npy"))
+
+    def test_hdf5(self):
+        self.assertStorage(lcstorage.get_storage("hdf5"))
+
+    def test_columns(self):
+        storage = lcstorage.get_storage("columns")
+        self.assertStorage(storage)
+
+        base_path = os.path.join(self.path, "lc_obs_b000")
+        path, _ = lcstorage.find(base_path)
+        self.assertIsInstance(
+            storage.column(path, "pwp_stack_src_mag3"), np.memmap)
+
+        amplitude = self.arr["pwp_stack_src_mag3"] * 2
+        storage.add_column(path, "Amplitude", amplitude)
+        self.assertEqual(
+            storage.dtype(path).names,
+            self.arr.dtype.names + ("Amplitude",))
+        np.testing.assert_array_equal(
+            storage.load(path, "Amplitude"), amplitude)
+        with self.assertRaises(ValueError):
+            storage.add_column(path, "Color", amplitude[:10])
+
+    def test_load_frame(self):
+        rows = [3, 10, 9999]
+        for name in ("npy", "hdf5", "columns"):
+            base_path = os.path.join(self.path, "features_" + name)
+            storage = lcstorage.get_storage(name)
+            path = lcstorage.save(base_path, self.arr, storage)
+
+            df = lcstorage.load_frame(path, storage, ["vs_type"], rows)
+            self.assertEqual(list(df.columns), ["vs_type"])
+            self.assertEqual(list(df.index), rows)
+
+            df = lcstorage.load_frame(
+                path, storage, "bm_src_id", slice(100, 200))
+            self.assertEqual(list(df.index), range(100, 200))
+            np.testing.assert_array_equal(
+                df.bm_src_id.values, self.arr["bm_src_id"][100:200])
+
+            df = lcstorage.load_frame(path, storage)
+            self.assertEqual(list(df.columns), list(self.arr.dtype.names))
+
+    def test_save_remove_other_storages(self):
+        base_path = os.path.join(self.path, "lc_obs_b000")
+        lcstorage.save(base_path, self.arr, lcstorage.get_storage("npy"))
+        lcstorage.save(base_path, self.arr, lcstorage.get_storage("columns"))
+        path = lcstorage.save(
+            base_path, self.arr, lcstorage.get_storage("hdf5"))
+        self.assertEqual(os.listdir(self.path), [os.path.basename(path)])
+
+
+class LCSchemaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        size = 10000
+        pwp_ids = random.randint(1, 3000, size)
+        self.obs = np.empty(size, dtype=lcschema.OBS_DTYPE)
+        self.obs["bm_src_id"] = 30010000000000 + random.randint(0, 500, size)
+        self.obs["pwp_id"] = pwp_ids
+        self.obs["pwp_stack_src_id"] = lcschema.pwp_src_id(
+            pwp_ids, random.randint(0, 10 ** 6, size))
+        # MJD with less than 5 seconds of spread by pawprint
+        self.obs["pwp_stack_src_hjd"] = (
+            55000. + pwp_ids + random.rand(size) * 5e-5)
+        self.obs["pwp_stack_src_mag3"] = random.uniform(10, 18, size)
+        self.obs["pwp_stack_src_mag_err3"] = random.rand(size)
+        self.obs = self.obs[lcindex.sort_order(self.obs)]
+
+    def test_roundtrip(self):
+        arr, pawprints = lcschema.encode(self.obs)
+        self.assertTrue(lcschema.is_compact(arr))
+        self.assertEqual(arr.dtype, np.dtype(lcschema.COMPACT_DTYPE))
+        self.assertLess(arr.nbytes, self.obs.nbytes / 2)
+
+        index = lcindex.build(self.obs["bm_src_id"])
+        rows = lcindex.source_slice(index, self.obs["bm_src_id"][42])
+        src_ids = lcschema.row_source_ids(index, rows)
+        decoded = lcschema.decode(arr[rows], pawprints, src_ids)
+        expected = self.obs[rows]
+
+        for name in ["bm_src_id", "pwp_id", "pwp_stack_src_id"]:
+            np.testing.assert_array_equal(decoded[name], expected[name])
+        np.testing.assert_array_equal(
+            decoded["pwp_stack_src_hjd"], expected["pwp_stack_src_hjd"])
+        np.testing.assert_allclose(
+            decoded["pwp_stack_src_mag3"], expected["pwp_stack_src_mag3"],
+            rtol=1e-6)
+
+        hjd = lcschema.decode(
+            arr, pawprints, self.obs["bm_src_id"], "pwp_stack_src_hjd")
+        np.testing.assert_array_equal(hjd, self.obs["pwp_stack_src_hjd"])
+
+    def test_exact_offsets(self):
+        hjd = 57000. + np.random.RandomState(7).rand(1000) * 1e-3 / 86400
+        self.assertTrue(lcschema.exact_offsets(hjd, lcschema.hjd_base(hjd)))
+        self.assertTrue(lcschema.exact_offsets(
+            hjd, np.full(len(hjd), lcschema.hjd_base(hjd))))
+        self.assertFalse(lcschema.exact_offsets(hjd + 1., hjd.min()))
+
+    def test_hjd_spread(self):
+        # the heliocentric correction spreads the hjd of a pawprint up to
+        # ~13 seconds, the float32 offsets to the midpoint are still exact
+        random = np.random.RandomState(7)
+        for seconds, dtype in [(15., lcschema.COMPACT_DTYPE),
+                               (30., lcschema.COMPACT_HJD64_DTYPE)]:
+            spread = random.rand(len(self.obs)) * seconds / 86400
+            self.obs["pwp_stack_src_hjd"] = (
+                55000. + self.obs["pwp_id"] + spread)
+            arr, pawprints = lcschema.encode(self.obs)
+            self.assertEqual(arr.dtype, np.dtype(dtype))
+            self.assertLess(arr.nbytes, self.obs.nbytes)
+
+            hjd = lcschema.decode(
+                arr, pawprints, self.obs["bm_src_id"], "pwp_stack_src_hjd")
+            np.testing.assert_array_equal(
+                hjd, self.obs["pwp_stack_src_hjd"])
+
+    def test_read_rows(self):
+        arr, pawprints = lcschema.encode(self.obs)
+        index = lcindex.build(self.obs["bm_src_id"])
+        rows = lcindex.source_slice(index, self.obs["bm_src_id"][42])
+        columns = ["bm_src_id", "pwp_stack_src_hjd"]
+
+        # the full layout is readed as is
+        np.testing.assert_array_equal(
+            lcschema.read_rows(self.obs, None, index, rows, columns),
+            self.obs[rows][columns])
+        np.testing.assert_array_equal(
+            lcschema.read_rows(arr, pawprints, index, rows, columns),
+            self.obs[rows][columns])
+
+    def test_not_encodable(self):
+        self.obs["pwp_stack_src_id"][10] += 10 ** 8
+        self.assertEqual(lcschema.encode(self.obs), (None, None))
+
+
+class ZonemapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        size = 10000
+        self.arr = np.empty(size, dtype=[
+            ("id", np.int64), ("Mean", float), ("vs_type", "|S13")])
+        self.arr["id"] = np.arange(size)
+        self.arr["Mean"] = np.sort(random.uniform(10, 18, size))
+        self.arr["Mean"][random.randint(0, size, 100)] = np.nan
+        self.arr["vs_type"] = ""
+        self.arr["vs_type"][::7] = "RRLyr-RRab"
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_build(self):
+        zm = zonemap.build(self.arr, group_size=1000)
+        self.assertEqual(len(zm), 10)
+        self.assertEqual(zm.dtype["min"].names, ("id", "Mean"))
+        np.testing.assert_array_equal(zm["start"], np.arange(0, 10000, 1000))
+        np.testing.assert_array_equal(zm["max"]["id"], zm["stop"] - 1)
+        self.assertFalse(np.any(np.isnan(zm["min"]["Mean"])))
+
+    def test_groups(self):
+        zm = zonemap.build(self.arr, group_size=1000)
+        predicates = [("Mean", ">", 12), ("Mean", "<", 13)]
+        mask = zonemap.groups(zm, predicates)
+        self.assertTrue(0 < mask.sum() < len(zm))
+
+        rows = np.flatnonzero(zonemap.evaluate(self.arr, predicates))
+        for start, stop in zonemap.ranges(zm, predicates):
+            rows = rows[(rows < start) | (rows >= stop)]
+        self.assertEqual(len(rows), 0)
+
+        # the columns without statistics never skip a group
+        mask = zonemap.groups(zm, [("vs_type", "==", "")])
+        self.assertTrue(mask.all())
+
+    def test_where(self):
+        storage = lcstorage.ColumnarStorage(row_group_size=1000)
+        path = lcstorage.save(
+            os.path.join(self.path, "features_b000"), self.arr, storage)
+        for predicates in (
+            [("Mean", ">", 12), ("Mean", "<", 16.5)],
+            [("Mean", "between", (11, 11.5)), ("vs_type", "!=", "")],
+            [("Mean", ">", 100)],
+            [("vs_type", "==", "")],
+        ):
+            expected = np.flatnonzero(zonemap.evaluate(self.arr, predicates))
+            np.testing.assert_array_equal(
+                lcstorage.where(path, storage, predicates), expected)
+
+        storage.add_column(path, "Amplitude", self.arr["Mean"] + 100)
+        rows = lcstorage.where(path, storage, [("Amplitude", "<", 111)])
+        expected = zonemap.evaluate(self.arr, [("Mean", "<", 11)])
+        np.testing.assert_array_equal(rows, np.flatnonzero(expected))
+
+    def test_cluster_order(self):
+        # the features are stored in id order, so the Mean of every group
+        # has almost all their range
+        random = np.random.RandomState(42)
+        self.arr["Mean"] = random.uniform(10, 18, len(self.arr))
+        self.arr["Mean"][random.randint(0, len(self.arr), 100)] = np.nan
+        predicates = [("Mean", ">", 12), ("Mean", "<", 12.5)]
+        expected = self.arr["id"][zonemap.evaluate(self.arr, predicates)]
+
+        zm = zonemap.build(self.arr, group_size=500)
+        self.assertTrue(zonemap.groups(zm, predicates).all())
+
+        # but sorted by the Mean only a few groups are readed
+        arr = self.arr[zonemap.cluster_order(self.arr["Mean"])]
+        self.assertTrue(np.isnan(arr["Mean"][-100:]).all())
+        zm = zonemap.build(arr, group_size=500)
+        mask = zonemap.groups(zm, predicates)
+        self.assertLessEqual(mask.sum(), 3)
+
+        storage = lcstorage.ColumnarStorage(row_group_size=500)
+        path = lcstorage.save(
+            os.path.join(self.path, "features_b000"), arr, storage)
+        rows = lcstorage.where(path, storage, predicates)
+        np.testing.assert_array_equal(np.sort(arr["id"][rows]), expected)
+
+
+def _assert_same_period(features, expected):
+    """The features of the same best period. The false alarm probability
+    is only close, the power of the full grid is an approximation.
+
+    """
+    for name in ("PeriodLS", "Psi_CS", "Psi_eta"):
+        np.testing.assert_equal(features[name], expected[name])
+    np.testing.assert_allclose(
+        features["Period_fit"], expected["Period_fit"], rtol=.05)
+
+
+class FeetsPatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        size = 100
+        self.time = np.sort(2456000 + random.uniform(0, 1000, size))
+        self.magnitude = (
+            14 + .4 * np.sin(2 * np.pi * self.time / .56) +
+            random.normal(0, .03, size))
+        self.error = np.full(size, .03)
+        self.kwds = {"autopower_kwds": {
+            "normalization": "standard",
+            "maximum_frequency": 10., "minimum_frequency": 1. / 200}}
+
+    def test_intermediates(self):
+        lc = feets_patch.intermediates(self.time, self.magnitude, self.error)
+        periodogram = lc.periodogram(self.kwds)
+
+        # the same light curve (even copied) reuse the results
+        same = feets_patch.intermediates(
+            self.time.copy(), self.magnitude.copy(), self.error.copy())
+        self.assertIs(same, lc)
+        self.assertIs(same.periodogram(dict(self.kwds)), periodogram)
+        np.testing.assert_allclose(
+            1 / lc.best_frequency(self.kwds), .56, rtol=1e-3)
+
+        other = feets_patch.intermediates(
+            self.time, self.magnitude + 1, self.error)
+        self.assertIsNot(other, lc)
+
+        frequency, power, fmax = feets_patch.lscargle_error(
+            self.time - self.time.min(), self.magnitude + 1, self.error,
+            **self.kwds)
+        np.testing.assert_array_equal(
+            other.periodogram(self.kwds)[1], power)
+
+    def test_extractor_frequencies(self):
+        obs = np.empty(len(self.time), dtype=lcschema.OBS_DTYPE)
+        obs["bm_src_id"] = 30010000000001
+        obs["pwp_id"] = np.arange(len(obs))
+        obs["pwp_stack_src_id"] = lcschema.pwp_src_id(obs["pwp_id"], 0)
+        obs["pwp_stack_src_hjd"] = self.time
+        obs["pwp_stack_src_mag3"] = self.magnitude
+        obs["pwp_stack_src_mag_err3"] = self.error
+        kwds = self.kwds
+
+        class FeatureSpace(object):
+            features_as_array_ = ["PeriodLS"]
+
+            def extract(self, magnitude, time, error):
+                ls = object.__new__(feets_patch.LombScargleWithError)
+                features = ls.fit(
+                    magnitude, time, error, kwds, False, feets_patch.FAP_KWDS)
+                return ["PeriodLS"], [features["PeriodLS"]]
+
+        arr, pawprints = lcschema.encode(obs)
+        extractor = Extractor(
+            FeatureSpace(), "b001", 1, 1, obs=arr,
+            index=lcindex.build(obs["bm_src_id"]), pawprints=pawprints)
+        with mock.patch("sys.stdout", new_callable=six.StringIO) as out:
+            extractor(pd.DataFrame({"id": obs["bm_src_id"][:1]}))
+
+        # the extractor reports the frequencies of the periodogram
+        src_obs = extractor.read_observations(obs["bm_src_id"][0])
+        lc = feets_patch.intermediates(
+            src_obs["pwp_stack_src_hjd"], src_obs["pwp_stack_src_mag3"],
+            src_obs["pwp_stack_src_mag_err3"])
+        self.assertEqual(lc.n_frequencies, len(lc.periodogram(kwds)[0]))
+        self.assertIn(
+            "END: 30010000000001 - frequencies: {}".format(lc.n_frequencies),
+            out.getvalue())
+
+    def test_harmonic_fit(self):
+        from scipy.optimize import curve_fit
+
+        time = self.time - self.time.min()
+        freq = 2 / .56
+        error = self.error * np.linspace(.5, 2, len(time))
+
+        def func(x, a, b, c):
+            return (a * np.sin(2 * np.pi * freq * x) +
+                    b * np.cos(2 * np.pi * freq * x) + c)
+
+        for sigma in (None, error):
+            expected = curve_fit(func, time, self.magnitude, sigma=sigma)[0]
+            coefficients, model = feets_patch.harmonic_fit(
+                time, self.magnitude, freq, error=sigma)
+            np.testing.assert_allclose(coefficients, expected, atol=1e-6)
+            np.testing.assert_allclose(
+                model, func(time, *expected), atol=1e-6)
+
+    def test_adaptive_grid(self):
+        random = np.random.RandomState(3)
+        adaptive = dict(feets_patch.LSCARGLE_KWDS, grid="adaptive")
+        for _ in range(10):
+            # a synthetic RR Lyrae (fast rise and slow decline)
+            size = random.randint(40, 150)
+            time = np.sort(random.uniform(0, 1500, size))
+            phase = np.mod(time / random.uniform(.3, .9), 1)
+            magnitude = (
+                14 + .6 * np.abs(phase - .2) +
+                .1 * np.sin(4 * np.pi * phase) +
+                random.normal(0, .05, size))
+            error = np.full(size, .05)
+
+            frequency, power, fmax = feets_patch.lscargle_error(
+                time, magnitude, error, **feets_patch.LSCARGLE_KWDS)
+            afrequency, apower, afmax = feets_patch.lscargle_error(
+                time, magnitude, error, **adaptive)
+
+            # fmax is the position in the full grid in both cases
+            self.assertEqual(afmax, fmax)
+            self.assertEqual(afrequency[np.argmax(apower)], frequency[fmax])
+            self.assertLess(len(afrequency), len(frequency) / 3)
+            np.testing.assert_array_equal(
+                np.in1d(afrequency, frequency), True)
+
+            # and so all the features of the best period are the same
+            extractor = object.__new__(feets_patch.LombScargleWithError)
+            features = [
+                extractor.fit(
+                    magnitude, time, error, kwds, False,
+                    feets_patch.FAP_KWDS)
+                for kwds in (feets_patch.LSCARGLE_KWDS, adaptive)]
+            _assert_same_period(features[1], features[0])
+
+        with self.assertRaises(ValueError):
+            feets_patch.lscargle_error(
+                time, magnitude, error, grid="unknown")
+
+
+class BatchLSTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(7)
+        n_epochs, n_sources = 80, 20
+        epochs = np.sort(2456000 + random.uniform(0, 1400, n_epochs))
+        self.periods = random.uniform(.2, 50, n_sources)
+
+        rows = []
+        for src_n, period in enumerate(self.periods):
+            for pwp_id in np.flatnonzero(random.rand(n_epochs) > .15):
+                # the heliocentric correction of every source
+                hjd = epochs[pwp_id] + random.normal(0, 3e-5)
+                mag = (
+                    14 + .3 * np.sin(2 * np.pi * hjd / period) +
+                    random.normal(0, .05))
+                err = .05 * (1 + random.rand())
+                rows.append((1000 + src_n, pwp_id, hjd, mag, err))
+        self.obs = np.array(rows, dtype=[
+            ("bm_src_id", np.int64), ("pwp_id", np.int64),
+            ("pwp_stack_src_hjd", float), ("pwp_stack_src_mag3", float),
+            ("pwp_stack_src_mag_err3", float)])
+        self.src_ids = np.arange(1000, 1000 + n_sources + 1)
+        self.kwds = feets_patch.LSCARGLE_KWDS
+
+    def test_from_observations(self):
+        periods = batchls.from_observations(
+            self.obs, self.src_ids, self.kwds["autopower_kwds"])
+        np.testing.assert_array_equal(periods["id"], self.src_ids)
+
+        # the last source has no observations
+        self.assertTrue(np.isnan(periods["frequency"][-1]))
+
+        for period in periods[:-1]:
+            obs = self.obs[self.obs["bm_src_id"] == period["id"]]
+            lc = feets_patch.intermediates(
+                obs["pwp_stack_src_hjd"], obs["pwp_stack_src_mag3"],
+                obs["pwp_stack_src_mag_err3"])
+            frequency, power, fmax = lc.best(self.kwds)
+            np.testing.assert_allclose(
+                1 / period["frequency"], 1 / frequency, rtol=1e-2)
+            np.testing.assert_allclose(period["power"], power, atol=.05)
+
+            # the seed is moved to the own grid of the source, so the
+            # best period is the same with and without batch
+            lc.seed(self.kwds, period["frequency"])
+            batch_best = lc.best(self.kwds, batch=True)
+            best = lc.best(self.kwds)
+            self.assertEqual(batch_best[::2], best[::2])
+            np.testing.assert_allclose(batch_best[1], best[1], atol=1e-3)
+
+            extractor = object.__new__(feets_patch.LombScargleWithError)
+            features = [
+                extractor.fit(
+                    obs["pwp_stack_src_mag3"], obs["pwp_stack_src_hjd"],
+                    obs["pwp_stack_src_mag_err3"], self.kwds, batch,
+                    feets_patch.FAP_KWDS)
+                for batch in (False, True)]
+            _assert_same_period(features[1], features[0])
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(max_bytes=3 * 80)
+        for key in range(3):
+            cache.set(key, np.zeros(10))
+        cache.get(0)
+        cache.set(3, np.zeros(10))
+
+        self.assertNotIn(1, cache)
+        for key in (0, 2, 3):
+            self.assertIn(key, cache)
+        self.assertEqual(cache.nbytes, 3 * 80)
+
+    def test_too_big(self):
+        cache = LRUCache(max_bytes=80)
+        cache.set(0, np.zeros(10))
+        cache.set(1, np.zeros(11))
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+
+
+class APITestCase(unittest.TestCase):
+
+    def test_tile_name_of(self):
+        self.assertEqual(api.tile_name_of(40010000000130), "d001")
+        self.assertEqual(api.tile_name_of("33960000000001"), "b396")
+        with self.assertRaises(ValueError):
+            api.tile_name_of(50010000000130)
+
+
+# =============================================================================
+# LIB TESTS RUNNER
+# =============================================================================
+
+def lib_test_cases():
+    """The plain unittest cases of this module (the corral runner only
+    collects the qa.TestCase)
+
+    """
+    return [
+        cls for cls in globals().values()
+        if isinstance(cls, type) and issubclass(cls, unittest.TestCase) and
+        not issubclass(cls, qa.TestCase)]
+
+
+class LibTestCase(qa.TestCase):
+    """Run all the lib tests inside the corral runner"""
+
+    subject = Paths
+
+    def validate(self):
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite(
+            loader.loadTestsFromTestCase(cls) for cls in lib_test_cases())
+        result = unittest.TestResult()
+        suite.run(result)
+
+        problems = result.errors + result.failures
+        self.assertTrue(suite.countTestCases())
+        self.assertFalse(problems, "\n".join(
+            "{}\n{}".format(test.id(), trace) for test, trace in problems))
@@ -17,28 +17,24 @@ CPUS = cpu_count()
 
 tiles = "b262 b263 b261 b264 b220 b278".split()
 
-from carpyncho.lib.beamc import add_columns
-
 
 def main():
     with db.session_scope() as ses:
         query = ses.query(LightCurves).join(Tile).filter(Tile.name.in_(tiles))
         for lc in query:
             print lc
-            feats = lc.features
-            if "AmplitudeJH" in feats.dtype.names:
+            if "AmplitudeJH" in lc.features_columns:
                 print "   skip!"
                 continue
 
-            columns = [
-                ("AmplitudeJH", feats["AmplitudeJ"] - feats["AmplitudeH"]),
-                ("AmplitudeJK", feats["AmplitudeJ"] - feats["Amplitude"])]
-
-            feats = add_columns(feats, columns, append=True)
-
+            feats = lc.get_features(["AmplitudeJ", "AmplitudeH", "Amplitude"])
 
+            # only the new columns are written
             lc.tile.ready = False
-            lc.features = feats
+            lc.add_feature_column(
+                "AmplitudeJH", feats["AmplitudeJ"] - feats["AmplitudeH"])
+            lc.add_feature_column(
+                "AmplitudeJK", feats["AmplitudeJ"] - feats["Amplitude"])
             lc.tile.ready = True
 
             ses.commit()
@@ -85,15 +85,11 @@ def reorder(df):
     return df[order]
 
 
-def remove_bad_color(df):
-    df = df[
-        df.c89_hk_color.between(-100, 100) &
-        df.c89_jh_color.between(-100, 100) &
-        df.c89_jk_color.between(-100, 100) &
-        df.n09_hk_color.between(-100, 100) &
-        df.n09_jh_color.between(-100, 100) &
-        df.n09_jk_color.between(-100, 100)]
-    return df
+# the sources with bad colors are removed when the features are readed
+GOOD_COLORS = [
+    (color, "between", (-100, 100))
+    for color in ("c89_hk_color", "c89_jh_color", "c89_jk_color",
+                  "n09_hk_color", "n09_jh_color", "n09_jk_color")]
 
 def main():
     with db.session_scope() as ses:
@@ -107,12 +103,11 @@ def main():
                 continue
 
             lc = tile.lcurves
-            feats = pd.DataFrame(lc.features)
-            feats = remove_bad_color(feats)  # here we remove the bad colors
+            feats = lc.features_frame(where=GOOD_COLORS)
             gc.collect()
 
-            obs = pd.DataFrame(lc.observations)
-            obs = obs[obs.bm_src_id.isin(feats.id)]
+            # the old observations are sorted by source here
+            index = lc.build_observations_index()
             gc.collect()
 
             to_proc = tqdm.tqdm(get_old_feats(feats), desc=lc.tile.name)
@@ -121,7 +116,8 @@ def main():
                 new_feats = P(
                     joblib.delayed(extract)(  # the exract make the source sigmaclip
                         sid=sid,
-                        obs=obs[obs.bm_src_id == sid],
+                        obs=pd.DataFrame(lc.read_observations(
+                            lc.source_slice(sid, index))),
                         old_feats=old_feats)
                     for sid, old_feats in to_proc)
 
@@ -27,17 +27,18 @@ def main():
             print lc
             tile = lc.tile
 
-            features = pd.DataFrame(lc.features)
-
-            features = features[features.Mean > 12]
-            features = features[features.Mean < 16.5]
+            # only the id and Mean are readed to select the sample
+            features = lc.features_frame(
+                ["id", "Mean"], where=[("Mean", ">", 12), ("Mean", "<", 16.5)])
 
             vss = features[features.id.isin(o3id)]
             unk = features[~features.id.isin(o3id)]
-            unk["vs_type"] = ""
 
+            vss = lc.features_frame(rows=np.sort(vss.index.values))
             for sample_size in [2500, 5000, 20000]:
                 samp = unk.sample(sample_size)
+                samp = lc.features_frame(rows=np.sort(samp.index.values))
+                samp["vs_type"] = ""
                 samples[sample_size].append(samp)
                 samples[sample_size].append(vss)
 
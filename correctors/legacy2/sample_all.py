@@ -18,11 +18,12 @@ def main():
         for lc in query:
             print lc
 
-            features = pd.DataFrame(lc.features)
-            features = features[features.Mean > 12]
-            features = features[features.Mean < 16.5]
+            # only the Mean is readed to select the sample
+            features = lc.features_frame(
+                ["Mean"], where=[("Mean", ">", 12), ("Mean", "<", 16.5)])
             sample = features.sample(1000)
-            result.append(sample)
+            result.append(
+                lc.features_frame(rows=np.sort(sample.index.values)))
 
         print "Merging"
         result = pd.concat(result, ignore_index=True)
@@ -12,7 +12,7 @@ import pandas as pd
 
 import tqdm
 
-from carpyncho.lib import feets_patch
+from carpyncho.lib import feets_patch, lcindex
 from carpyncho.models import *
 
 import joblib
@@ -176,8 +176,11 @@ def extract(time, magnitude, error, feats):
 
 def extract_part(result_folder, used_ids_folder, sids, sids_feats, sids_obs):
     results, with_errors = [], []
+
+    # the observations are sorted by source so every source is a slice
+    index = lcindex.build(sids_obs.bm_src_id.values)
     for sid in sids:
-        obs = sids_obs[sids_obs.bm_src_id == sid]
+        obs = sids_obs.iloc[lcindex.source_slice(index, sid)]
 
         time, magnitude, error = sigma_clip(obs)
         cnt = len(time)
@@ -231,16 +234,12 @@ def process(session):
 
         # read the original features
         lc = tile.lcurves
-        feats = pd.DataFrame(lc.features)[COLUMNS_TO_PRESERVE]
-
-        # here we remove the bad colors
-        feats = feats[
-            feats.c89_hk_color.between(-100, 100) &
-            feats.c89_jh_color.between(-100, 100) &
-            feats.c89_jk_color.between(-100, 100) &
-            feats.n09_hk_color.between(-100, 100) &
-            feats.n09_jh_color.between(-100, 100) &
-            feats.n09_jk_color.between(-100, 100)]
+        # here we remove the bad colors (only the row groups with good
+        # colors are readed)
+        feats = lc.features_frame(COLUMNS_TO_PRESERVE, where=[
+            (color, "between", (-100, 100))
+            for color in ("c89_hk_color", "c89_jh_color", "c89_jk_color",
+                          "n09_hk_color", "n09_jh_color", "n09_jk_color")])
 
 
         # get the already usded ids
@@ -254,9 +253,14 @@ def process(session):
             print("Skiping {} of {}".format(len(used_ids), len(feats)))
             feats = feats[~feats.id.isin(used_ids)]
 
-        # retrieve all the observation for this features
-        all_obs = pd.DataFrame(lc.observations)
-        all_obs = all_obs[all_obs.bm_src_id.isin(feats.id)]
+        # the observations are sorted by source, so the observations of
+        # every source are a slice
+        index = lc.build_observations_index()
+
+        def read_obs(ids):
+            return pd.DataFrame(np.concatenate([
+                lc.read_observations(lc.source_slice(sid, index))
+                for sid in ids]))
 
         # garbage collection
         gc.collect()
@@ -264,15 +268,13 @@ def process(session):
         # split the features in a arrays of size SPLIT_SIZE
         n_feats = len(feats)
         number_of_parts = int(n_feats / SPLIT_SIZE) or 1
-        split_ids = np.array_split(feats.id.values, number_of_parts)
-        split_ids = map(tuple, split_ids)
+        split_feats = np.array_split(feats.sort_values("id"), number_of_parts)
+        split_ids = [tuple(part.id.values) for part in split_feats]
 
         # this generate observation for the split_ids part
-        feats_and_obs_gen = tqdm.tqdm((
-            ids,
-            feats[feats.id.isin(ids)],
-            all_obs[all_obs.bm_src_id.isin(ids)]
-        ) for ids in split_ids)
+        feats_and_obs_gen = (
+            (ids, part, read_obs(ids))
+            for ids, part in zip(split_ids, split_feats))
 
         # this part generates the progress bar
         feats_and_obs_gen = tqdm.tqdm(